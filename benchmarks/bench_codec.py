@@ -0,0 +1,75 @@
+"""JSON codecs available to the proxy on the payloads of its plugins
+
+    python benchmarks/bench_codec.py
+
+Prints microseconds per dumps/loads call of every available codec.
+"""
+
+import argparse
+import json
+import timeit
+
+from cocaine.proxy import codec
+
+
+def jsonrpc_request():
+    return {"jsonrpc": "2.0", "method": "storage.read", "params": ["collection", "key"], "id": 1}
+
+
+def jsonrpc_batch():
+    return [{"jsonrpc": "2.0", "method": "storage.read", "params": ["collection", "key%d" % i], "id": i}
+            for i in xrange(20)]
+
+
+def jsonrpc_stream():
+    # a streaming result with chunks of a document
+    return {"jsonrpc": "2.0", "id": 1,
+            "result": [{"offset": i * 1024, "data": "d" * 1024, "ratio": i / 7.0} for i in xrange(64)]}
+
+
+def mds_dist_info():
+    return {"primary": [{"host": "storage%02d.mds.example.net" % i, "group": 1000 + i,
+                         "path": "/srv/storage/%d/1" % i} for i in xrange(3)],
+            "size": 1 << 20,
+            "mtime": 1760000000}
+
+
+PAYLOADS = {
+    "jsonrpc_request": jsonrpc_request,
+    "jsonrpc_batch": jsonrpc_batch,
+    "jsonrpc_stream": jsonrpc_stream,
+    "mds_dist_info": mds_dist_info,
+}
+
+
+def measure(func, arg, repeat):
+    timer = timeit.Timer(lambda: func(arg))
+    number = 1
+    while timer.timeit(number) < 0.02:
+        number *= 10
+    return 1e6 * min(timer.repeat(repeat, number)) / number
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    names = codec.available()
+    print("%-16s %-8s %s" % ("payload", "op", "".join("%14s" % name for name in names)))
+    for payload_name in sorted(PAYLOADS):
+        payload = PAYLOADS[payload_name]()
+        encoded = json.dumps(payload)
+        for op in ("dumps", "loads"):
+            timings = []
+            for name in names:
+                codec.select(name)
+                func, arg = (codec.dumps, payload) if op == "dumps" else (codec.loads, encoded)
+                timings.append(measure(func, arg, args.repeat))
+            print("%-16s %-8s %s" % (payload_name, op, "".join("%11.2f us" % t for t in timings)))
+    codec.select()
+    print("selected: %s" % codec.info())
+
+
+if __name__ == "__main__":
+    main()
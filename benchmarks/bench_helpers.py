@@ -0,0 +1,236 @@
+"""Microbenchmarks of the helpers called on every request of the proxy
+
+Each case is timed as the best of several runs, in microseconds per call.
+Results are compared against a baseline saved on the same machine:
+
+    python benchmarks/bench_helpers.py --save       # record the baseline
+    python benchmarks/bench_helpers.py              # compare against it
+
+The exit code is 1 if any case is slower than the baseline by more than
+the threshold.
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import timeit
+
+from tornado import httputil
+from tornado.httputil import HTTPHeaders
+from tornado.httputil import HTTPServerRequest
+
+from cocaine.proxy.helpers import extract_app_and_event
+from cocaine.proxy.helpers import fill_response_in
+from cocaine.proxy.helpers import header_to_seed
+from cocaine.proxy.helpers import pack_httprequest
+from cocaine.proxy.helpers import upper_bound
+from cocaine.proxy.helpers import write_chunked
+from cocaine.proxy.jsonrpc import JSONRPC
+from cocaine.proxy.logutils import NULLLOGGER
+from cocaine.proxy.mds_direct import MDSDirect
+from cocaine.proxy.mds_exec import MDSExec
+from cocaine.proxy.plugin import PluginIndex
+from cocaine.proxy.proxy import generate_request_id
+from cocaine.proxy.proxy import scan_for_updates
+
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "helpers_baseline.json")
+DEFAULT_THRESHOLD = 0.2
+DEFAULT_REPEAT = 5
+# sec a single run of a case takes approximately
+RUN_DURATION = 0.2
+
+HEADERS_COUNT = 40
+COOKIES_COUNT = 20
+URI_LENGTH = 2048
+RING_SIZE = 10000
+GROUPS_COUNT = 200
+GROUP_SIZE = 100
+CHUNK_SIZE = 4096
+
+
+class NullConnection(object):
+    def __init__(self):
+        self.remote_ip = "2a02:6b8::1"
+        self.context = self
+
+    def write_headers(self, start_line, headers, chunk=None, callback=None):
+        pass
+
+    def write(self, chunk, callback=None):
+        pass
+
+    def finish(self):
+        pass
+
+
+def make_request(uri="/app/event", method="POST", body=""):
+    headers = HTTPHeaders()
+    for i in xrange(HEADERS_COUNT):
+        headers.add("X-Header-%d" % i, "value-%d-%s" % (i, "v" * 32))
+    headers.add("Cookie", "; ".join("cookie%d=%s" % (i, "c" * 40) for i in xrange(COOKIES_COUNT)))
+    request = HTTPServerRequest(method=method, uri=uri, version="HTTP/1.1", headers=headers,
+                                body=body, host="example.com", connection=NullConnection())
+    request.logger = NULLLOGGER
+    request.traceid = None
+    return request
+
+
+def long_uri():
+    query = "&".join("arg%d=%s" % (i, "a" * 24) for i in xrange(URI_LENGTH // 32))
+    return "/app/event/some/path?" + query
+
+
+def case_pack_httprequest():
+    request = make_request(body="b" * 1024)
+
+    def run():
+        # cookies are parsed once per request and cached by tornado
+        request.__dict__.pop("_cookies", None)
+        pack_httprequest(request)
+    return run
+
+
+def case_extract_app_and_event_uri():
+    uri = long_uri()
+    request = make_request(uri=uri)
+
+    def run():
+        # the request is restored to be dispatched by uri again
+        request.uri = uri
+        del request.headers["X-Cocaine-Service"], request.headers["X-Cocaine-Event"]
+        extract_app_and_event(request)
+    extract_app_and_event(request)
+    return run
+
+
+def case_extract_app_and_event_headers():
+    request = make_request()
+    request.headers["X-Cocaine-Service"] = "app"
+    request.headers["X-Cocaine-Event"] = "event"
+    return lambda: extract_app_and_event(request)
+
+
+def case_fill_response_in():
+    request = make_request()
+    body = "r" * 1024
+
+    def run():
+        headers = HTTPHeaders()
+        for i in xrange(10):
+            headers.add("X-Reply-%d" % i, "value-%d" % i)
+        fill_response_in(request, 200, httputil.responses[200], body, headers)
+    return run
+
+
+def case_write_chunked():
+    request = make_request()
+    chunk = "c" * CHUNK_SIZE
+    return lambda: write_chunked(request, chunk)
+
+
+def case_header_to_seed():
+    value = "6f1c2a8e-4d3b-4b0a-9a7e-3c2d1e0f9b8a"
+    return lambda: header_to_seed(value)
+
+
+def case_upper_bound():
+    rnd = random.Random(0)
+    ring = sorted((rnd.randint(0, 1 << 32), "app-v%d" % i) for i in xrange(RING_SIZE))
+    value = rnd.randint(0, 1 << 32)
+    return lambda: upper_bound(ring, value)
+
+
+def case_scan_for_updates():
+    rnd = random.Random(0)
+
+    def make_ring():
+        return sorted([rnd.randint(0, 1 << 32), "app-v%d" % i] for i in xrange(GROUP_SIZE))
+
+    current = dict(("group%d" % i, make_ring()) for i in xrange(GROUPS_COUNT))
+    new = dict((name, list(ring)) for name, ring in current.iteritems())
+    # the usual update touches a few groups only
+    for name in rnd.sample(sorted(new), 5):
+        new[name] = make_ring()
+    # it consumes `current`, the copy is a part of the case
+    return lambda: scan_for_updates(dict(current), new)
+
+
+def case_plugin_candidates():
+    # only the declared trigger headers are needed to index plugins
+    index = PluginIndex([MDSExec.__new__(MDSExec), MDSDirect.__new__(MDSDirect), JSONRPC.__new__(JSONRPC)])
+    request = make_request()
+    return lambda: index.candidates(request.headers)
+
+
+def case_generate_request_id():
+    request = make_request()
+    return lambda: generate_request_id(request)
+
+
+CASES = dict((name[len("case_"):], func) for name, func in globals().items() if name.startswith("case_"))
+
+
+def measure(run, repeat=DEFAULT_REPEAT):
+    timer = timeit.Timer(run)
+    # calibrate the number of calls per run
+    number = 1
+    while timer.timeit(number) < RUN_DURATION / 10:
+        number *= 10
+    return 1e6 * min(timer.repeat(repeat, number)) / number
+
+
+def compare(results, baseline, threshold):
+    """Returns [(case, usec, baseline usec, ratio)] of the cases slower than the threshold"""
+    regressions = []
+    for name, usec in sorted(results.iteritems()):
+        base = baseline.get(name)
+        if base and usec > base * (1 + threshold):
+            regressions.append((name, usec, base, usec / base))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("cases", nargs="*", help="cases to run, all of them by default: %s" % ", ".join(sorted(CASES)))
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="path to the baseline JSON")
+    parser.add_argument("--save", action="store_true", help="save the results as the baseline")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="allowed slowdown relative to the baseline, 0.2 is 20%%")
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT)
+    args = parser.parse_args()
+
+    unknown = set(args.cases) - set(CASES)
+    if unknown:
+        parser.error("unknown cases: %s" % ", ".join(sorted(unknown)))
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    results = {}
+    for name in sorted(args.cases or CASES):
+        results[name] = measure(CASES[name](), args.repeat)
+        base = baseline.get(name)
+        change = " %+6.1f%%" % (100.0 * (results[name] / base - 1)) if base else ""
+        print("%-32s %10.3f us%s" % (name, results[name], change))
+
+    if args.save:
+        baseline.update(results)
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print("baseline is saved to %s" % args.baseline)
+        return
+
+    regressions = compare(results, baseline, args.threshold)
+    for name, usec, base, ratio in regressions:
+        print("REGRESSION %s: %.3f us against %.3f us (x%.2f)" % (name, usec, base, ratio))
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""Throughput of CocaineProxy against a local stand-in cocaine runtime
+
+The proxy, the fake runtime and the load generator share one process
+and one IOLoop, so the numbers are relative: compare them between
+revisions on the same machine, e.g.
+
+    python benchmarks/bench_proxy.py --requests 20000 --concurrency 64
+
+Python 2 has no allocation counter, so allocations are reported as the objects
+visible to the garbage collector: cyclic garbage left by a request and
+objects retained after the run.
+"""
+
+import argparse
+import collections
+import gc
+import json
+import logging
+import os
+import socket
+import sys
+import time
+
+from tornado import gen
+from tornado import httpclient
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import IOLoop
+from tornado.netutil import bind_sockets
+
+from cocaine.proxy.proxy import CocaineProxy
+from cocaine.tools.actions.proxylog import percentile
+
+# the fake runtime is a test helper, it is not shipped with the package
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "tests"))
+from fake_runtime import FakeApp  # noqa: E402
+from fake_runtime import FakeRuntime  # noqa: E402
+
+
+APP = "bench"
+
+
+@gen.coroutine
+def drive(url, requests, concurrency, latencies, codes):
+    client = httpclient.AsyncHTTPClient(force_instance=True, max_clients=concurrency)
+    remaining = [requests]
+
+    @gen.coroutine
+    def worker():
+        while remaining[0] > 0:
+            remaining[0] -= 1
+            start = time.time()
+            response = yield client.fetch(url, raise_error=False)
+            latencies.append(1000.0 * (time.time() - start))
+            codes[response.code] += 1
+
+    yield [worker() for _ in xrange(concurrency)]
+    client.close()
+
+
+@gen.coroutine
+def run(requests, concurrency, latency, response_size, chunks, error_rate, queue_full_rate):
+    runtime = FakeRuntime([FakeApp(APP, latency=latency, response_size=response_size, chunks=chunks,
+                                   error_rate=error_rate, queue_full_rate=queue_full_rate, seed=0)])
+    proxy = CocaineProxy(locators=[runtime.locator_endpoint], allow_json_rpc=False)
+    sockets = bind_sockets(0, address="127.0.0.1", family=socket.AF_INET)
+    server = HTTPServer(proxy)
+    server.add_sockets(sockets)
+    url = "http://127.0.0.1:%d/%s/ping" % (sockets[0].getsockname()[1], APP)
+
+    # connections to the app are established during the warm-up
+    yield drive(url, concurrency * 4, concurrency, [], collections.Counter())
+
+    latencies, codes = [], collections.Counter()
+    gc.collect()
+    gc.disable()
+    objects = len(gc.get_objects())
+    start = time.time()
+    try:
+        yield drive(url, requests, concurrency, latencies, codes)
+        duration = time.time() - start
+        garbage = gc.collect()
+        retained = len(gc.get_objects()) - objects
+    finally:
+        gc.enable()
+        server.stop()
+        runtime.stop()
+
+    latencies.sort()
+    raise gen.Return({
+        "requests": requests,
+        "concurrency": concurrency,
+        "duration": duration,
+        "rps": requests / duration,
+        "p50_ms": percentile(latencies, 50),
+        "p99_ms": percentile(latencies, 99),
+        "max_ms": latencies[-1],
+        "codes": dict(codes),
+        "garbage_per_request": float(garbage) / requests,
+        "retained_per_request": float(retained) / requests,
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--requests", type=int, default=10000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--latency", type=float, default=0, help="sec the app spends on a request")
+    parser.add_argument("--response-size", type=int, default=1024, help="bytes")
+    parser.add_argument("--chunks", type=int, default=1, help="chunks of a response")
+    parser.add_argument("--error-rate", type=float, default=0)
+    parser.add_argument("--queue-full-rate", type=float, default=0)
+    parser.add_argument("--verbose", action="store_true", help="show logs of the proxy")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.CRITICAL)
+    result = IOLoop.current().run_sync(lambda: run(args.requests, args.concurrency, args.latency,
+                                                   args.response_size, args.chunks,
+                                                   args.error_rate, args.queue_full_rate))
+    print(json.dumps(result, indent=2, sort_keys=True))
+
+
+if __name__ == "__main__":
+    main()
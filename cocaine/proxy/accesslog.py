@@ -0,0 +1,113 @@
+import mmap
+import os
+import struct
+
+import msgpack
+
+
+MAGIC = "CPXALOG1"
+# a record is a msgpack array of FIELDS prefixed with its length,
+# the timestamp of the end of a request and durations are in microseconds.
+# `plugin` is the name of the plugin processed the request, `trigger_headers` are
+# the headers plugins are dispatched by, `authorization` is whether the request had it
+FIELDS = ("timestamp", "traceid", "app", "event", "code",
+          "request_size", "response_size", "duration_us", "stages_us",
+          "method", "uri", "sticky", "plugin", "trigger_headers", "authorization")
+_LENGTH = struct.Struct(">I")
+
+DEFAULT_MAX_SIZE = 256 << 20  # bytes
+DEFAULT_BACKUP_COUNT = 5
+# bytes buffered before they are written to the file
+FLUSH_SIZE = 64 << 10
+
+
+class BinaryAccessLogError(Exception):
+    pass
+
+
+class BinaryAccessLog(object):
+    """Writes access log records into a file rotated by size
+
+    Records are buffered and written by FLUSH_SIZE chunks or on `flush`,
+    which is expected to be called periodically.
+    """
+
+    def __init__(self, path, max_size=DEFAULT_MAX_SIZE, backup_count=DEFAULT_BACKUP_COUNT):
+        self.path = path
+        self.max_size = max_size
+        self.backup_count = backup_count
+        self.buffer = []
+        self.buffered = 0
+        self.file = None
+        self.size = 0
+        self.open()
+
+    def open(self):
+        self.file = open(self.path, "ab")
+        self.size = self.file.tell()
+        if self.size == 0:
+            self.file.write(MAGIC)
+            self.size = len(MAGIC)
+
+    def write(self, record):
+        packed = msgpack.packb(record)
+        self.buffer.append(_LENGTH.pack(len(packed)))
+        self.buffer.append(packed)
+        self.buffered += _LENGTH.size + len(packed)
+        if self.buffered >= FLUSH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+
+        data = "".join(self.buffer)
+        self.buffer = []
+        self.buffered = 0
+        self.file.write(data)
+        self.file.flush()
+        self.size += len(data)
+        if self.size >= self.max_size:
+            self.rotate()
+
+    def rotate(self):
+        self.file.close()
+        for i in xrange(self.backup_count - 1, 0, -1):
+            source = "%s.%d" % (self.path, i)
+            if os.path.exists(source):
+                os.rename(source, "%s.%d" % (self.path, i + 1))
+        if self.backup_count > 0:
+            os.rename(self.path, self.path + ".1")
+        else:
+            os.remove(self.path)
+        self.open()
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+def read_records(path):
+    """Yields records of a binary access log as dicts of FIELDS
+
+    The file is memory-mapped, a truncated tail written concurrently is skipped.
+    """
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size <= len(MAGIC):
+            return
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        if mm[:len(MAGIC)] != MAGIC:
+            raise BinaryAccessLogError("%s is not a binary access log" % path)
+
+        offset = len(MAGIC)
+        end = len(mm)
+        while offset + _LENGTH.size <= end:
+            length, = _LENGTH.unpack_from(mm, offset)
+            offset += _LENGTH.size
+            if offset + length > end:
+                break
+            yield dict(zip(FIELDS, msgpack.unpackb(mm[offset:offset + length])))
+            offset += length
+    finally:
+        mm.close()
@@ -0,0 +1,86 @@
+import json
+
+try:
+    import simplejson
+except ImportError:  # pragma: no cover
+    simplejson = None
+
+try:
+    import ujson
+except ImportError:  # pragma: no cover
+    ujson = None
+
+
+AUTO = "auto"
+
+
+# ujson before 2.0 rounds floats unless asked otherwise, later ones print them as repr does
+_UJSON_LEGACY = ujson is not None and int(ujson.__version__.split(".")[0]) < 2
+
+
+def _ujson_dumps(obj):
+    if _UJSON_LEGACY:
+        # ujson rounds floats to 15 significant digits at most
+        return ujson.dumps(obj, escape_forward_slashes=False, double_precision=15)
+    return ujson.dumps(obj, escape_forward_slashes=False)
+
+
+def _ujson_loads(value):
+    if _UJSON_LEGACY:
+        return ujson.loads(value, precise_float=True)
+    return ujson.loads(value)
+
+
+def _simplejson_available():
+    # the pure python version is slower than the stdlib one
+    return simplejson is not None and simplejson.encoder.c_make_encoder is not None
+
+
+# codecs which may change the output, they are never picked automatically
+OPT_IN = ("ujson",)
+
+# the fastest first as measured by benchmarks/bench_codec.py,
+# the stdlib encoder outruns the simplejson one
+ENCODERS = [
+    ("ujson", lambda: ujson is not None, _ujson_dumps),
+    ("json", lambda: True, json.dumps),
+    ("simplejson", _simplejson_available, lambda obj: simplejson.dumps(obj)),
+]
+
+DECODERS = [
+    ("ujson", lambda: ujson is not None, _ujson_loads),
+    ("simplejson", _simplejson_available, lambda value: simplejson.loads(value)),
+    ("json", lambda: True, json.loads),
+]
+
+
+def available():
+    return [name for name, is_available, _ in DECODERS if is_available()]
+
+
+def _pick(candidates, name):
+    for candidate, is_available, func in candidates:
+        if name == AUTO and candidate in OPT_IN:
+            continue
+        if (name == AUTO or name == candidate) and is_available():
+            return candidate, func
+    raise ValueError("JSON codec %s is not available, choose one of: %s" % (name, ", ".join(available())))
+
+
+def select(name=AUTO):
+    """Switches dumps and loads to the codec
+
+    `auto` picks the fastest available one producing the same output as the stdlib json.
+    ujson before 2.0 prints floats with 15 significant digits instead of repr, so it's opt-in.
+    """
+    global encoder, decoder, dumps, loads
+    encoder, dumps = _pick(ENCODERS, name)
+    decoder, loads = _pick(DECODERS, name)
+
+
+def info():
+    return {"encoder": encoder, "decoder": decoder, "available": available()}
+
+
+encoder, dumps = _pick(ENCODERS, AUTO)
+decoder, loads = _pick(DECODERS, AUTO)
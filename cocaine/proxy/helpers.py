@@ -2,9 +2,12 @@ import collections
 import hashlib
 import json
 from operator import xor
+import os
 import re
 import struct
+import time
 
+import msgpack
 from tornado import httputil
 
 CRLF = '\r\n'
@@ -27,6 +30,20 @@ def load_srw_config(path):
     return config
 
 
+def load_snapshot(path):
+    with open(path, mode='rb') as f:
+        return msgpack.unpack(f)
+
+
+def dump_snapshot(path, snapshot):
+    # write to a temporary file and rename it
+    # to never leave a partially written snapshot
+    tmp_path = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp_path, mode='wb') as f:
+        msgpack.pack(snapshot, f)
+    os.rename(tmp_path, path)
+
+
 class Endpoints(object):
     unix_prefix = "unix://"
     tcp_prefix = "tcp://"
@@ -57,13 +74,50 @@ class Endpoints(object):
 def write_chunked(request, chunk):
     request.connection.write(SIZE_OF_CHUNK_FMT.format(len(chunk)))
     request.connection.write(chunk)
-    request.connection.write(CRLF)
+    # the future is resolved when the whole chunk is flushed to the socket
+    future = request.connection.write(CRLF)
+    request.response_size = getattr(request, "response_size", 0) + len(chunk)
+    return future
+
+
+def mark_stage(request, stage):
+    """Records the end of a processing stage, it's timed since the start of the request"""
+    stages = getattr(request, "stages", None)
+    if stages is not None:
+        stages.append((stage, request.request_time()))
+
+
+def stage_durations(request):
+    """Returns [(stage, seconds)] in the order of completion, durations of retried stages are summed"""
+    durations = collections.OrderedDict()
+    previous = 0.0
+    for stage, elapsed in getattr(request, "stages", ()):
+        durations[stage] = durations.get(stage, 0.0) + elapsed - previous
+        previous = elapsed
+    return durations.items()
+
+
+def format_stages(durations):
+    return " ".join("%s=%.2fms" % (stage, 1000.0 * duration) for stage, duration in durations)
+
+
+def format_server_timing(durations):
+    return ", ".join("%s;dur=%.2f" % (stage, 1000.0 * duration) for stage, duration in durations)
 
 
 def finalize_response(request, code, status):
     request.connection.finish()
-    request.logger.info("finish request: %d %s %.2fms",
-                        code, status, 1000.0 * request.request_time())
+    mark_stage(request, "finalize")
+    # used by the proxy to record latency histograms
+    request.response_code = code
+    request.response_time = request.request_time()
+    durations = stage_durations(request)
+    if durations:
+        request.logger.info("finish request: %d %s %.2fms stages: %s",
+                            code, status, 1000.0 * request.response_time, format_stages(durations))
+    else:
+        request.logger.info("finish request: %d %s %.2fms",
+                            code, status, 1000.0 * request.response_time)
 
 
 def finalize_chunked_response(request, code, status):
@@ -88,8 +142,14 @@ def fill_response_in(request, code, status, message, headers=None, chunked=False
     if getattr(request, "traceid", None) is not None:
         headers.add("X-Request-Id", request.traceid)
 
+    if getattr(request, "server_timing", False):
+        # only the stages passed before the headers are sent can be reported
+        headers.add("Server-Timing", format_server_timing(stage_durations(request)))
+
     if request.method == "HEAD":
         message = None
+    else:
+        request.response_size = getattr(request, "response_size", 0) + len(message)
 
     request.connection.write_headers(
         # start_line
@@ -141,6 +201,105 @@ def extract_app_and_event(request):
     return name, event
 
 
+class TokenBucket(object):
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def consume(self, now):
+        self.refill(now)
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class RateLimiter(object):
+    """Token buckets by a key, i.e. an application name
+
+    Names come from urls, so there are at most max_keys buckets: the idle buckets are dropped
+    to make room, or the least recently used one if it's not idle.
+    """
+
+    def __init__(self, rate, burst=None, max_keys=4096):
+        self.rate = rate
+        self.burst = burst or max(rate, 1)
+        self.max_keys = max_keys
+        # the most recently used are kept at the end
+        self.buckets = collections.OrderedDict()
+
+    def allow(self, key, now=None):
+        if self.rate <= 0:
+            return True
+
+        now = time.time() if now is None else now
+        bucket = self.buckets.pop(key, None)
+        if bucket is None:
+            if len(self.buckets) >= self.max_keys:
+                self.drop_idle(now)
+            bucket = TokenBucket(self.rate, self.burst, now)
+        self.buckets[key] = bucket
+        return bucket.consume(now)
+
+    def drop_idle(self, now):
+        """Drops idle buckets from the least recently used end, or the least recently used one"""
+        dropped = 0
+        while self.buckets:
+            bucket = next(self.buckets.itervalues())
+            bucket.refill(now)
+            if bucket.tokens < bucket.burst:
+                break
+            self.buckets.popitem(last=False)
+            dropped += 1
+        if not dropped and self.buckets:
+            self.buckets.popitem(last=False)
+
+
+class TTLCache(object):
+    """LRU cache of a bounded size, entries expire after their TTL"""
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None, now=None):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return default
+
+        value, expires_at = entry
+        if expires_at <= (time.time() if now is None else now):
+            return default
+        # the most recently used are kept at the end
+        self.entries[key] = entry
+        return value
+
+    def put(self, key, value, ttl=None, now=None):
+        if self.size <= 0:
+            return
+
+        now = time.time() if now is None else now
+        self.entries.pop(key, None)
+        self.entries[key] = (value, now + (self.ttl if ttl is None else ttl))
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def pop(self, key):
+        self.entries.pop(key, None)
+
+
 def parse_locators_endpoints(endpoint):
     host, _, port = endpoint.rpartition(":")
     if host and port:
@@ -1,29 +1,143 @@
-import json
+import functools
 
 from tornado import gen
 from tornado import httputil
+from tornado import locks
+from tornado.iostream import StreamClosedError
 
 from cocaine.exceptions import ChokeEvent
 from cocaine.services import EmptyResponse
 
+from cocaine.proxy import codec
 from cocaine.proxy.helpers import fill_response_in
+from cocaine.proxy.helpers import finalize_chunked_response
+from cocaine.proxy.helpers import write_chunked
 from cocaine.proxy.plugin import IPlugin
 
 
 REQUEST_FIELDS = ('jsonrpc', 'method', 'params', 'id')
+# `id` is omitted by notifications
+BATCH_ENTRY_FIELDS = ('jsonrpc', 'method', 'params')
+
+DEFAULT_BATCH_CONCURRENCY = 8
+DEFAULT_MAX_BATCH_SIZE = 256
+
+# results of the streaming protocol are streamed to the clients accepting it
+NDJSON = 'application/x-ndjson'
+
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INTERNAL_ERROR = -32603
+SERVER_ERROR = -32000
+
+
+class JSONRPCError(Exception):
+    def __init__(self, code, message, status=400):
+        super(JSONRPCError, self).__init__(message)
+        self.code = code
+        self.message = message
+        self.status = status
+
+
+def split_method(method):
+    """Splits `service.method` into the names, raises JSONRPCError if it's malformed"""
+    if not isinstance(method, basestring):
+        raise JSONRPCError(INVALID_REQUEST, 'The JSON sent is not a valid Request object.')
+    name, _, method = method.partition('.')
+    if not name or not method:
+        raise JSONRPCError(METHOD_NOT_FOUND, 'Method not found.')
+    return name, method
+
+
+class NDJSONStream(object):
+    """Replies with chunks of a streaming result as they arrive, one JSON element per line
+
+    The last element is a trailer with the status of the stream.
+    """
+
+    def __init__(self, request, request_id):
+        self.request = request
+        self.id = request_id
+        self.started = False
+        self.closed = False
+        self.chunks = 0
+
+    def start(self):
+        headers = httputil.HTTPHeaders({
+            'Content-Type': NDJSON,
+            'Transfer-Encoding': 'chunked',
+        })
+        fill_response_in(self.request, 200, 'OK', '', headers, chunked=True)
+        self.started = True
+
+    def write(self, chunk):
+        """Returns a future resolved once the element is flushed to the client"""
+        self.chunks += 1
+        return self._write({'jsonrpc': '2.0', 'id': self.id, 'chunk': chunk})
+
+    def finish(self, error=None):
+        if self.closed:
+            # 200 has been sent, the request is still counted in the metrics and the access log
+            self.request.response_code = 200
+            self.request.response_time = self.request.request_time()
+            return
+
+        trailer = {'jsonrpc': '2.0', 'id': self.id, 'status': 'ok', 'chunks': self.chunks}
+        if error is not None:
+            trailer.update(status='error', error=error)
+        self._write(trailer)
+        finalize_chunked_response(self.request, 200, 'OK')
+
+    def _write(self, element):
+        return write_chunked(self.request, codec.dumps(element) + '\n')
+
+
+class APITables(object):
+    """Compiled {method: handler} tables of services by name
+
+    The name is the only key: `version` of a service is the requested one, not the resolved.
+    A table is recompiled when a reconnected service gets a different API.
+    Instances with an equal API are switched to the cached one, so the check is an identity test.
+    """
+
+    def __init__(self, compile_table):
+        self.compile_table = compile_table
+        self.tables = {}
+
+    def get(self, service):
+        cached = self.tables.get(service.name)
+        if cached is not None:
+            api, table = cached
+            if api is service.api:
+                return table
+            if api == service.api:
+                service.api = api
+                return table
+
+        table = self.compile_table(service.api)
+        self.tables[service.name] = (service.api, table)
+        return table
 
 
 class JSONRPC(IPlugin):
+    trigger_headers = ("X-Cocaine-JSON-RPC",)
+
     PRIMITIVE = {0: ['value', {}], 1: ['error', {}]}
     STREAMING = {0: ['write', None], 1: ['error', {}], 2: ['close', {}]}
 
-    def __init__(self, proxy, _):
+    def __init__(self, proxy, config):
         super(JSONRPC, self).__init__(proxy)
+        # entries of a batch dispatched at the same time
+        self.batch_concurrency = config.get("batch_concurrency", DEFAULT_BATCH_CONCURRENCY)
+        # all the replies of a batch are kept in memory until it's done
+        self.max_batch_size = config.get("max_batch_size", DEFAULT_MAX_BATCH_SIZE)
         self._protocols = [
             (lambda tx, rx: rx == {}, self._handle_mute),
             (lambda tx, rx: rx == self.PRIMITIVE, self._handle_primitive),
             (lambda tx, rx: tx == rx == self.STREAMING, self._handle_streaming),
         ]
+        self.api_tables = APITables(self.compile_api)
 
     @staticmethod
     def name():
@@ -35,48 +149,36 @@ class JSONRPC(IPlugin):
     @gen.coroutine
     def process(self, request):
         try:
-            payload = json.loads(request.body)
+            payload = codec.loads(request.body)
         except ValueError:
-            JSONRPC._send_400_error(request, -32700, 'Parse error: Invalid JSON was received by the server.')
+            JSONRPC._send_400_error(request, PARSE_ERROR, 'Parse error: Invalid JSON was received by the server.')
             return
 
-        if not all(k in payload for k in REQUEST_FIELDS):
-            JSONRPC._send_400_error(request, -32600, 'The JSON sent is not a valid Request object.')
+        if isinstance(payload, list):
+            yield self.process_batch(request, payload)
             return
 
-        name, method = payload['method'].split('.', 2)
-        args = payload['params']
-        chunks = payload.get('chunks', [])
-        headers = {}
-        if 'authorization' in request.headers:
-            headers['authorization'] = request.headers['authorization']
-
-        try:
-            service = yield self.proxy.get_service(name, request)
-            if service is None:
-                JSONRPC._send_500_error(request, payload, 'Service not found.')
-                return
-        except Exception as err:
-            JSONRPC._send_500_error(request, payload, err)
+        if not isinstance(payload, dict) or not all(k in payload for k in REQUEST_FIELDS):
+            JSONRPC._send_400_error(request, INVALID_REQUEST, 'The JSON sent is not a valid Request object.')
             return
 
-        api = dict((data[0], data) for data in service.api.itervalues())
-        if method not in api:
-            JSONRPC._send_400_error(request, -32601, 'Method not found.')
-            return
-
-        name, tx_tree, rx_tree = api[method]
+        streamer = None
+        if request.version != 'HTTP/1.0' and NDJSON in request.headers.get('Accept', ''):
+            streamer = NDJSONStream(request, payload['id'])
 
         try:
-            for match, handle in self._protocols:
-                if match(tx_tree, rx_tree):
-                    result = yield handle(service, method, args, chunks, **headers)
-                    break
+            result = yield self.call(request, payload, streamer)
+        except JSONRPCError as err:
+            if streamer is not None and streamer.started:
+                streamer.finish(err.message)
+            elif err.status == 400:
+                JSONRPC._send_400_error(request, err.code, err.message)
             else:
-                JSONRPC._send_400_error(request, -32000, 'Protocol type is not supported.')
-                return
-        except Exception as err:
-            JSONRPC._send_500_error(request, payload, err)
+                JSONRPC._send_500_error(request, payload, err.message)
+            return
+
+        if streamer is not None and streamer.started:
+            streamer.finish()
             return
 
         headers = httputil.HTTPHeaders({
@@ -87,7 +189,117 @@ class JSONRPC(IPlugin):
             'result': result,
             'id': payload['id'],
         }
-        fill_response_in(request, 200, 'OK', json.dumps(body), headers)
+        fill_response_in(request, 200, 'OK', codec.dumps(body), headers)
+
+    @gen.coroutine
+    def process_batch(self, request, batch):
+        """Dispatches entries of the batch concurrently, replies once all of them with `id` are done
+
+        Notifications are not waited for and have no replies.
+        """
+        if not batch:
+            JSONRPC._send_400_error(request, INVALID_REQUEST, 'The JSON sent is not a valid Request object.')
+            return
+
+        if len(batch) > self.max_batch_size:
+            JSONRPC._send_400_error(request, INVALID_REQUEST,
+                                    'The batch exceeds %d entries.' % self.max_batch_size)
+            return
+
+        request.logger.info("JSON-RPC batch of %d entries", len(batch))
+        slots = locks.Semaphore(self.batch_concurrency)
+        replies = []
+        for entry in batch:
+            if isinstance(entry, dict) and 'id' not in entry:
+                self.proxy.io_loop.add_future(self.call_entry(request, entry, slots),
+                                              lambda future: future.result())
+            else:
+                replies.append(self.call_entry(request, entry, slots))
+
+        if not replies:
+            fill_response_in(request, 204, 'No Content', '')
+            return
+
+        replies = yield replies
+        headers = httputil.HTTPHeaders({
+            'Content-Type': 'application/json-rpc'
+        })
+        fill_response_in(request, 200, 'OK', codec.dumps(replies), headers)
+
+    @gen.coroutine
+    def call_entry(self, request, entry, slots):
+        """Returns a response object for the batch entry, errors are replied as JSON-RPC error objects"""
+        if not isinstance(entry, dict) or not all(k in entry for k in BATCH_ENTRY_FIELDS):
+            raise gen.Return(self._error_object(None, INVALID_REQUEST, 'The JSON sent is not a valid Request object.'))
+
+        entry_id = entry.get('id')
+        try:
+            split_method(entry['method'])
+        except JSONRPCError as err:
+            raise gen.Return(self._error_object(entry_id, err.code, err.message))
+
+        with (yield slots.acquire()):
+            try:
+                result = yield self.call(request, entry)
+            except JSONRPCError as err:
+                reply = self._error_object(entry_id, err.code, err.message)
+            except Exception as err:
+                request.logger.error("JSON-RPC batch entry %s failed: %s", entry['method'], err)
+                reply = self._error_object(entry_id, INTERNAL_ERROR, str(err))
+            else:
+                reply = {'jsonrpc': '2.0', 'result': result, 'id': entry_id}
+
+        if entry_id is None and 'error' in reply:
+            request.logger.error("JSON-RPC notification %s failed: %s", entry['method'], reply['error']['message'])
+        raise gen.Return(reply)
+
+    def compile_api(self, api):
+        """Maps method names to their protocol handlers, None if the protocol is not supported"""
+        table = {}
+        for method, tx_tree, rx_tree in api.itervalues():
+            for match, handle in self._protocols:
+                if match(tx_tree, rx_tree):
+                    break
+            else:
+                handle = None
+            table[method] = handle
+        return table
+
+    @gen.coroutine
+    def call(self, request, payload, streamer=None):
+        """Calls the service method of the request object, raises JSONRPCError on failures
+
+        A result of the streaming protocol is written into `streamer` if it's passed.
+        """
+        name, method = split_method(payload['method'])
+        args = payload['params']
+        chunks = payload.get('chunks', [])
+        headers = {}
+        if 'authorization' in request.headers:
+            headers['authorization'] = request.headers['authorization']
+
+        try:
+            service = yield self.proxy.get_service(name, request)
+        except Exception as err:
+            raise JSONRPCError(SERVER_ERROR, str(err), 500)
+        if service is None:
+            raise JSONRPCError(SERVER_ERROR, 'Service not found.', 500)
+
+        try:
+            handle = self.api_tables.get(service)[method]
+        except KeyError:
+            raise JSONRPCError(METHOD_NOT_FOUND, 'Method not found.')
+
+        if handle is None:
+            raise JSONRPCError(SERVER_ERROR, 'Protocol type is not supported.')
+        if streamer is not None and handle == self._handle_streaming:
+            handle = functools.partial(handle, streamer=streamer)
+
+        try:
+            result = yield handle(service, method, args, chunks, **headers)
+        except Exception as err:
+            raise JSONRPCError(SERVER_ERROR, str(err), 500)
+        raise gen.Return(result)
 
     @gen.coroutine
     def _handle_mute(self, service, method, args, _, **headers):
@@ -101,32 +313,48 @@ class JSONRPC(IPlugin):
         raise gen.Return(result)
 
     @gen.coroutine
-    def _handle_streaming(self, service, method, args, chunks, **headers):
+    def _handle_streaming(self, service, method, args, chunks, streamer=None, **headers):
         channel = yield getattr(service, method)(*args, **headers)
         for name, data in chunks:
             getattr(channel.tx, name)(*data)
 
-        # TODO: Chunked.
+        if streamer is not None:
+            streamer.start()
+
         result = []
         try:
             while True:
                 chunk = yield channel.rx.get()
 
-                if not isinstance(chunk, EmptyResponse):
+                if isinstance(chunk, EmptyResponse):
+                    continue
+                if streamer is None:
                     result.append(chunk)
+                else:
+                    # the next chunk is not read until the client takes this one
+                    yield streamer.write(chunk)
         except ChokeEvent:
             pass
+        except StreamClosedError:
+            if streamer is None:
+                raise
+            streamer.closed = True
+            streamer.request.logger.info("client has closed the connection after %d chunks", streamer.chunks)
         finally:
             if hasattr(channel.tx, 'close'):
                 channel.tx.close()
 
         raise gen.Return(result)
 
+    @staticmethod
+    def _error_object(entry_id, code, message):
+        return {'jsonrpc': '2.0', 'error': {'code': code, 'message': message}, 'id': entry_id}
+
     @staticmethod
     def _send_400_error(request, code, message):
         headers = httputil.HTTPHeaders({'Content-Type': 'application/json-rpc'})
         body = {'code': code, 'message': message}
-        fill_response_in(request, 400, 'Bad JSON-RPC request', json.dumps(body), headers)
+        fill_response_in(request, 400, 'Bad JSON-RPC request', codec.dumps(body), headers)
 
     @staticmethod
     def _send_500_error(request, payload, err):
@@ -136,4 +364,4 @@ class JSONRPC(IPlugin):
             'error': str(err),
             'id': payload['id'],
         }
-        fill_response_in(request, 500, 'Internal Server Error', json.dumps(body), headers)
+        fill_response_in(request, 500, 'Internal Server Error', codec.dumps(body), headers)
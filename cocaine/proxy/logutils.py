@@ -1,4 +1,10 @@
+import errno
 import logging
+import logging.handlers
+import numbers
+import os
+import Queue
+import threading
 
 
 class ContextAdapter(logging.LoggerAdapter):
@@ -22,3 +28,163 @@ class NullLogger(object):
 
 
 NULLLOGGER = NullLogger()
+
+
+DEFAULT_LOG_QUEUE_SIZE = 10000
+LOG_BATCH_SIZE = 512
+# sec to wait for the queue to be written out on close
+LOG_CLOSE_TIMEOUT = 1
+
+_STOP = object()
+
+# arguments of these types can't be changed by the event loop after a record is emitted
+_IMMUTABLE_ARGS = (basestring, numbers.Number, type(None))
+
+
+def _reopen_if_moved(handler):
+    # the same check as WatchedFileHandler.emit does for every record
+    try:
+        stat = os.stat(handler.baseFilename)
+    except OSError as err:
+        if err.errno != errno.ENOENT:
+            raise
+        stat = None
+
+    if stat is None or stat.st_dev != handler.dev or stat.st_ino != handler.ino:
+        if handler.stream is not None:
+            handler.stream.flush()
+            handler.stream.close()
+        handler.stream = handler._open()
+        stat = os.fstat(handler.stream.fileno())
+        handler.dev, handler.ino = stat.st_dev, stat.st_ino
+
+
+def write_batch(handler, records):
+    """Formats records and writes them to the stream of the handler at once"""
+    lines = []
+    for record in records:
+        try:
+            line = handler.format(record)
+            if isinstance(line, unicode):
+                line = line.encode("utf-8")
+            lines.append(line + "\n")
+        except Exception:
+            handler.handleError(record)
+
+    handler.acquire()
+    try:
+        if isinstance(handler, logging.handlers.WatchedFileHandler):
+            _reopen_if_moved(handler)
+        elif getattr(handler, "stream", None) is None:
+            handler.stream = handler._open()
+        handler.stream.write("".join(lines))
+        handler.stream.flush()
+    except Exception:
+        handler.handleError(records[-1])
+    finally:
+        handler.release()
+
+
+def freeze_record(record):
+    """Returns a copy of the record which is safe to be rendered in another thread
+
+    Mutable arguments are rendered with %s at once, the rest are left as is.
+    """
+    frozen = logging.makeLogRecord(record.__dict__)
+    if isinstance(frozen.args, tuple):
+        frozen.args = tuple(arg if isinstance(arg, _IMMUTABLE_ARGS) else "%s" % (arg,) for arg in frozen.args)
+    elif frozen.args:
+        # a mapping of named arguments
+        frozen.msg, frozen.args = frozen.getMessage(), None
+    return frozen
+
+
+def render_record(record):
+    """Returns a copy of the record with the message interpolated and the traceback appended"""
+    message = record.getMessage()
+    if record.exc_info:
+        message = "%s\n%s" % (message, logging.Formatter().formatException(record.exc_info))
+    # the record itself may be being formatted by other handlers
+    rendered = logging.makeLogRecord(record.__dict__)
+    rendered.msg, rendered.args, rendered.exc_info = message, None, None
+    return rendered
+
+
+class AsyncHandler(logging.Handler):
+    """Moves formatting and writing of log records off the event loop thread
+
+    Only mutable arguments of records are rendered when they are emitted, as the event
+    loop may change them later on. Records are put into a bounded queue, a background
+    thread interpolates the messages, appends the tracebacks, formats the records and
+    writes them in batches with the wrapped handler. Records are dropped and counted
+    when the queue is full. Handlers which must be called in the event loop, like CocaineHandler,
+    get the records via `io_loop.add_callback`.
+    It starts a thread, so it must be created after fork.
+    """
+
+    def __init__(self, target, capacity=DEFAULT_LOG_QUEUE_SIZE, io_loop=None):
+        logging.Handler.__init__(self)
+        self.target = target
+        self.io_loop = io_loop
+        self.setLevel(target.level)
+        self.queue = Queue.Queue(capacity)
+        self.dropped = 0
+        self._thread = threading.Thread(target=self._run, name="async-log")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(freeze_record(record))
+        except Queue.Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            try:
+                while len(batch) < LOG_BATCH_SIZE:
+                    batch.append(self.queue.get_nowait())
+            except Queue.Empty:
+                pass
+
+            stop = batch[-1] is _STOP
+            if stop:
+                batch.pop()
+            batch = self._render(batch)
+            if batch:
+                self._write(batch)
+            if stop:
+                return
+
+    def _render(self, records):
+        rendered = []
+        for record in records:
+            try:
+                rendered.append(render_record(record))
+            except Exception:
+                self.handleError(record)
+        return rendered
+
+    def _write(self, records):
+        if self.io_loop is not None:
+            self.io_loop.add_callback(self._handle_all, records)
+        elif isinstance(self.target, logging.StreamHandler):
+            write_batch(self.target, records)
+        else:
+            self._handle_all(records)
+
+    def _handle_all(self, records):
+        for record in records:
+            self.target.handle(record)
+
+    def close(self):
+        try:
+            self.queue.put(_STOP, timeout=LOG_CLOSE_TIMEOUT)
+        except Queue.Full:
+            pass
+        self._thread.join(LOG_CLOSE_TIMEOUT)
+        self.target.close()
+        logging.Handler.close(self)
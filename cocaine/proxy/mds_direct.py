@@ -3,35 +3,55 @@ try:
 except ImportError:
     import http.client as httplib  # pylint: disable=F0401
 
+import functools
+import hashlib
+import time
 from datetime import timedelta
 from random import shuffle
 
 import msgpack
 
-import json
-
 from tornado import gen
 from tornado import httputil
-from tornado.httpclient import AsyncHTTPClient
+from tornado.ioloop import PeriodicCallback
+from tornado.concurrent import Future
 from tornado.httpclient import HTTPError
 from tornado.httpclient import HTTPRequest
 
+from cocaine.exceptions import ServiceConnectionError
 from cocaine.exceptions import ServiceError
 
 from cocaine.services import Service, Locator
 
+from cocaine.proxy import codec
 from cocaine.proxy.helpers import extract_app_and_event
 from cocaine.proxy.helpers import fill_response_in
 from cocaine.proxy.helpers import pack_httprequest
+from cocaine.proxy.helpers import TTLCache
 
 from cocaine.proxy.plugin import IPlugin
 from cocaine.proxy.plugin import PluginApplicationError
 from cocaine.proxy.plugin import PluginConfigurationError
+from cocaine.proxy.plugin import PluginHTTPClient
 from cocaine.proxy.plugin import PluginNoSuchApplication
 
 from cocaine.proxy.proxy import RESOLVE_TIMEOUT, LOCATORCATEGORY, ESERVICENOTAVAILABLE
 
 
+DEFAULT_SERVICE_CONNECT_STAGGER_MS = 250
+
+# sec a pooled connection to an app on a storage host is kept unused
+DEFAULT_SERVICE_POOL_IDLE_TIMEOUT = 60
+
+DEFAULT_DIST_INFO_CACHE_SIZE = 10000
+DEFAULT_DIST_INFO_CACHE_TTL = 30  # sec
+# sec a missing key is not asked for again
+DEFAULT_DIST_INFO_NEGATIVE_TTL = 5
+
+# cached 404 reply of dist-info
+NOT_FOUND = object()
+
+
 def is_mds_stid(stid):
     parts = stid.split(".", 2)
     return len(parts) == 3 and parts[2].startswith('E') and ':' in parts[2]
@@ -42,7 +62,52 @@ def is_mds_key(key):
     return len(parts) == 2 and parts[0].isdigit()
 
 
+class ServicePool(object):
+    """Connected app services shared by requests, keyed by (endpoint, app)"""
+
+    def __init__(self, idle_timeout):
+        self.idle_timeout = idle_timeout
+        # key: [service, last used]
+        self.services = {}
+
+    def get(self, key, now=None):
+        """Returns the connected service or None, a disconnected one is evicted"""
+        entry = self.services.get(key)
+        if entry is None:
+            return None
+        if not entry[0]._connected:
+            self.evict(key)
+            return None
+        entry[1] = time.time() if now is None else now
+        return entry[0]
+
+    def put(self, key, service, now=None):
+        previous = self.services.get(key)
+        if previous is not None and previous[0] is not service:
+            self.evict(key)
+        self.services[key] = [service, time.time() if now is None else now]
+
+    def evict(self, key):
+        service = self.services.pop(key)[0]
+        service.disconnect()
+        service.locator.disconnect()
+
+    def evict_idle(self, now=None):
+        """Evicts the services unused for idle_timeout or disconnected, returns their count"""
+        deadline = (time.time() if now is None else now) - self.idle_timeout
+        stale = [key for key, (service, used) in self.services.iteritems()
+                 if used < deadline or not service._connected]
+        for key in stale:
+            self.evict(key)
+        return len(stale)
+
+    def __len__(self):
+        return len(self.services)
+
+
 class MDSDirect(IPlugin):
+    trigger_headers = ("X-Srw-Key", "X-Srw-Key-Type", "X-Srw-Namespace")
+
     def __init__(self, proxy, config):
         super(MDSDirect, self).__init__(proxy)
         try:
@@ -51,10 +116,30 @@ class MDSDirect(IPlugin):
             self.locator_port = config["locator_port"]
             self.filter_mds_stid = config.get("filter_stid", True)
             self.service_connect_timeout = timedelta(milliseconds=config.get("service_connect_timeout_ms", 1500))
-            self.srw_httpclient = AsyncHTTPClient()
+            # sec to wait for a dist-info host before racing the next one
+            self.service_connect_stagger = config.get("service_connect_stagger_ms",
+                                                      DEFAULT_SERVICE_CONNECT_STAGGER_MS) / 1000.0
+            self.srw_httpclient = PluginHTTPClient(self.name(), proxy, config.get("http_client"))
+            # decoded endpoints by (key type, namespace, key, credentials digest)
+            self.dist_info_cache = TTLCache(config.get("dist_info_cache_size", DEFAULT_DIST_INFO_CACHE_SIZE),
+                                            config.get("dist_info_cache_ttl", DEFAULT_DIST_INFO_CACHE_TTL))
+            self.dist_info_negative_ttl = config.get("dist_info_negative_ttl", DEFAULT_DIST_INFO_NEGATIVE_TTL)
+            # the fetches in progress shared by concurrent requests of the same key and credentials
+            self.dist_info_fetches = {}
+            # the apps on storage hosts are connected once and reused
+            self.service_pool = ServicePool(config.get("service_pool_idle_timeout",
+                                                       DEFAULT_SERVICE_POOL_IDLE_TIMEOUT))
+            self.service_connects = {}
         except KeyError as err:
             raise PluginConfigurationError(self.name(), "option required %s" % err)
 
+        if self.service_pool.idle_timeout < 0:
+            raise PluginConfigurationError(self.name(), "service_pool_idle_timeout must not be negative")
+        # 0 keeps the pooled services until they are disconnected
+        if self.service_pool.idle_timeout > 0:
+            PeriodicCallback(self.evict_idle_services, self.service_pool.idle_timeout * 1000 / 2,
+                             io_loop=self.proxy.io_loop).start()
+
     @staticmethod
     def name():
         return "mds-direct"
@@ -65,55 +150,154 @@ class MDSDirect(IPlugin):
             return not self.filter_mds_stid or is_mds_stid(key) or is_mds_key(key)
         return False
 
-    @gen.coroutine
-    def reelect_app(self, request, app):
-        """tries to connect to the same app on differnet host from dist-info"""
-
-        # disconnect app explicitly to break possibly existing connection
-        app.disconnect()
-        endpoints_size = len(app.locator.endpoints)
-
-        # try x times, where x is the number of different endpoints in app locator.
-        for _ in xrange(0, endpoints_size + 1):
-            # last chance to take app from common pool
-            if len(app.locator.endpoints) == 0:
-                request.logger.info(
-                    "giving up on connecting to dist-info hosts, falling back to common pool processing")
-                app = yield self.proxy.reelect_app(request, app)
-                raise gen.Return(app)
+    def evict_idle_services(self):
+        evicted = self.service_pool.evict_idle()
+        if evicted:
+            self.proxy.logger.info("evicted %d idle connections to storage hosts, %d left",
+                                   evicted, len(self.service_pool))
+
+    def connect_endpoint(self, request, name, endpoint):
+        """returns the pooled app on the endpoint or connects to it"""
+        key = (tuple(endpoint), name)
+        metrics = self.proxy.metrics
+        app = self.service_pool.get(key)
+        if app is not None:
+            metrics.incr("cocaine_proxy_mds_service_pool_total", ("hit",))
+            request.logger.debug("reusing connection to application %s via %s", name, endpoint)
+            future = Future()
+            future.set_result(app)
+            return future
+
+        connect = self.service_connects.get(key)
+        if connect is None:
+            metrics.incr("cocaine_proxy_mds_service_pool_total", ("miss",))
+            connect = self.connect_service(request, name, endpoint, key)
+            if not connect.done():
+                self.service_connects[key] = connect
+        else:
+            metrics.incr("cocaine_proxy_mds_service_pool_total", ("coalesced",))
+        return connect
 
+    @gen.coroutine
+    def connect_service(self, request, name, endpoint, key):
+        """connects to the app via the locator on the endpoint only and puts it to the pool"""
+        # a locator per host, as locking on connect with timeout would stall the other hosts
+        locator = Locator(endpoints=[endpoint])
+        app = Service(name, locator=locator, timeout=RESOLVE_TIMEOUT)
+        try:
+            request.logger.info("connecting to locator %s", endpoint)
+            # first try to connect to locator only on remote host with timeout
+            yield gen.with_timeout(self.service_connect_timeout, locator.connect())
+            request.logger.debug("connected to locator %s for %s", endpoint, name)
+
+            # try to resolve and connect to application itself
+            yield gen.with_timeout(self.service_connect_timeout, app.connect())
+            request.logger.debug("connected to application %s via %s", name, app.endpoints)
+        except Exception:
+            app.disconnect()
+            raise
+        finally:
+            # the app is resolved, the pooled entry does not need the locator connection
+            locator.disconnect()
+            self.service_connects.pop(key, None)
+        self.service_pool.put(key, app)
+        raise gen.Return(app)
+
+    def race_connect(self, request, name, endpoints):
+        """Connects to the app on the endpoints in a staggered race
+
+        The next endpoint is tried if the previous one has not connected within
+        `service_connect_stagger` or has failed. The future resolves to
+        (app, endpoint, failed endpoints) of the first connected one, the rest
+        stay in the pool. It resolves to None if no endpoint is available, or
+        fails with the first unexpected error of them.
+        """
+        race = Future()
+        pending = list(endpoints)
+        failed = []
+        errors = []
+        # [running attempts, stagger timer]
+        state = [0, None]
+
+        def on_connected(endpoint, attempt):
+            state[0] -= 1
             try:
-                # always create new locator to prevent locking as we do connect with timeout
-                # however lock can be still held during TCP timeout
-                locator = Locator(endpoints=app.locator.endpoints)
-                request.logger.info("connecting to locator %s", locator.endpoints[0])
-
-                # first try to connect to locator only on remote host with timeout
-                yield gen.with_timeout(self.service_connect_timeout, locator.connect())
-                request.logger.debug("connected to locator %s for %s", locator.endpoints[0], app.name)
-                app = Service(app.name, locator=locator, timeout=RESOLVE_TIMEOUT)
-
-                # try to resolve and connect to application itself
-                yield gen.with_timeout(self.service_connect_timeout, app.connect())
-                request.logger.debug("connected to application %s via %s", app.name, app.endpoints)
+                app = attempt.result()
             except gen.TimeoutError:
-                # on timeout try next endpoint first
-                request.logger.warning("timed out while connecting to application")
-                continue
+                request.logger.warning("timed out while connecting to application via %s", endpoint)
+            except ServiceConnectionError as err:
+                request.logger.warning("unable to connect to %s - %s", endpoint, err)
             except ServiceError as err:
-                request.logger.warning("got error while resolving app - %s", err)
-                if err.category in LOCATORCATEGORY and err.code == ESERVICENOTAVAILABLE:
-                    # if the application is down - also try next endpoint
-                    continue
+                request.logger.warning("got error while resolving app via %s - %s", endpoint, err)
+                # if the application is down - also try next endpoint
+                if not (err.category in LOCATORCATEGORY and err.code == ESERVICENOTAVAILABLE):
+                    errors.append(err)
+            except Exception as err:
+                request.logger.warning("failed to connect to application via %s - %s", endpoint, err)
+                errors.append(err)
+            else:
+                if not race.done():
+                    cancel_stagger()
+                    race.set_result((app, endpoint, failed))
+                return
+
+            failed.append(endpoint)
+            if race.done():
+                return
+            if pending:
+                # do not wait for the stagger delay, the endpoint has already failed
+                launch()
+            elif state[0] == 0:
+                if errors:
+                    race.set_exception(errors[0])
                 else:
-                    raise err
-            finally:
-                # drop first endpoint to start next connection from different endpoint
-                # we do this, as default logic of connection attempts in locator do not fit here
-                app.locator.endpoints = app.locator.endpoints[1:]
-            # return connected app
+                    race.set_result(None)
+
+        def cancel_stagger():
+            if state[1] is not None:
+                self.proxy.io_loop.remove_timeout(state[1])
+                state[1] = None
+
+        def launch():
+            cancel_stagger()
+            if race.done() or not pending:
+                return
+            endpoint = pending.pop(0)
+            state[0] += 1
+            self.proxy.io_loop.add_future(self.connect_endpoint(request, name, endpoint),
+                                          functools.partial(on_connected, endpoint))
+            if pending:
+                state[1] = self.proxy.io_loop.call_later(self.service_connect_stagger, launch)
+
+        launch()
+        if not race.done() and state[0] == 0:
+            race.set_result(None)
+        return race
+
+    @gen.coroutine
+    def reelect_app(self, request, app, name, endpoints):
+        """tries to connect to the same app on differnet host from dist-info
+
+        `endpoints` are the hosts of the request left to try, the list is updated.
+        `app` is None on the first election.
+        """
+        # the apps are shared by requests, so a busy one is kept connected
+        winner = yield self.race_connect(request, name, endpoints)
+        if winner is None:
+            # last chance to take app from common pool
+            request.logger.info(
+                "giving up on connecting to dist-info hosts, falling back to common pool processing")
+            if app is None:
+                app = yield self.proxy.get_service(name, request)
+            else:
+                app = yield self.proxy.reelect_app(request, app)
             raise gen.Return(app)
-        raise PluginApplicationError(42, 42, "could not connect to application")
+
+        app, endpoint, failed = winner
+        # the next reelection starts from the endpoints not tried yet or still racing,
+        # as default logic of connection attempts in locator do not fit here
+        endpoints[:] = [e for e in endpoints if e != endpoint and e not in failed]
+        raise gen.Return(app)
 
     def is_stid_request(self, request):
         return request.headers["X-Srw-Key-Type"].upper() == "STID"
@@ -153,36 +337,78 @@ class MDSDirect(IPlugin):
                 allow_ipv6=True,
                 request_timeout=timeout)
 
-        endpoints = yield self.fetch_mds_endpoints(request, srw_request)
-        locator = Locator(endpoints=endpoints)
-        app = Service(name, locator=locator, timeout=RESOLVE_TIMEOUT)
+        cache_key = (self.is_stid_request(request), request.headers["X-Srw-Namespace"], key)
+        endpoints = yield self.fetch_mds_endpoints(request, srw_request, cache_key)
+        if endpoints is None:
+            # the reply has been sent already
+            return
+
         request.logger.info("connecting to app %s", name)
-        app = yield self.reelect_app(request, app)
+        app = yield self.reelect_app(request, None, name, endpoints)
+
+        def reelect_app(request, app):
+            return self.reelect_app(request, app, name, endpoints)
+
         # TODO: attempts should be configurable
-        yield self.proxy.process(request, name, app, event, pack_httprequest(request), self.reelect_app, 4, timeout)
+        yield self.proxy.process(request, name, app, event, pack_httprequest(request), reelect_app, 4, timeout)
 
     def decode_mulca_dist_info(self, body):
         lines = body.split("\n")
-        endpoints = [(line.split()[0], self.locator_port) for line in lines if line]
-        shuffle(endpoints)
-        return endpoints
+        return [(line.split()[0], self.locator_port) for line in lines if line]
 
     def decode_mds_dist_info(self, body):
-        obj = json.loads(body)
-        endpoints = [(x['host'], self.locator_port) for x in obj['primary']]
-        shuffle(endpoints)
-        return endpoints
+        obj = codec.loads(body)
+        return [(x['host'], self.locator_port) for x in obj['primary']]
 
     @gen.coroutine
-    def fetch_mds_endpoints(self, request, srw_request):
+    def fetch_dist_info(self, srw_request, cache_key):
+        stid = cache_key[0]
         try:
             # NOTE: we can do it in a streaming way
             resp = yield self.srw_httpclient.fetch(srw_request)
             body = resp.buffer.read(None)
-            if self.is_stid_request(request):
-                raise gen.Return(self.decode_mulca_dist_info(body))
+            endpoints = self.decode_mulca_dist_info(body) if stid else self.decode_mds_dist_info(body)
+        except HTTPError as err:
+            if err.code == 404:
+                self.dist_info_cache.put(cache_key, NOT_FOUND, self.dist_info_negative_ttl)
+            raise
+        finally:
+            self.dist_info_fetches.pop(cache_key, None)
+
+        self.dist_info_cache.put(cache_key, endpoints)
+        raise gen.Return(endpoints)
+
+    @gen.coroutine
+    def fetch_mds_endpoints(self, request, srw_request, cache_key):
+        """Returns shuffled endpoints of the key from the cache or dist-info, None if the reply is sent"""
+        metrics = self.proxy.metrics
+        # dist-info checks the credentials, so neither its reply nor a fetch
+        # in progress is shared by requests with different ones
+        cache_key = cache_key + (credentials_digest(srw_request),)
+        try:
+            endpoints = self.dist_info_cache.get(cache_key)
+            if endpoints is NOT_FOUND:
+                metrics.incr("cocaine_proxy_dist_info_cache_total", ("negative",))
+                raise PluginNoSuchApplication("404")
+
+            if endpoints is None:
+                fetch = self.dist_info_fetches.get(cache_key)
+                if fetch is None:
+                    metrics.incr("cocaine_proxy_dist_info_cache_total", ("miss",))
+                    fetch = self.fetch_dist_info(srw_request, cache_key)
+                    if not fetch.done():
+                        self.dist_info_fetches[cache_key] = fetch
+                else:
+                    metrics.incr("cocaine_proxy_dist_info_cache_total", ("coalesced",))
+                    request.logger.debug("waiting for dist-info of the same key requested by another request")
+                endpoints = yield fetch
             else:
-                raise gen.Return(self.decode_mds_dist_info(body))
+                metrics.incr("cocaine_proxy_dist_info_cache_total", ("hit",))
+
+            # every request starts from its own random endpoint
+            endpoints = list(endpoints)
+            shuffle(endpoints)
+            raise gen.Return(endpoints)
 
         except HTTPError as err:
             if err.code == 404:
@@ -200,6 +426,14 @@ class MDSDirect(IPlugin):
             raise err
 
 
+def credentials_digest(srw_request):
+    """Returns a digest of Authorization of the request to key cached replies, None without it"""
+    authorization = srw_request.headers.get("Authorization")
+    if authorization is None:
+        return None
+    return hashlib.sha1(authorization).digest()
+
+
 def decode_chunked_encoded_reply(resp):
     # read_size is set to to prevent overead from BytesIO
     # in this case the rest of the buffer is not packed data
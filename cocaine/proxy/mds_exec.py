@@ -7,7 +7,6 @@ import msgpack
 
 from tornado import gen
 from tornado import httputil
-from tornado.httpclient import AsyncHTTPClient
 from tornado.httpclient import HTTPError
 from tornado.httpclient import HTTPRequest
 
@@ -18,8 +17,12 @@ from cocaine.proxy.helpers import pack_httprequest
 from cocaine.proxy.plugin import IPlugin
 from cocaine.proxy.plugin import PluginApplicationError
 from cocaine.proxy.plugin import PluginConfigurationError
+from cocaine.proxy.plugin import PluginHTTPClient
 from cocaine.proxy.plugin import PluginNoSuchApplication
 
+from cocaine.proxy.proxy import BodyProcessor
+from cocaine.proxy.proxy import ChunkedBodyProcessor
+
 
 def is_mds_stid(stid):
     _, _, tail = stid.split(".", 2)
@@ -27,12 +30,14 @@ def is_mds_stid(stid):
 
 
 class MDSExec(IPlugin):
+    trigger_headers = ("X-Srw-Key", "X-Srw-Key-Type", "X-Srw-Namespace")
+
     def __init__(self, proxy, config):
         super(MDSExec, self).__init__(proxy)
         try:
             self.srw_host = config["srw_host"]
             self.filter_mds_stid = config.get("filter_stid", True)
-            self.srw_httpclient = AsyncHTTPClient()
+            self.srw_httpclient = PluginHTTPClient(self.name(), proxy, config.get("http_client"))
         except KeyError as err:
             raise PluginConfigurationError(self.name(), "option required %s" % err)
 
@@ -64,21 +69,28 @@ class MDSExec(IPlugin):
         if traceid is not None:
             mds_request_headers["X-Request-Id"] = traceid
 
+        decoder = ReplyDecoder(request, name)
         srw_request = HTTPRequest("%s/exec-%s/%s/%s/stid/%s?timeout=%d" % (self.srw_host, namespace, name, event, key, timeout),
                                   method="POST",
                                   headers=mds_request_headers,
                                   body=msgpack.packb(pack_httprequest(request)),
                                   allow_ipv6=True,
-                                  request_timeout=timeout)
+                                  request_timeout=timeout,
+                                  header_callback=decoder.on_header,
+                                  streaming_callback=decoder.on_chunk)
 
         try:
-            # NOTE: we can do it in a streaming way
-            resp = yield self.srw_httpclient.fetch(srw_request)
-            code, reply_headers, body = decode_chunked_encoded_reply(resp)
-            fill_response_in(request, code,
-                             httplib.responses.get(code, httplib.OK),
-                             body, reply_headers)
+            yield self.srw_httpclient.fetch(srw_request)
         except HTTPError as err:
+            if decoder.streaming:
+                # the code has been sent already, so the client sees the body broken off
+                request.logger.error("SRW reply has broken off after %d bytes: %s", decoder.body_size, err)
+                # the request is accounted with the code sent, as finalize_response does
+                request.response_code = decoder.processor.code
+                request.response_time = request.request_time()
+                request.connection.close()
+                return
+
             if err.code == 404:
                 raise PluginNoSuchApplication("worker was not found")
 
@@ -88,16 +100,70 @@ class MDSExec(IPlugin):
             if err.code == 401:
                 fill_response_in(request, err.code,
                                  httplib.responses.get(err.code, httplib.OK),
-                                 err.response.body, err.response.headers)
+                                 decoder.error_body(), err.response.headers)
                 return
 
             raise err
 
+        decoder.finish()
+
+
+class ReplyDecoder(object):
+    """Decodes SRW exec reply as it arrives: a packed (code, headers) frame followed by the body
+
+    The body is passed to the client as soon as the frame is decoded.
+    The body of a SRW reply other than 2xx is kept to be reported as is.
+    """
+
+    def __init__(self, request, name):
+        self.request = request
+        self.name = name
+        self.srw_code = None
+        self.unpacker = msgpack.Unpacker()
+        # received bytes until the frame is decoded
+        self.head = bytearray()
+        self.processor = None
+        self.body_size = 0
+        self.error_chunks = []
+
+    @property
+    def streaming(self):
+        """True if the code and headers have been sent to the client"""
+        return isinstance(self.processor, ChunkedBodyProcessor)
+
+    def on_header(self, line):
+        if line.startswith("HTTP/"):
+            self.srw_code = httputil.parse_response_start_line(line.strip()).code
+
+    def on_chunk(self, chunk):
+        if self.srw_code is None or not 200 <= self.srw_code < 300:
+            self.error_chunks.append(chunk)
+            return
+
+        if self.processor is None:
+            self.unpacker.feed(chunk)
+            self.head.extend(chunk)
+            try:
+                code, raw_headers = self.unpacker.unpack()
+            except msgpack.OutOfData:
+                return
+
+            # the rest of the received data is the body
+            chunk = bytes(self.head[self.unpacker.tell():])
+            self.head = None
+            headers = httputil.HTTPHeaders(raw_headers)
+            self.processor = BodyProcessor.make_processor(headers.get("Content-Length"),
+                                                          self.request, self.name, code, headers)
+            if not chunk:
+                return
+
+        self.body_size += len(chunk)
+        self.processor.swallow(chunk)
+
+    def finish(self):
+        if self.processor is None:
+            raise PluginApplicationError(42, 42, "worker reply has no code and headers")
+        self.processor.finish()
 
-def decode_chunked_encoded_reply(resp):
-    # read_size is set to to prevent overead from BytesIO
-    # in this case the rest of the buffer is not packed data
-    code, raw_headers = msgpack.Unpacker(resp.buffer, read_size=1).unpack()
-    body = resp.buffer.read(None)
-    headers = httputil.HTTPHeaders(raw_headers)
-    return code, headers, body
+    def error_body(self):
+        return "".join(self.error_chunks)
@@ -0,0 +1,115 @@
+import collections
+import functools
+import gc
+import resource
+
+
+DEFAULT_TOP_TYPES = 50
+
+
+def type_name(obj):
+    klass = type(obj)
+    module = getattr(klass, "__module__", None)
+    if module in (None, "__builtin__"):
+        return klass.__name__
+    return "%s.%s" % (module, klass.__name__)
+
+
+def count_objects():
+    """Counts objects tracked by the garbage collector by type
+
+    Only containers are tracked, so strings and numbers are not counted.
+    It walks the whole heap and blocks the event loop for a while.
+    """
+    counts = collections.defaultdict(int)
+    for obj in gc.get_objects():
+        counts[type_name(obj)] += 1
+    return dict(counts)
+
+
+def unwrap_stack_context(callback):
+    # stack_context.wrap keeps the original callback in the `fn` closure cell
+    if not getattr(callback, "_wrapped", False):
+        return callback
+    code = getattr(callback, "__code__", None)
+    if code is None or "fn" not in code.co_freevars:
+        return callback
+    return callback.__closure__[code.co_freevars.index("fn")].cell_contents
+
+
+def callback_name(callback):
+    # IOLoop.call_at wraps a callback into functools.partial of stack_context.wrap
+    while isinstance(callback, functools.partial) or getattr(callback, "_wrapped", False):
+        unwrapped = callback.func if isinstance(callback, functools.partial) else unwrap_stack_context(callback)
+        if unwrapped is callback:
+            break
+        callback = unwrapped
+    func = getattr(callback, "im_func", callback)
+    code = getattr(func, "__code__", None)
+    name = "%s.%s" % (getattr(func, "__module__", "?"), getattr(func, "__name__", type_name(func)))
+    if code is not None:
+        # there are plenty of closures named `wrapper`
+        name = "%s:%d" % (name, code.co_firstlineno)
+    return name
+
+
+def count_timeouts(io_loop):
+    """Counts pending `call_later`/`call_at` callbacks of the IOLoop by callback"""
+    counts = collections.defaultdict(int)
+    # it's a private heap of the PollIOLoop
+    for timeout in getattr(io_loop, "_timeouts", ()):
+        if timeout.callback is not None:
+            counts[callback_name(timeout.callback)] += 1
+    return dict(counts)
+
+
+def process_memory():
+    result = {"max_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024}
+    try:
+        with open("/proc/self/statm") as f:
+            size, rss = [int(i) for i in f.read().split()[:2]]
+        page = resource.getpagesize()
+        result.update(vms=size * page, rss=rss * page)
+    except (IOError, OSError, ValueError):
+        pass
+    return result
+
+
+def top_counts(counts, top=DEFAULT_TOP_TYPES):
+    return dict(sorted(counts.iteritems(), key=lambda item: -abs(item[1]))[:top])
+
+
+def diff_counts(previous, current, top=DEFAULT_TOP_TYPES):
+    """Nonzero changes between two {name: count} snapshots, the biggest first"""
+    diff = {}
+    for name in set(previous) | set(current):
+        delta = current.get(name, 0) - previous.get(name, 0)
+        if delta:
+            diff[name] = delta
+    return top_counts(diff, top)
+
+
+class MemoryTracker(object):
+    """Keeps the previous snapshot to report what has grown since then"""
+
+    def __init__(self):
+        self.previous = None
+        self.taken_at = None
+
+    def snapshot(self, sections, now, top=DEFAULT_TOP_TYPES):
+        """Takes {section: {name: count}}, returns the diff against the previous one or None"""
+        previous, taken_at = self.previous, self.taken_at
+        self.previous, self.taken_at = sections, now
+        if previous is None:
+            return None
+
+        diff = dict((name, diff_counts(previous.get(name, {}), counts, top))
+                    for name, counts in sections.iteritems())
+        diff["interval"] = now - taken_at
+        return diff
+
+
+def gc_stats():
+    return {"counts": gc.get_count(),
+            "thresholds": gc.get_threshold(),
+            "garbage": len(gc.garbage)}
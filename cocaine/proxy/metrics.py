@@ -0,0 +1,299 @@
+import math
+
+
+# ms, the upper bound of the first bucket
+HISTOGRAM_MIN = 0.1
+# each next bucket is wider by ~9%, it bounds the relative error of percentiles
+HISTOGRAM_FACTOR = 2 ** 0.125
+# covers up to ~100 seconds
+HISTOGRAM_BUCKETS = 168
+
+DEFAULT_PERCENTILES = (50, 75, 90, 95, 99, 99.9)
+
+# protects from unbounded growth of series if events come from urls
+MAX_LATENCY_SERIES = 4096
+OVERFLOW_LABEL = "__overflow__"
+
+_INV_LOG_FACTOR = 1.0 / math.log(HISTOGRAM_FACTOR)
+
+
+def bucket_upper_bound(index):
+    return HISTOGRAM_MIN * HISTOGRAM_FACTOR ** index
+
+
+def status_class(code):
+    return "%dxx" % (code // 100)
+
+
+class Histogram(object):
+    """Fixed-size histogram with logarithmic buckets
+
+    Bucket 0 counts values up to HISTOGRAM_MIN, bucket i counts values
+    up to HISTOGRAM_MIN * HISTOGRAM_FACTOR ** i, the last one is unbounded.
+    """
+
+    __slots__ = ("counts", "count", "sum", "max")
+
+    def __init__(self):
+        self.counts = [0] * HISTOGRAM_BUCKETS
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def record(self, value):
+        if value <= HISTOGRAM_MIN:
+            index = 0
+        else:
+            index = min(int(math.log(value / HISTOGRAM_MIN) * _INV_LOG_FACTOR) + 1,
+                        HISTOGRAM_BUCKETS - 1)
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        for index, count in enumerate(other.counts):
+            self.counts[index] += count
+        self.count += other.count
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+
+    def cumulative(self, bounds):
+        """Counts of values not greater than each of the sorted bounds
+
+        A bucket is attributed to a bound if its upper bound does not exceed it,
+        so the result is exact up to the bucket width.
+        """
+        result = []
+        seen = 0
+        index = 0
+        for bound in bounds:
+            while index < HISTOGRAM_BUCKETS - 1 and bucket_upper_bound(index) <= bound:
+                seen += self.counts[index]
+                index += 1
+            result.append(seen)
+        return result
+
+    def percentile(self, p):
+        if self.count == 0:
+            return 0.0
+
+        rank = math.ceil(self.count * p / 100.0)
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bucket_upper_bound(index), self.max)
+        return self.max
+
+    def summary(self, percentiles=DEFAULT_PERCENTILES):
+        result = {
+            "count": self.count,
+            "mean": self.sum / self.count if self.count else 0.0,
+            "max": self.max,
+        }
+        for p in percentiles:
+            result["p%s" % ("%g" % p).replace(".", "")] = self.percentile(p)
+        return result
+
+    def dump(self):
+        # sparse form as most of the buckets are empty
+        return [dict((i, c) for i, c in enumerate(self.counts) if c), self.count, self.sum, self.max]
+
+    @classmethod
+    def load(cls, dumped):
+        hist = cls()
+        counts, hist.count, hist.sum, hist.max = dumped
+        for index, count in counts.iteritems():
+            hist.counts[index] = count
+        return hist
+
+
+class LatencySeries(object):
+    __slots__ = ("total", "headers", "body")
+
+    def __init__(self):
+        # whole request, until a code and headers from an app, streaming of a body
+        self.total = Histogram()
+        self.headers = Histogram()
+        self.body = Histogram()
+
+    def merge(self, other):
+        self.total.merge(other.total)
+        self.headers.merge(other.headers)
+        self.body.merge(other.body)
+
+    def dump(self):
+        return [self.total.dump(), self.headers.dump(), self.body.dump()]
+
+    @classmethod
+    def load(cls, dumped):
+        series = cls()
+        series.total, series.headers, series.body = [Histogram.load(i) for i in dumped]
+        return series
+
+
+class LatencyHistograms(object):
+    """Latency distributions by (app, event, status class)"""
+
+    def __init__(self, max_series=MAX_LATENCY_SERIES):
+        self.max_series = max_series
+        self.series = {}
+
+    def record(self, app, event, code, total, headers=None):
+        key = (app, event, status_class(code))
+        series = self.series.get(key)
+        if series is None:
+            if len(self.series) >= self.max_series:
+                key = (app, OVERFLOW_LABEL, key[2])
+                series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = LatencySeries()
+
+        series.total.record(total)
+        if headers is not None:
+            series.headers.record(headers)
+            series.body.record(total - headers)
+
+    def merge(self, other):
+        for key, series in other.series.iteritems():
+            if key in self.series:
+                self.series[key].merge(series)
+            else:
+                merged = self.series[key] = LatencySeries()
+                merged.merge(series)
+
+    def dump(self):
+        return [[list(key), series.dump()] for key, series in self.series.iteritems()]
+
+    @classmethod
+    def load(cls, dumped):
+        histograms = cls()
+        for key, series in dumped:
+            histograms.series[tuple(key)] = LatencySeries.load(series)
+        return histograms
+
+    def summary(self, app=None):
+        result = []
+        for (app_name, event, status), series in self.series.iteritems():
+            if app is not None and app != app_name:
+                continue
+            result.append({
+                "app": app_name,
+                "event": event,
+                "status": status,
+                "total": series.total.summary(),
+                "headers": series.headers.summary(),
+                "body": series.body.summary(),
+            })
+        result.sort(key=lambda item: item["total"]["p99"], reverse=True)
+        return result
+
+
+COUNTER = "counter"
+GAUGE = "gauge"
+HISTOGRAM = "histogram"
+
+# ms, histograms are recorded in milliseconds and exported in seconds
+EXPORTED_HISTOGRAM_BOUNDS = (1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+# per a metric, protects from unbounded growth of label values
+MAX_METRIC_SERIES = 4096
+
+
+class MetricsRegistry(object):
+    """Counters and gauges with labels, rendered in Prometheus text format
+
+    Counters are summed across processes, gauges and histograms are exported
+    per process with an additional `worker` label.
+    """
+
+    def __init__(self, max_series=MAX_METRIC_SERIES):
+        self.max_series = max_series
+        self.definitions = {}
+        self.values = {}
+
+    def define(self, name, kind, description, labelnames=()):
+        self.definitions[name] = (kind, description, tuple(labelnames))
+        self.values.setdefault(name, {})
+
+    def incr(self, name, labels=(), value=1):
+        series = self.values[name]
+        if labels not in series and len(series) >= self.max_series:
+            labels = (OVERFLOW_LABEL,) * len(labels)
+        series[labels] = series.get(labels, 0) + value
+
+    def set(self, name, labels, value):
+        series = self.values[name]
+        if labels not in series and len(series) >= self.max_series:
+            return
+        series[labels] = value
+
+    def observe(self, name, labels, value):
+        series = self.values[name]
+        hist = series.get(labels)
+        if hist is None:
+            if len(series) >= self.max_series:
+                return
+            hist = series[labels] = Histogram()
+        hist.record(value)
+
+    def reset(self, name):
+        self.values[name] = {}
+
+    def dump(self):
+        result = {}
+        for name, series in self.values.iteritems():
+            if self.definitions[name][0] == HISTOGRAM:
+                result[name] = [[list(labels), hist.dump()] for labels, hist in series.iteritems()]
+            else:
+                result[name] = [[list(labels), value] for labels, value in series.iteritems()]
+        return result
+
+    def render(self, dumps):
+        """Renders metrics from dumps of registries, it's a list of (worker, dump)"""
+        lines = []
+        for name in sorted(self.definitions):
+            kind, description, labelnames = self.definitions[name]
+            lines.append("# HELP %s %s" % (name, description))
+            lines.append("# TYPE %s %s" % (name, kind))
+            if kind == COUNTER:
+                merged = {}
+                for _, dumped in dumps:
+                    for labels, value in dumped.get(name, ()):
+                        key = tuple(labels)
+                        merged[key] = merged.get(key, 0) + value
+                for labels, value in sorted(merged.iteritems()):
+                    lines.append(format_sample(name, labelnames, labels, value))
+            elif kind == HISTOGRAM:
+                worker_labelnames = labelnames + ("worker",)
+                bucket_labelnames = worker_labelnames + ("le",)
+                for worker, dumped in dumps:
+                    for labels, value in dumped.get(name, ()):
+                        labels = tuple(labels) + (worker,)
+                        hist = Histogram.load(value)
+                        for bound, count in zip(EXPORTED_HISTOGRAM_BOUNDS, hist.cumulative(EXPORTED_HISTOGRAM_BOUNDS)):
+                            lines.append(format_sample(name + "_bucket", bucket_labelnames,
+                                                       labels + ("%g" % (bound / 1000.0),), count))
+                        lines.append(format_sample(name + "_bucket", bucket_labelnames, labels + ("+Inf",), hist.count))
+                        lines.append(format_sample(name + "_sum", worker_labelnames, labels, hist.sum / 1000.0))
+                        lines.append(format_sample(name + "_count", worker_labelnames, labels, hist.count))
+            else:
+                worker_labelnames = labelnames + ("worker",)
+                for worker, dumped in dumps:
+                    for labels, value in dumped.get(name, ()):
+                        lines.append(format_sample(name, worker_labelnames, tuple(labels) + (worker,), value))
+        lines.append("")
+        return "\n".join(lines)
+
+
+def escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def format_sample(name, labelnames, labels, value):
+    if labelnames:
+        name = "%s{%s}" % (name, ",".join('%s="%s"' % (k, escape_label_value(v))
+                                          for k, v in zip(labelnames, labels)))
+    return "%s %s" % (name, repr(float(value)) if isinstance(value, float) else value)
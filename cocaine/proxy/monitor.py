@@ -0,0 +1,102 @@
+import sys
+import threading
+import time
+import traceback
+
+
+LOOP_LAG_PERIOD = 0.5  # sec
+# frames deeper than that are not interesting in a dump of a blocked loop
+MAX_DUMPED_FRAMES = 64
+
+
+def find_request(frame):
+    """Returns the innermost `request` local which looks like an HTTP request"""
+    while frame is not None:
+        code = frame.f_code
+        # f_locals builds a dict, so frames without the name are skipped cheaply
+        if "request" not in code.co_varnames and "request" not in code.co_cellvars:
+            frame = frame.f_back
+            continue
+        request = frame.f_locals.get("request")
+        if request is not None and hasattr(request, "headers"):
+            return request
+        frame = frame.f_back
+    return None
+
+
+def describe_request(request):
+    if request is None:
+        return "", ""
+    app = getattr(request, "app_name", None) or request.headers.get("X-Cocaine-Service", "")
+    return app, getattr(request, "traceid", "")
+
+
+class LoopLagMonitor(object):
+    """Measures the delay of the event loop callbacks
+
+    A callback is scheduled every `period` seconds, the lateness of its run
+    is reported to `on_lag`. If `watchdog_threshold` is set, a thread watches
+    the callbacks and logs the stack of the loop thread once it has been blocked
+    for longer than the threshold.
+    """
+
+    def __init__(self, io_loop, on_lag, period=LOOP_LAG_PERIOD, watchdog_threshold=0, logger=None):
+        self.io_loop = io_loop
+        self.on_lag = on_lag
+        self.period = period
+        self.watchdog_threshold = watchdog_threshold
+        self.logger = logger
+
+        self.loop_thread = None
+        self.last_tick = None
+        self.stalls = 0
+        self._reported_tick = None
+        self._watchdog = None
+
+    def start(self):
+        self._schedule()
+        if self.watchdog_threshold > 0 and self._watchdog is None:
+            self._watchdog = threading.Thread(target=self._watch, name="loop-watchdog")
+            self._watchdog.daemon = True
+            self._watchdog.start()
+
+    def _schedule(self):
+        scheduled = self.io_loop.time() + self.period
+
+        def on_tick():
+            self.loop_thread = threading.current_thread().ident
+            self.last_tick = time.time()
+            self.on_lag(max(self.io_loop.time() - scheduled, 0))
+            self._schedule()
+
+        self.io_loop.call_at(scheduled, on_tick)
+
+    def _watch(self):
+        interval = min(self.period, self.watchdog_threshold) / 2.0
+        while True:
+            time.sleep(interval)
+            self.check()
+
+    def check(self):
+        """Dumps the loop stack if the loop has been blocked, returns True in this case"""
+        last_tick = self.last_tick
+        if last_tick is None or last_tick == self._reported_tick:
+            return False
+
+        blocked = time.time() - last_tick - self.period
+        if blocked <= self.watchdog_threshold:
+            return False
+
+        # the stall is reported once until the loop gets back
+        self._reported_tick = last_tick
+        self.stalls += 1
+        frame = sys._current_frames().get(self.loop_thread)
+        if frame is None:
+            return False
+
+        app, traceid = describe_request(find_request(frame))
+        stack = "".join(traceback.format_stack(frame, MAX_DUMPED_FRAMES))
+        if self.logger:
+            self.logger.error("event loop has been blocked for %.3fs, app: %s, traceid: %s\n%s",
+                              blocked, app, traceid, stack)
+        return True
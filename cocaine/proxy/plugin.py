@@ -1,4 +1,20 @@
+import copy
+import time
+from datetime import timedelta
+
 from tornado import gen
+from tornado.httpclient import HTTPError
+from tornado.locks import Semaphore
+from tornado.util import import_object
+
+
+# the simple client of tornado queues requests over 10 by default
+DEFAULT_HTTP_MAX_CLIENTS = 100
+
+HTTP_CLIENT_IMPLEMENTATIONS = {
+    "simple": "tornado.simple_httpclient.SimpleAsyncHTTPClient",
+    "curl": "tornado.curl_httpclient.CurlAsyncHTTPClient",
+}
 
 
 class PluginException(Exception):
@@ -25,6 +41,9 @@ class PluginApplicationError(PluginException):
 
 
 class IPlugin(object):
+    # headers a request must have all of to be matched, None to match every request
+    trigger_headers = None
+
     @staticmethod
     def name():
         raise NotImplementedError()
@@ -38,3 +57,87 @@ class IPlugin(object):
     @gen.coroutine
     def process(self, request):
         raise NotImplementedError()
+
+
+class PluginHTTPClient(object):
+    """HTTP client of a plugin configured by the `http_client` section of its srwconfig args
+
+    Requests over `max_clients` wait for a free slot of this wrapper, so the wait
+    is observed in cocaine_proxy_plugin_http_queue_seconds. The wait is a part of
+    the request timeout. The curl client keeps connections alive between requests,
+    the simple one does not.
+    """
+
+    def __init__(self, plugin_name, proxy, config=None):
+        config = config or {}
+        self.plugin_name = plugin_name
+        self.metrics = proxy.metrics
+        implementation = config.get("implementation", "simple")
+        try:
+            klass = import_object(HTTP_CLIENT_IMPLEMENTATIONS.get(implementation, implementation))
+        except ImportError as err:
+            raise PluginConfigurationError(plugin_name, "http client %s is not available: %s" % (implementation, err))
+
+        self.max_clients = config.get("max_clients", DEFAULT_HTTP_MAX_CLIENTS)
+        defaults = dict((name, config[name]) for name in ("connect_timeout", "request_timeout") if name in config)
+        self.client = klass(force_instance=True, max_clients=self.max_clients, defaults=defaults)
+        self.request_timeout = defaults.get("request_timeout")
+        self.slots = Semaphore(self.max_clients)
+
+    @gen.coroutine
+    def fetch(self, request, **kwargs):
+        start = time.time()
+        timeout = request.request_timeout or self.request_timeout
+        try:
+            yield self.slots.acquire(None if timeout is None else timedelta(seconds=timeout))
+        except gen.TimeoutError:
+            raise HTTPError(599, "Timeout in request queue")
+        finally:
+            waited = time.time() - start
+            self.metrics.observe("cocaine_proxy_plugin_http_queue_seconds", (self.plugin_name,), 1000.0 * waited)
+
+        try:
+            if timeout is not None:
+                if waited >= timeout:
+                    raise HTTPError(599, "Timeout in request queue")
+                request = copy.copy(request)
+                request.request_timeout = timeout - waited
+            response = yield self.client.fetch(request, **kwargs)
+        finally:
+            self.slots.release()
+        raise gen.Return(response)
+
+    def close(self):
+        self.client.close()
+
+
+class PluginIndex(object):
+    """Plugins by their trigger headers
+
+    A plugin with `trigger_headers` is matched only against requests having
+    all of them, a plugin without them is matched against every request.
+    Candidates keep the order of the plugins.
+    """
+
+    def __init__(self, plugins):
+        self.plugins = list(plugins)
+        self.triggers = [None if plugin.trigger_headers is None else
+                         frozenset(normalize_header_name(header) for header in plugin.trigger_headers)
+                         for plugin in self.plugins]
+        self.headers = frozenset().union(*(t for t in self.triggers if t is not None))
+        # candidates by the trigger headers present in a request
+        self.candidates_cache = {}
+
+    def candidates(self, headers):
+        present = self.headers.intersection(headers)
+        candidates = self.candidates_cache.get(present)
+        if candidates is None:
+            candidates = [plugin for plugin, triggers in zip(self.plugins, self.triggers)
+                          if triggers is None or triggers <= present]
+            self.candidates_cache[present] = candidates
+        return candidates
+
+
+def normalize_header_name(name):
+    """Returns the name as it's kept by HTTPHeaders, e.g. X-Cocaine-Json-Rpc"""
+    return "-".join(word.capitalize() for word in name.split("-"))
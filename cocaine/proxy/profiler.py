@@ -0,0 +1,171 @@
+import os
+import signal
+import time
+
+from cocaine.proxy.monitor import describe_request
+from cocaine.proxy.monitor import find_request
+from cocaine.proxy.shared import SharedBoard
+from cocaine.proxy.shared import SharedStore
+from cocaine.proxy.shared import SharedStoreBusy
+from cocaine.proxy.shared import SharedStoreOverflow
+
+
+DEFAULT_SAMPLING_INTERVAL = 0.01  # sec of CPU time
+DEFAULT_PROFILE_DURATION = 10  # sec
+MAX_PROFILE_DURATION = 60  # sec
+DEFAULT_PROFILE_SLOT_SIZE = 1 << 20  # bytes
+# the rarest stacks are dropped if the result does not fit into a slot
+MAX_PUBLISHED_STACKS = 4096
+_CONTROL_SIZE = 4096  # bytes
+
+
+class ProfilerBusy(Exception):
+    pass
+
+
+def frame_name(frame):
+    code = frame.f_code
+    return "%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+
+def collapse(frame):
+    """Folds the stack into `[app/event];outer;...;inner` form used by flamegraph tools"""
+    names = []
+    innermost = frame
+    while frame is not None:
+        names.append(frame_name(frame))
+        frame = frame.f_back
+
+    request = find_request(innermost)
+    if request is not None:
+        app, _ = describe_request(request)
+        event = getattr(request, "event_name", None) or request.headers.get("X-Cocaine-Event", "")
+        names.append("[%s/%s]" % (app or "-", event or "-"))
+    else:
+        names.append("[-]")
+    names.reverse()
+    return ";".join(names)
+
+
+def format_collapsed(counts):
+    return "".join("%s %d\n" % (stack, count)
+                   for stack, count in sorted(counts.iteritems(), key=lambda item: -item[1]))
+
+
+class SamplingProfiler(object):
+    """Statistical profiler driven by SIGPROF
+
+    The timer counts CPU time of the process, so an idle event loop is not sampled.
+    The handler runs in the main thread, which is the thread of the event loop.
+    Only one profiler can be active in a process at a time.
+    """
+
+    active = None
+
+    def __init__(self, interval=DEFAULT_SAMPLING_INTERVAL):
+        self.interval = interval
+        self.counts = {}
+        self.samples = 0
+
+    def start(self):
+        if SamplingProfiler.active is not None:
+            raise ProfilerBusy("profiler is already running")
+        SamplingProfiler.active = self
+        signal.signal(signal.SIGPROF, self._sample)
+        # restart interrupted syscalls instead of failing them with EINTR
+        signal.siginterrupt(signal.SIGPROF, False)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_IGN)
+        SamplingProfiler.active = None
+        return self.counts
+
+    def _sample(self, signum, frame):
+        if frame is None:
+            return
+        stack = collapse(frame)
+        self.counts[stack] = self.counts.get(stack, 0) + 1
+        self.samples += 1
+
+
+class ProfilerControl(object):
+    """Profiling sessions shared between forked processes
+
+    Any process can request a session for a set of workers, each of them
+    picks it up on the next poll and publishes collapsed stacks into its slot.
+    It must be created before fork.
+    """
+
+    def __init__(self, rows=1, size=DEFAULT_PROFILE_SLOT_SIZE):
+        self.control = SharedStore(_CONTROL_SIZE)
+        self.results = SharedBoard(rows, size)
+        self.rows = rows
+        self.row = 0
+        self.handled = 0
+
+    def select(self, row):
+        self.results.select(row)
+        self.row = row
+
+    def request(self, seconds, workers=None, interval=DEFAULT_SAMPLING_INTERVAL):
+        """Starts a session, returns its description. `workers` is None for all of them"""
+        now = time.time()
+        if workers is None:
+            workers = range(self.rows)
+        workers = [i for i in workers if 0 <= i < self.rows]
+        if not workers:
+            raise ValueError("no such workers, there are %d of them" % self.rows)
+
+        def start(current):
+            if current.get("deadline", 0) > now:
+                raise ProfilerBusy("session %d is in progress" % current["id"])
+            return {"id": current.get("id", 0) + 1,
+                    "workers": workers,
+                    "seconds": seconds,
+                    "interval": interval,
+                    "deadline": now + seconds}
+
+        try:
+            return self.control.update(start, {})
+        except SharedStoreBusy:
+            raise ProfilerBusy("a session is being requested by another process")
+
+    def pending(self):
+        session = self.control.read({})
+        if session.get("id", 0) <= self.handled:
+            return None
+        self.handled = session["id"]
+        if self.row not in session["workers"] or session["deadline"] < time.time():
+            return None
+        return session
+
+    def publish(self, session_id, counts, samples):
+        stacks = sorted(counts.iteritems(), key=lambda item: -item[1])
+        limit = MAX_PUBLISHED_STACKS
+        while True:
+            try:
+                self.results.publish({"id": session_id, "samples": samples, "stacks": dict(stacks[:limit])})
+                return
+            except SharedStoreOverflow:
+                if limit == 0:
+                    raise
+                limit //= 2
+
+    def collect(self, session):
+        """Returns results of the session published so far by {worker: result}"""
+        collected = {}
+        for row in session["workers"]:
+            result = self.results.slots[row].read()
+            if result is not None and result["id"] == session["id"]:
+                collected[row] = result
+        return collected
+
+
+def merge_stacks(results):
+    merged = {}
+    for result in results:
+        for stack, count in result["stacks"].iteritems():
+            merged[stack] = merged.get(stack, 0) + count
+    return merged
@@ -67,22 +67,58 @@ from cocaine.detail.trace import Trace
 from cocaine.tools.dispatch import PooledServiceFactory
 from cocaine.tools.plugins.secure.tvm import TVM
 
+from cocaine.proxy import codec
+from cocaine.proxy.accesslog import BinaryAccessLog
+from cocaine.proxy.accesslog import DEFAULT_BACKUP_COUNT
+from cocaine.proxy.accesslog import DEFAULT_MAX_SIZE
+from cocaine.proxy.helpers import dump_snapshot
 from cocaine.proxy.helpers import Endpoints
 from cocaine.proxy.helpers import extract_app_and_event
 from cocaine.proxy.helpers import fill_response_in
 from cocaine.proxy.helpers import write_chunked
 from cocaine.proxy.helpers import finalize_chunked_response
 from cocaine.proxy.helpers import header_to_seed
+from cocaine.proxy.helpers import load_snapshot
 from cocaine.proxy.helpers import load_srw_config
+from cocaine.proxy.helpers import mark_stage
+from cocaine.proxy.helpers import stage_durations
 from cocaine.proxy.helpers import pack_httprequest
 from cocaine.proxy.helpers import parse_locators_endpoints
 from cocaine.proxy.helpers import ProxyInvalidRequest
+from cocaine.proxy.helpers import RateLimiter
 from cocaine.proxy.helpers import upper_bound
+from cocaine.proxy.jsonrpc import DEFAULT_BATCH_CONCURRENCY
+from cocaine.proxy.jsonrpc import DEFAULT_MAX_BATCH_SIZE
+from cocaine.proxy.logutils import AsyncHandler
 from cocaine.proxy.logutils import ContextAdapter
+from cocaine.proxy.logutils import DEFAULT_LOG_QUEUE_SIZE
 from cocaine.proxy.logutils import NULLLOGGER
+from cocaine.proxy.metrics import COUNTER
+from cocaine.proxy.metrics import GAUGE
+from cocaine.proxy.metrics import HISTOGRAM
+from cocaine.proxy.metrics import LatencyHistograms
+from cocaine.proxy.memory import count_objects
+from cocaine.proxy.memory import count_timeouts
+from cocaine.proxy.memory import DEFAULT_TOP_TYPES
+from cocaine.proxy.memory import gc_stats
+from cocaine.proxy.memory import MemoryTracker
+from cocaine.proxy.memory import process_memory
+from cocaine.proxy.memory import top_counts
+from cocaine.proxy.metrics import MetricsRegistry
+from cocaine.proxy.monitor import LoopLagMonitor
 from cocaine.proxy.plugin import IPlugin
+from cocaine.proxy.plugin import PluginIndex
 from cocaine.proxy.plugin import PluginNoSuchApplication
 from cocaine.proxy.plugin import PluginApplicationError
+from cocaine.proxy.profiler import DEFAULT_SAMPLING_INTERVAL
+from cocaine.proxy.profiler import merge_stacks
+from cocaine.proxy.profiler import ProfilerBusy
+from cocaine.proxy.profiler import ProfilerControl
+from cocaine.proxy.profiler import SamplingProfiler
+from cocaine.proxy.shared import DEFAULT_RESOLVE_CACHE_TTL
+from cocaine.proxy.shared import SharedBoard
+from cocaine.proxy.shared import SharedCounters
+from cocaine.proxy.shared import SharedState
 from cocaine.proxy.utilserver import UtilServer
 
 
@@ -96,6 +132,47 @@ DEFAULT_SERVICE_CACHE_COUNT = 5
 DEFAULT_REFRESH_PERIOD = 120
 DEFAULT_TIMEOUT = 30
 DEFAULT_TRACING_CHANCE = 5.  # %
+# traced requests per second per application in a process
+DEFAULT_TRACING_RATE = 50
+# sec Period of reading the routing groups published by the leader process
+SHARED_SYNC_PERIOD = 0.5
+# sec Delay to coalesce a burst of updates into one snapshot
+SNAPSHOT_DELAY = 1
+SNAPSHOT_VERSION = 1
+# sec Period of updating the gauges of the worker stats
+STATS_UPDATE_PERIOD = 1
+# sec Period of publishing histograms for other processes
+BOARD_PUBLISH_PERIOD = 5
+# sec Period of writing out the buffered binary access log
+BINARY_ACCESS_LOG_FLUSH_PERIOD = 1
+# sec Period of checking for profiling sessions requested by other processes
+PROFILE_POLL_PERIOD = 0.5
+# sec Time to wait for the results of a profiling session after its end
+PROFILE_COLLECT_TIMEOUT = 3
+
+# counters kept in shared memory per tornado process
+WORKER_STATS = ("pid", "requests_in_progress", "requests_total",
+                "requests_disconnections", "services")
+
+# name: (type, description, labels)
+PROXY_METRICS = {
+    "cocaine_proxy_requests_total": (COUNTER, "Finished requests", ("app", "code")),
+    "cocaine_proxy_requests_in_progress": (GAUGE, "Requests being processed", ()),
+    "cocaine_proxy_disconnections_total": (COUNTER, "Disconnections from applications", ()),
+    "cocaine_proxy_pool_size": (GAUGE, "Connected application instances", ("app",)),
+    "cocaine_proxy_reconnects_total": (COUNTER, "Reconnections to applications after disconnection", ("app",)),
+    "cocaine_proxy_retries_total": (COUNTER, "Repeated attempts to process a request", ("app", "reason")),
+    "cocaine_proxy_queue_full_total": (COUNTER, "Requests rejected by an application with full queue", ("app",)),
+    "cocaine_proxy_plugin_requests_total": (COUNTER, "Requests dispatched to plugins", ("plugin",)),
+    "cocaine_proxy_plugin_matches_total": (COUNTER, "Requests checked by a plugin by the result", ("plugin", "matched")),
+    "cocaine_proxy_plugin_match_seconds": (HISTOGRAM, "Time spent in match of a plugin", ("plugin",)),
+    "cocaine_proxy_dist_info_cache_total": (COUNTER, "Lookups of MDS dist-info by the result", ("result",)),
+    "cocaine_proxy_mds_service_pool_total": (COUNTER, "Connections to MDS storage hosts taken by the result", ("result",)),
+    "cocaine_proxy_plugin_http_queue_seconds": (HISTOGRAM, "Wait of a plugin HTTP request for a free client", ("plugin",)),
+    "cocaine_proxy_tracing_limited_total": (COUNTER, "Sampled requests not traced due to the rate limit", ("app",)),
+    "cocaine_proxy_log_records_dropped_total": (COUNTER, "Log records dropped as the queue is full", ("logger",)),
+    "cocaine_proxy_loop_lag_seconds": (HISTOGRAM, "Delay of a scheduled event loop callback", ()),
+}
 
 _DEFAULT_BACKLOG = 128
 
@@ -200,8 +277,9 @@ def get_request_id(request_id_header, request, force=False):
 def context(func):
     @gen.coroutine
     def wrapper(self, request):
-        self.requests_in_progress += 1
-        self.requests_total += 1
+        self.stats.incr("requests_in_progress")
+        self.stats.incr("requests_total")
+        request.stages = []
         traceid = None
         try:
             generated_traceid = self.get_request_id(request)
@@ -224,10 +302,12 @@ def context(func):
                 request.logger = NULLLOGGER  # pylint: disable=R0204
             request.traceid = traceid
             request.tracebit = True
-            request.logger.info("start request: %s %s %s", request.host, request.remote_ip, request.uri)
+            request.logger.info("start request: %s %s %s %s", request.host, request.remote_ip, request.uri,
+                                request.method)
             yield func(self, request)
         finally:
-            self.requests_in_progress -= 1
+            self.stats.incr("requests_in_progress", -1)
+            self.on_request_finished(request)
     return wrapper
 
 
@@ -256,6 +336,13 @@ def drop_app_from_cache(cache, app, name):
             cache.pop(name)
 
 
+def drop_unwatched(values, watchers):
+    # values restored from a snapshot for the apps which
+    # have been removed from the configuration service
+    for name in [i for i in values if i not in watchers]:
+        values.pop(name)
+
+
 def load_plugin(name, proxy, config):
     klass = import_object(name)
     if not issubclass(klass, IPlugin):
@@ -269,6 +356,7 @@ class CocaineProxy(object):
                  request_id_header="", sticky_header="X-Cocaine-Sticky",
                  forcegen_request_header=False,
                  default_tracing_chance=DEFAULT_TRACING_CHANCE,
+                 tracing_rate=DEFAULT_TRACING_RATE,
                  configuration_service="unicorn",
                  client_id=0,
                  client_secret='',
@@ -277,35 +365,90 @@ class CocaineProxy(object):
                  timeouts_conf_path="/proxy_apps_timeouts",
                  srw_config=None,
                  allow_json_rpc=True,
+                 jsonrpc_batch_concurrency=DEFAULT_BATCH_CONCURRENCY,
+                 jsonrpc_max_batch_size=DEFAULT_MAX_BATCH_SIZE,
+                 shared_state=None,
+                 snapshot_path=None,
+                 stats=None,
+                 board=None,
+                 profiler=None,
+                 loop_watchdog_ms=0,
+                 server_timing=False,
+                 binary_access_log=None,
+                 binary_access_log_max_size=DEFAULT_MAX_SIZE,
+                 binary_access_log_backups=DEFAULT_BACKUP_COUNT,
                  ioloop=None, **config):
-        # stats
-        self.requests_in_progress = 0
-        self.requests_disconnections = 0
-        self.requests_total = 0
-
         self.io_loop = ioloop or tornado.ioloop.IOLoop.current()
+
+        # stats are allocated before fork to be aggregated across the processes
+        self.stats = stats or SharedCounters(WORKER_STATS)
+        self.stats.select(process.task_id() or 0)
+        self.stats.set("pid", os.getpid())
+        tornado.ioloop.PeriodicCallback(self.update_stats, STATS_UPDATE_PERIOD * 1000,
+                                        io_loop=self.io_loop).start()
+
+        self.metrics = MetricsRegistry()
+        for name, (kind, description, labelnames) in PROXY_METRICS.iteritems():
+            self.metrics.define(name, kind, description, labelnames)
+
+        self.latency = LatencyHistograms()
+        self.board = board or SharedBoard()
+        self.board.select(self.stats.row)
+        tornado.ioloop.PeriodicCallback(self.publish_board, BOARD_PUBLISH_PERIOD * 1000,
+                                        io_loop=self.io_loop).start()
+        self.profiler = profiler or ProfilerControl()
+        self.profiler.select(self.stats.row)
+        tornado.ioloop.PeriodicCallback(self.poll_profile, PROFILE_POLL_PERIOD * 1000,
+                                        io_loop=self.io_loop).start()
         self.service_cache_count = cache
         self.spool_size = int(self.service_cache_count * 1.5)
         self.refresh_period = config.get("refresh_timeout", DEFAULT_REFRESH_PERIOD)
         self.locator_endpoints = [parse_locators_endpoints(i) for i in locators]
+
+        self.logger = logging.getLogger("cocaine.proxy.general")
+        self.access_log = logging.getLogger("cocaine.proxy.access")
+        self.access_log.propagate = False
+
+        self.binary_access_log = None
+        if binary_access_log:
+            # every forked process writes its own file
+            if process.task_id() is not None:
+                binary_access_log = "%s.%d" % (binary_access_log, self.stats.row)
+            self.binary_access_log = BinaryAccessLog(binary_access_log, binary_access_log_max_size,
+                                                     binary_access_log_backups)
+            tornado.ioloop.PeriodicCallback(self.flush_binary_access_log,
+                                            BINARY_ACCESS_LOG_FLUSH_PERIOD * 1000,
+                                            io_loop=self.io_loop).start()
+
+        self.loop_monitor = LoopLagMonitor(self.io_loop, self.on_loop_lag,
+                                           watchdog_threshold=loop_watchdog_ms / 1000.0,
+                                           logger=self.logger)
+        self.loop_monitor.start()
+
+        # state shared between forked processes
+        self.shared_state = shared_state
+        self.shared_routing_generation = 0
         # it's initialized after start
         # to avoid an io_loop creation before fork
         self.locator = Locator(endpoints=self.locator_endpoints)
+        if self.shared_state is not None:
+            self.locator = self.shared_state.make_locator(self.locator, self.logger)
         # it's used to reply on `ping` method
         self.locator_status = False
 
         # active applications
         self.cache = collections.defaultdict(list)
+        # instances removed from the cache and waiting to be disposed
+        self.disposing = collections.defaultdict(int)
+        self.memory_tracker = MemoryTracker()
         # routing groups from Locator service
         self.current_rg = {}
-
-        self.logger = logging.getLogger("cocaine.proxy.general")
-        self.access_log = logging.getLogger("cocaine.proxy.access")
-        self.access_log.propagate = False
         self.logger.info("locators %s",
                          ','.join("%s:%d" % (h, p) for h, p in self.locator_endpoints))
 
         self.sticky_header = sticky_header
+        # Server-Timing header is added to the responses of sampled requests
+        self.server_timing = server_timing
         self.mapped_headers = mapped_headers
         self.logger.info("mapping headers - %s", str(self.mapped_headers))
 
@@ -317,7 +460,10 @@ class CocaineProxy(object):
                 self.plugins.append(load_plugin(name, self, cfg))
 
         if allow_json_rpc:
-            self.plugins.append(load_plugin('cocaine.proxy.jsonrpc.JSONRPC', self, {}))
+            self.plugins.append(load_plugin('cocaine.proxy.jsonrpc.JSONRPC', self,
+                                            {"batch_concurrency": jsonrpc_batch_concurrency,
+                                             "max_batch_size": jsonrpc_max_batch_size}))
+        self.plugin_index = PluginIndex(self.plugins)
 
         self.logger.info("conf path in `%s` configuration service: %s",
                          configuration_service, tracing_conf_path)
@@ -331,14 +477,29 @@ class CocaineProxy(object):
             self.logger.info("using authenticated unicorn access")
             self.unicorn = repo.create_secure_service(configuration_service)
         self.sampled_apps = {}
+        # names of applications being watched for sampling updates
+        self.sampling_watchers = set()
         self.default_tracing_chance = default_tracing_chance
+        # the chance is an upper bound, a spike of an application traffic
+        # must not turn into the same spike of verbose logging
+        self.tracing_limiter = RateLimiter(tracing_rate)
         self.tracing_conf_path = tracing_conf_path
 
+        self.timeouts_conf_path = timeouts_conf_path
+        self.timeouts = {}
+        # names of applications being watched for timeouts updates
+        self.timeouts_watchers = set()
+
+        # the last known state is served until
+        # the subscriptions deliver the actual one
+        self.snapshot_path = snapshot_path
+        self.snapshot_scheduled = False
+        if self.snapshot_path:
+            self.restore_snapshot()
+
         self.io_loop.add_future(self.on_sampling_updates(),
                                 lambda x: self.logger.error("the sample updater must not exit"))
 
-        self.timeouts_conf_path = timeouts_conf_path
-        self.timeouts = {}
         self.io_loop.add_future(self.on_timeouts_updates(),
                                 lambda x: self.logger.error("the timeouts updater must not exit"))
 
@@ -348,11 +509,17 @@ class CocaineProxy(object):
         else:
             self.get_request_id = generate_request_id
 
-        # post the watcher for routing groups
-        self.io_loop.add_future(self.on_routing_groups_update(),
-                                lambda x: self.logger.error("the updater must not exit"))
-        # run infinity check locator health status
-        self.locator_health_check()
+        if self.shared_state is None or self.shared_state.is_leader():
+            # post the watcher for routing groups
+            self.io_loop.add_future(self.on_routing_groups_update(),
+                                    lambda x: self.logger.error("the updater must not exit"))
+            # run infinity check locator health status
+            self.locator_health_check()
+        else:
+            self.logger.info("routing groups and locator status are received from the leader process")
+            tornado.ioloop.PeriodicCallback(self.sync_shared_routing,
+                                            SHARED_SYNC_PERIOD * 1000,
+                                            io_loop=self.io_loop).start()
 
     @gen.coroutine
     def locator_health_check(self, period=5):
@@ -362,14 +529,77 @@ class CocaineProxy(object):
                 self.logger.debug("check health status of locator via cluster method")
                 channel = yield gen.with_timeout(wait_timeot, self.locator.cluster())
                 cluster = yield gen.with_timeout(wait_timeot, channel.rx.get())
-                self.locator_status = True
+                self.set_locator_status(True)
                 self.logger.debug("dumped cluster %s", cluster)
                 yield gen.sleep(period)
             except Exception as err:
                 self.logger.error("health status check failed: %s", err)
-                self.locator_status = False
+                self.set_locator_status(False)
                 yield gen.sleep(1)
 
+    def set_locator_status(self, status):
+        if self.locator_status != status:
+            self.locator_status = status
+            self.publish_shared_routing()
+
+    def publish_shared_routing(self):
+        if self.shared_state is None:
+            return
+
+        try:
+            self.shared_state.routing.publish({"routing": self.current_rg,
+                                               "locator_status": self.locator_status})
+        except Exception as err:
+            self.logger.error("unable to publish routing groups: %s", err)
+
+    def sync_shared_routing(self):
+        generation = self.shared_state.routing.generation()
+        if generation == self.shared_routing_generation:
+            return
+
+        state = self.shared_state.routing.read()
+        if state is None:
+            return
+
+        self.shared_routing_generation = generation
+        self.locator_status = state["locator_status"]
+        self.update_routing_groups(state["routing"])
+
+    def update_routing_groups(self, new):
+        updates = scan_for_updates(self.current_rg, new)
+        # replace current
+        self.current_rg = new
+        self.schedule_snapshot()
+        if len(updates) == 0:
+            self.logger.info("locator sends an update message, "
+                             "but no updates have been found")
+            return
+
+        self.logger.info("%d routing groups have been refreshed %s",
+                         len(updates), updates)
+        for group in updates:
+            self.invalidate_resolve(group, routing=True)
+            # if we have not created an instance of
+            # the group it is absent in cache
+            if group not in self.cache:
+                self.logger.debug("nothing to update in group %s", group)
+                continue
+
+            for app in self.cache[group]:
+                self.logger.debug("%s: move %s to the inactive queue to refresh"
+                                  " routing group", app.id, app.name)
+                self.migrate_from_cache_to_inactive(app, group)
+
+    def invalidate_resolve(self, name, routing=False):
+        if self.shared_state is None:
+            return
+
+        try:
+            # every process gets the routing updates, only the leader drops the shared entry
+            self.locator.invalidate(name, shared=not routing or self.shared_state.is_leader())
+        except Exception as err:
+            self.logger.error("unable to invalidate shared resolve result of %s: %s", name, err)
+
     @gen.coroutine
     def on_routing_groups_update(self):
         uid = gen_uid()
@@ -377,7 +607,8 @@ class CocaineProxy(object):
         maximum_timeout = 32  # sec
         timeout = 1  # sec
         while True:
-            self.current_rg = {}
+            delivered = False
+            failure = None
             try:
                 self.logger.info("subscribe to updates with id %s", uid)
                 channel = yield self.locator.routing(uid, True)
@@ -388,37 +619,71 @@ class CocaineProxy(object):
                         # it means that the cocaine has been stopped
                         self.logger.error("locator sends close")
                         break
-                    updates = scan_for_updates(self.current_rg, new)
-                    # replace current
-                    self.current_rg = new
-                    if len(updates) == 0:
-                        self.logger.info("locator sends an update message, "
-                                         "but no updates have been found")
-                        continue
-
-                    self.logger.info("%d routing groups have been refreshed %s",
-                                     len(updates), updates)
-                    for group in updates:
-                        # if we have not created an instance of
-                        # the group it is absent in cache
-                        if group not in self.cache:
-                            self.logger.debug("nothing to update in group %s", group)
-                            continue
-
-                        for app in self.cache[group]:
-                            self.logger.debug("%s: move %s to the inactive queue to refresh"
-                                              " routing group", app.id, app.name)
-                            self.migrate_from_cache_to_inactive(app, group)
+                    delivered = True
+                    self.update_routing_groups(new)
+                    self.publish_shared_routing()
             except Exception as err:
+                failure = err
+
+            if delivered:
+                # the subscription has been lost, so the current groups can not be trusted.
+                # The restored snapshot is kept until the first subscription replies
+                self.current_rg = {}
+                self.publish_shared_routing()
+
+            if failure is not None:
                 timeout = min(timeout << 1, maximum_timeout)
                 self.logger.error("error occurred while watching for group updates %s. Sleep %d",
-                                  err, timeout)
+                                  failure, timeout)
                 yield gen.sleep(timeout)
 
+    def restore_snapshot(self):
+        try:
+            snapshot = load_snapshot(self.snapshot_path)
+            if snapshot.get("version") != SNAPSHOT_VERSION:
+                raise ValueError("unsupported version %s" % snapshot.get("version"))
+            self.current_rg = snapshot["routing"]
+            self.timeouts = snapshot["timeouts"]
+            self.sampled_apps = snapshot["sampling"]
+        except Exception as err:
+            self.logger.error("unable to restore the snapshot from %s: %s", self.snapshot_path, err)
+        else:
+            self.logger.info("the snapshot from %s has been restored: %d routing groups, "
+                             "%d timeouts, %d sampling values", self.snapshot_path,
+                             len(self.current_rg), len(self.timeouts), len(self.sampled_apps))
+            self.publish_shared_routing()
+
+    def schedule_snapshot(self):
+        if not self.snapshot_path or self.snapshot_scheduled:
+            return
+
+        # all the forks have the same state, the only one writes it
+        if self.shared_state is not None and not self.shared_state.is_leader():
+            return
+
+        self.snapshot_scheduled = True
+        self.io_loop.call_later(SNAPSHOT_DELAY, self.save_snapshot)
+
+    def save_snapshot(self):
+        self.snapshot_scheduled = False
+        snapshot = {
+            "version": SNAPSHOT_VERSION,
+            "timestamp": time.time(),
+            "routing": self.current_rg,
+            "timeouts": self.timeouts,
+            "sampling": self.sampled_apps,
+        }
+        try:
+            dump_snapshot(self.snapshot_path, snapshot)
+        except Exception as err:
+            self.logger.error("unable to save the snapshot to %s: %s", self.snapshot_path, err)
+
     @gen.coroutine
     def watch_app(self, name, path):
         version = 0
-        self.sampled_apps[name] = self.default_tracing_chance
+        self.sampling_watchers.add(name)
+        # keep the restored value till the first update
+        self.sampled_apps.setdefault(name, self.default_tracing_chance)
         try:
             self.logger.info("start watching for sampling updates of %s", name)
             watch_channel = yield self.unicorn.subscribe(path, version)
@@ -432,6 +697,7 @@ class CocaineProxy(object):
                     self.logger.error("sample value %s for %s can NOT be converted: %s. Use %f",
                                       value, name, err, self.default_tracing_chance)
                     self.sampled_apps[name] = self.default_tracing_chance
+                self.schedule_snapshot()
         except ServiceError as err:
             # verify that the err is `zookeeper: no node [-101]``
             if err.code != -101:
@@ -440,7 +706,9 @@ class CocaineProxy(object):
             self.logger.error("watching of %s error: %s", name, err)
         finally:
             self.logger.info("stop watching for sampling updates of %s", name)
+            self.sampling_watchers.discard(name)
             self.sampled_apps.pop(name, None)
+            self.schedule_snapshot()
             try:
                 watch_channel.tx.close()
             except Exception:
@@ -458,8 +726,9 @@ class CocaineProxy(object):
                 while True:
                     listing_version, apps = yield listing_channel.rx.get()
                     self.logger.info("on_sampling_updates: version %d value %s", listing_version, apps)
-                    for app in (i for i in apps if i not in self.sampled_apps):
+                    for app in (i for i in apps if i not in self.sampling_watchers):
                         self.watch_app(app, self.tracing_conf_path + "/" + app)
+                    drop_unwatched(self.sampled_apps, self.sampling_watchers)
             except Exception as err:
                 timeout = min(timeout << 1, maximum_timeout)
                 listing_version = 0
@@ -470,7 +739,9 @@ class CocaineProxy(object):
     @gen.coroutine
     def watch_app_timeouts(self, name, path):
         version = 0
-        self.timeouts[name] = {}
+        self.timeouts_watchers.add(name)
+        # keep the restored value till the first update
+        self.timeouts.setdefault(name, {})
         try:
             self.logger.info("start watching for timeouts updates of %s", name)
             watch_channel = yield self.unicorn.subscribe(path, version)
@@ -482,6 +753,7 @@ class CocaineProxy(object):
                 else:
                     self.logger.error("timeout value %s for %s is not dict", value, name)
                     self.timeouts[name] = {}
+                self.schedule_snapshot()
         except ServiceError as err:
             # verify that the err is `zookeeper: no node [-101]``
             if err.code != -101:
@@ -490,7 +762,9 @@ class CocaineProxy(object):
             self.logger.error("watching of %s error: %s", name, err)
         finally:
             self.logger.info("stop watching for timeouts updates of %s", name)
+            self.timeouts_watchers.discard(name)
             self.timeouts.pop(name, None)
+            self.schedule_snapshot()
             try:
                 watch_channel.tx.close()
             except Exception:
@@ -508,8 +782,9 @@ class CocaineProxy(object):
                 while True:
                     listing_version, apps = yield listing_channel.rx.get()
                     self.logger.info("on_timeouts_updates: version %d value %s", listing_version, apps)
-                    for app in (i for i in apps if i not in self.timeouts):
+                    for app in (i for i in apps if i not in self.timeouts_watchers):
                         self.watch_app_timeouts(app, self.timeouts_conf_path + "/" + app)
+                    drop_unwatched(self.timeouts, self.timeouts_watchers)
             except Exception as err:
                 timeout = min(timeout << 1, maximum_timeout)
                 listing_version = 0
@@ -532,6 +807,7 @@ class CocaineProxy(object):
 
         # dispose service after 3 x timeouts
         # assume that all requests will be finished
+        self.disposing[name] += 1
         self.io_loop.call_later(self.get_timeout(name) * 3,
                                 functools.partial(self.dispose, app, name))
         self.logger.info("app %s %s is scheduled to dispose", app, name)
@@ -567,6 +843,9 @@ class CocaineProxy(object):
 
     def dispose(self, app, name):
         self.logger.info("dispose service %s %s", name, app.id)
+        self.disposing[name] -= 1
+        if self.disposing[name] <= 0:
+            del self.disposing[name]
         app.disconnect()
 
     def resolve_group_to_version(self, name, value=None):
@@ -604,15 +883,28 @@ class CocaineProxy(object):
                 request.logger.info('stop tracing the request')
                 request.logger = NULLLOGGER
                 request.tracebit = False
+            elif not self.tracing_limiter.allow(name):
+                request.logger.info('stop tracing the request: rate limit has been exceeded')
+                self.metrics.incr("cocaine_proxy_tracing_limited_total", (name,))
+                request.logger = NULLLOGGER
+                request.tracebit = False
         else:
             request.tracebit = False
 
     @context
     @gen.coroutine
     def __call__(self, request):
-        for plugin in self.plugins:
-            if plugin.match(request):
+        for plugin in self.plugin_index.candidates(request.headers):
+            start = time.time()
+            matched = plugin.match(request)
+            self.metrics.observe("cocaine_proxy_plugin_match_seconds", (plugin.name(),),
+                                 1000.0 * (time.time() - start))
+            self.metrics.incr("cocaine_proxy_plugin_matches_total", (plugin.name(), "true" if matched else "false"))
+            if matched:
+                request.plugin = plugin.name()
+                mark_stage(request, "dispatch")
                 request.logger.info('processed by %s plugin', plugin.name())
+                self.metrics.incr("cocaine_proxy_plugin_requests_total", (plugin.name(),))
                 try:
                     yield plugin.process(request)
                 except PluginNoSuchApplication as err:
@@ -655,7 +947,10 @@ class CocaineProxy(object):
             request.logger.info('sticky_header has been found: name %s, value %s, seed %d', name, seed, seed_value)
             name = self.resolve_group_to_version(name, seed_value)
 
+        request.server_timing = self.server_timing and request.tracebit
+        mark_stage(request, "dispatch")
         app = yield self.get_service(name, request)
+        mark_stage(request, "connect")
 
         if app is None:
             message = "current application %s is unavailable" % name
@@ -674,12 +969,202 @@ class CocaineProxy(object):
 
         request.logger.info("exit from process")
 
+    def on_request_finished(self, request):
+        code = getattr(request, "response_code", None)
+        if code is None:
+            return
+
+        app = getattr(request, "app_name", None) or request.headers.get("X-Cocaine-Service")
+        self.metrics.incr("cocaine_proxy_requests_total", (app or "", code))
+        event = getattr(request, "event_name", None) or request.headers.get("X-Cocaine-Event", "")
+        if self.binary_access_log is not None:
+            self.write_binary_access_log(request, app, event, code)
+        if not app:
+            return
+
+        headers_time = getattr(request, "headers_time", None)
+        self.latency.record(app, event, code, 1000.0 * request.response_time,
+                            None if headers_time is None else 1000.0 * headers_time)
+
+    def write_binary_access_log(self, request, app, event, code):
+        try:
+            self.binary_access_log.write([
+                int(time.time() * 1000000),
+                request.traceid,
+                app or "",
+                event,
+                code,
+                len(request.body or ""),
+                getattr(request, "response_size", 0),
+                int(request.response_time * 1000000),
+                dict((stage, int(duration * 1000000)) for stage, duration in stage_durations(request)),
+                request.method,
+                # it's without /app/event prefix if it has been dispatched by uri
+                request.uri,
+                request.headers.get(self.sticky_header),
+                getattr(request, "plugin", None),
+                dict((name, request.headers[name]) for name in self.plugin_index.headers if name in request.headers),
+                "Authorization" in request.headers,
+            ])
+        except Exception as err:
+            self.logger.error("unable to write the binary access log: %s", err)
+
+    def flush_binary_access_log(self):
+        try:
+            self.binary_access_log.flush()
+        except Exception as err:
+            self.logger.error("unable to flush the binary access log: %s", err)
+
+    def on_loop_lag(self, lag):
+        self.metrics.observe("cocaine_proxy_loop_lag_seconds", (), 1000.0 * lag)
+
+    def publish_board(self):
+        self.update_pool_metrics()
+        self.update_logging_metrics()
+        try:
+            self.board.publish({"latency": self.latency.dump(),
+                                "metrics": self.metrics.dump()})
+        except Exception as err:
+            self.logger.error("unable to publish the worker board: %s", err)
+
+    def update_pool_metrics(self):
+        self.metrics.reset("cocaine_proxy_pool_size")
+        for name, apps in self.cache.iteritems():
+            self.metrics.set("cocaine_proxy_pool_size", (name,), len(apps))
+
+    def update_logging_metrics(self):
+        for logger in (self.logger, self.access_log):
+            dropped = sum(h.dropped for h in logger.handlers if isinstance(h, AsyncHandler))
+            self.metrics.set("cocaine_proxy_log_records_dropped_total", (logger.name,), dropped)
+
+    def render_metrics(self):
+        self.update_pool_metrics()
+        self.update_logging_metrics()
+        dumps = [(self.stats.row, self.metrics.dump())]
+        for row, published in self.board.read_others():
+            if published is not None:
+                dumps.append((row, published["metrics"]))
+
+        for row in xrange(self.stats.rows):
+            values = self.stats.row_values(row)
+            dumps.append((row, {
+                "cocaine_proxy_requests_in_progress": [[[], values["requests_in_progress"]]],
+                "cocaine_proxy_disconnections_total": [[[], values["requests_disconnections"]]],
+            }))
+        return self.metrics.render(dumps)
+
+    @gen.coroutine
+    def poll_profile(self):
+        session = self.profiler.pending()
+        if session is None:
+            return
+
+        sampler = SamplingProfiler(session["interval"])
+        try:
+            sampler.start()
+        except ProfilerBusy as err:
+            self.logger.error("unable to start profiling session %d: %s", session["id"], err)
+            return
+
+        self.logger.info("profiling session %d has been started for %ss", session["id"], session["seconds"])
+        try:
+            yield gen.sleep(session["seconds"])
+        finally:
+            counts = sampler.stop()
+        self.profiler.publish(session["id"], counts, sampler.samples)
+
+    @gen.coroutine
+    def profile(self, seconds, workers=None, interval=DEFAULT_SAMPLING_INTERVAL):
+        session = self.profiler.request(seconds, workers, interval)
+        # the own worker does not wait for the next poll
+        self.poll_profile()
+
+        deadline = self.io_loop.time() + seconds + PROFILE_COLLECT_TIMEOUT
+        while True:
+            yield gen.sleep(PROFILE_POLL_PERIOD)
+            collected = self.profiler.collect(session)
+            if len(collected) == len(session["workers"]) or self.io_loop.time() > deadline:
+                break
+
+        raise gen.Return({"id": session["id"],
+                          "workers": sorted(collected),
+                          "missing": [i for i in session["workers"] if i not in collected],
+                          "samples": sum(i["samples"] for i in collected.itervalues()),
+                          "stacks": merge_stacks(collected.itervalues())})
+
+    def structure_sizes(self):
+        return {"cache": sum(len(apps) for apps in self.cache.itervalues()),
+                "cache_apps": len(self.cache),
+                "disposing": sum(self.disposing.itervalues()),
+                "current_rg": len(self.current_rg),
+                "timeouts": len(self.timeouts),
+                "timeouts_watchers": len(self.timeouts_watchers),
+                "sampled_apps": len(self.sampled_apps),
+                "sampling_watchers": len(self.sampling_watchers),
+                "latency_series": len(self.latency.series),
+                "ioloop_timeouts": len(getattr(self.io_loop, "_timeouts", ())),
+                "ioloop_callbacks": len(getattr(self.io_loop, "_callbacks", ())),
+                "ioloop_handlers": len(getattr(self.io_loop, "_handlers", ()))}
+
+    def connection_counts(self):
+        result = {}
+        for name in set(self.cache) | set(self.disposing):
+            apps = self.cache.get(name, ())
+            result[name] = {"active": len(apps),
+                            "connected": sum(1 for app in apps if app._connected),
+                            "sessions": sum(len(app.sessions) for app in apps),
+                            "disposing": self.disposing.get(name, 0)}
+        return result
+
+    def memory_info(self, top=DEFAULT_TOP_TYPES):
+        sections = {"objects": count_objects(),
+                    "structures": self.structure_sizes(),
+                    "timeouts": count_timeouts(self.io_loop)}
+        diff = self.memory_tracker.snapshot(sections, time.time(), top)
+        return {"worker": self.stats.row,
+                "process": process_memory(),
+                "gc": gc_stats(),
+                "objects": top_counts(sections["objects"], top),
+                "structures": sections["structures"],
+                "timeouts": sections["timeouts"],
+                "connections": self.connection_counts(),
+                "diff": diff}
+
+    def latency_summary(self, app=None):
+        merged = LatencyHistograms()
+        merged.merge(self.latency)
+        for _, published in self.board.read_others():
+            if published is not None:
+                merged.merge(LatencyHistograms.load(published["latency"]))
+        return merged.summary(app)
+
+    def update_stats(self):
+        self.stats.set("services", sum(len(apps) for apps in self.cache.itervalues()))
+
     def info(self):
-        return {'services': {'cache': dict(((k, len(v)) for k, v in self.cache.items()))},
-                'requests': {'inprogress': self.requests_in_progress,
-                             'total': self.requests_total},
-                'errors': {'disconnections': self.requests_disconnections},
-                'sampling': self.sampled_apps}
+        self.update_stats()
+        totals = self.stats.totals()
+        workers = []
+        for row in xrange(self.stats.rows):
+            values = self.stats.row_values(row)
+            workers.append({'id': row,
+                            'pid': values['pid'],
+                            'services': values['services'],
+                            'requests': {'inprogress': values['requests_in_progress'],
+                                         'total': values['requests_total']},
+                            'errors': {'disconnections': values['requests_disconnections']}})
+
+        return {'services': {'cache': dict(((k, len(v)) for k, v in self.cache.items())),
+                             'total': totals['services']},
+                'requests': {'inprogress': totals['requests_in_progress'],
+                             'total': totals['requests_total']},
+                'errors': {'disconnections': totals['requests_disconnections']},
+                'worker': self.stats.row,
+                'workers': workers,
+                'sampling': self.sampled_apps,
+                'json': codec.info(),
+                'shared': {'enabled': self.shared_state is not None,
+                           'routing_generation': self.shared_state.routing.generation() if self.shared_state else 0}}
 
     @gen.coroutine
     def reelect_app(self, request, app):
@@ -716,6 +1201,8 @@ class CocaineProxy(object):
             timeout = self.get_timeout(name, event)
         request.logger.info("start processing event `%s` for an app `%s` (appid: %s) after %.3f ms with timeout %f",
                             event, app.name, app.id, request.request_time() * 1000, timeout)
+        request.app_name = name
+        request.event_name = event
         parentid = 0
 
         if request.traceid is not None:
@@ -755,12 +1242,16 @@ class CocaineProxy(object):
             try:
                 request.logger.debug("%s: enqueue event (attempt %d)", app.id, attempts)
                 channel = yield app.enqueue(event, trace=trace, **headers)
+                mark_stage(request, "enqueue")
                 request.logger.debug("%s: send event data (attempt %d)", app.id, attempts)
                 yield channel.tx.write(msgpack.packb(data), trace=trace)
                 yield channel.tx.close(trace=trace)
+                mark_stage(request, "write")
                 request.logger.debug("%s: waiting for a code and headers (attempt %d)",
                                      app.id, attempts)
                 code_and_headers = yield channel.rx.get(timeout=timeout)
+                request.headers_time = request.request_time()
+                mark_stage(request, "headers")
                 request.logger.debug("%s: code and headers have been received (attempt %d)",
                                      app.id, attempts)
                 code, raw_headers = msgpack.unpackb(code_and_headers)
@@ -786,6 +1277,7 @@ class CocaineProxy(object):
                     body = yield channel.rx.get(timeout=timeout)
                     if stop_condition(body):
                         request.logger.info("%s: body finished (attempt %d)", app.id, attempts)
+                        mark_stage(request, "body")
                         break
 
                     request.logger.debug("%s: received %d bytes as a body chunk (attempt %d)",
@@ -797,7 +1289,7 @@ class CocaineProxy(object):
                 on_error(app, err, '', httplib.GATEWAY_TIMEOUT)
 
             except (DisconnectionError, StreamClosedError) as err:
-                self.requests_disconnections += 1
+                self.stats.incr("requests_disconnections")
                 # Probably it's dangerous to retry requests all the time.
                 # I must find the way to determine whether it failed during writing
                 # or reading a reply. And retry only writing fails.
@@ -805,6 +1297,8 @@ class CocaineProxy(object):
                 if not check_attempts(app, err):
                     return
 
+                self.metrics.incr("cocaine_proxy_retries_total", (name, "disconnection"))
+
                 # Seems on_close callback is not called in case of connecting through IPVS
                 # We detect disconnection here to avoid unnecessary errors.
                 # Try to reconnect here and give the request a go
@@ -812,11 +1306,14 @@ class CocaineProxy(object):
                     start_time = time.time()
                     reconn_timeout = timeout - request.request_time()
                     request.logger.info("%s: connecting with timeout %.fms", app.id, reconn_timeout * 1000)
+                    self.metrics.incr("cocaine_proxy_reconnects_total", (name,))
                     yield gen.with_timeout(start_time + reconn_timeout, app.connect(request.traceid))
                     reconn_time = time.time() - start_time
                     request.logger.info("%s: connecting took %.3fms", app.id, reconn_time * 1000)
                 except Exception as err:
                     request.logger.error("%s: unable to reconnect: %s (%d attempts left)", err, attempts)
+                    self.invalidate_resolve(app.name)
+                mark_stage(request, "reconnect")
                 # We have an attempt to process request again.
                 # Jump to the begining of `while attempts > 0`, either we connected successfully
                 # or we were failed to connect
@@ -830,16 +1327,20 @@ class CocaineProxy(object):
                 # and system category
                 if err.category in SYSTEMCATEGORY and err.code == EAPPSTOPPED:
                     request.logger.error("%s: the application has been restarted", app.id)
+                    self.metrics.incr("cocaine_proxy_retries_total", (name, "restarted"))
                     app.disconnect()
                     continue
 
                 elif err.category in OVERSEERCATEGORY and err.code == EQUEUEISFULL:
                     request.logger.error("%s: queue is full. Pick another application instance", app.id)
+                    self.metrics.incr("cocaine_proxy_queue_full_total", (name,))
+                    self.metrics.incr("cocaine_proxy_retries_total", (name, "queue_full"))
                     try:
                         app = yield reelect_app_fn(request, app)
                     except Exception as reelect_err:
                         on_error(app, reelect_err, '(could not reelect app)')
                         return
+                    mark_stage(request, "reelect")
                     request.logger.info("fetched new app from reelect_app_fn")
                     continue
 
@@ -874,6 +1375,7 @@ class CocaineProxy(object):
             except Exception as err:
                 logger.error("%s: unable to connect to `%s`: %s", app.id, name, err)
                 drop_app_from_cache(self.cache, app, name)
+                self.invalidate_resolve(name)
                 raise gen.Return()
             else:
                 raise gen.Return(app)
@@ -900,9 +1402,16 @@ def enable_logging(options):
         cocainelogger = logging.getLogger("cocaine.baseservice")
         cocainelogger.setLevel(getattr(logging, options.logging.upper()))
 
+    def make_async(handler, io_loop=None):
+        # formatting and writing are moved to a thread
+        if options.log_queue_size <= 0:
+            return handler
+        return AsyncHandler(handler, options.log_queue_size, io_loop)
+
     if options.log_to_cocaine:
         Logger().target = "tornado-proxy"
-        handler = CocaineHandler()
+        # the cocaine logger is not thread-safe, so records are sent from the event loop
+        handler = make_async(CocaineHandler(), tornado.ioloop.IOLoop.current())
         general_logger.addHandler(handler)
         if cocainelogger:
             cocainelogger.addHandler(handler)
@@ -914,24 +1423,25 @@ def enable_logging(options):
             filename=options.log_file_prefix,
         )
         handler.setFormatter(general_formatter)
-        general_logger.addHandler(handler)
+        general_logger.addHandler(make_async(handler))
 
         handler = logging.handlers.WatchedFileHandler(
             filename=options.log_file_prefix,
         )
         handler.setFormatter(access_formatter)
-        access_logger.addHandler(handler)
+        access_logger.addHandler(make_async(handler))
 
         if cocainelogger:
             cocainehandler = logging.handlers.WatchedFileHandler(
                 filename=options.log_file_prefix + "framework.log"
             )
             cocainehandler.setFormatter(general_formatter)
-            cocainelogger.addHandler(cocainehandler)
+            cocainelogger.addHandler(make_async(cocainehandler))
 
     if options.log_to_stderr or (options.log_to_stderr is None and not general_logger.handlers):
         stderr_handler = logging.StreamHandler()
         stderr_handler.setFormatter(general_formatter)
+        stderr_handler = make_async(stderr_handler)
 
         general_logger.addHandler(stderr_handler)
         if cocainelogger:
@@ -939,7 +1449,7 @@ def enable_logging(options):
 
         stderr_handler = logging.StreamHandler()
         stderr_handler.setFormatter(access_formatter)
-        access_logger.addHandler(stderr_handler)
+        access_logger.addHandler(make_async(stderr_handler))
 
 
 def enable_gc_stats():
@@ -977,12 +1487,37 @@ def main():
     opts.define("gcstats", default=False, type=bool, help="print garbage collector stats to stderr")
     opts.define("srwconfig", default="", type=str, help="path to srwconfig")
     opts.define("allow_json_rpc", default=True, type=bool, help="allow JSON RPC module")
+    opts.define("json_codec", default=codec.AUTO, type=str,
+                help="JSON codec of JSON RPC and MDS plugins: auto, simplejson, json or ujson, "
+                     "which is never picked by auto as its old versions print floats with 15 digits")
+    opts.define("jsonrpc_batch_concurrency", default=DEFAULT_BATCH_CONCURRENCY, type=int,
+                help="entries of a JSON RPC batch dispatched concurrently")
+    opts.define("jsonrpc_max_batch_size", default=DEFAULT_MAX_BATCH_SIZE, type=int,
+                help="entries of a JSON RPC batch, larger batches are rejected")
     opts.define("mapped_headers", default=[], type=str, multiple=True,
                 help="pass specified headers as cocaine headers")
+    opts.define("shared_locator", default=True, type=bool,
+                help="share routing groups and resolve results between tornado processes")
+    opts.define("resolve_cache_ttl", default=DEFAULT_RESOLVE_CACHE_TTL, type=int,
+                help="seconds to keep a shared resolve result")
+    opts.define("snapshot_path", default="", type=str,
+                help="path to a file to save routing groups, timeouts and sampling to and restore them at start")
+    opts.define("access_log_binary", default="", type=str,
+                help="path to a binary access log, a worker id is appended for forked processes")
+    opts.define("access_log_binary_max_size", default=DEFAULT_MAX_SIZE >> 20, type=int,
+                help="size of the binary access log in MB to rotate it")
+    opts.define("access_log_binary_backups", default=DEFAULT_BACKUP_COUNT, type=int,
+                help="count of rotated binary access logs to keep")
+    opts.define("server_timing", default=False, type=bool,
+                help="add Server-Timing header with the stages of processing to sampled requests")
+    opts.define("loop_watchdog_ms", default=0, type=int,
+                help="log the stack of the event loop blocked longer than that, 0 disables the watchdog")
 
     # tracing options
     opts.define("tracing_chance", default=DEFAULT_TRACING_CHANCE,
                 type=float, help="default chance for an app to be traced")
+    opts.define("tracing_rate", default=DEFAULT_TRACING_RATE, type=float,
+                help="max traced requests per second for an app in a process, 0 disables the limit")
     opts.define("configuration_service", default="unicorn",
                 type=str, help="name of configuration service")
     opts.define("tracing_conf_path", default="/zipkin_sampling",
@@ -993,6 +1528,8 @@ def main():
                 help=("Set the Python log level. If 'none', tornado won't touch the "
                       "logging configuration."), metavar="debug|info|warning|error|none")
     opts.define("log_to_cocaine", default=False, type=bool, help="log to cocaine")
+    opts.define("log_queue_size", default=DEFAULT_LOG_QUEUE_SIZE, type=int,
+                help="records queued to be written by a thread, extra ones are dropped. 0 writes synchronously")
     opts.define("log_to_stderr", type=bool, default=None,
                 help=("Send log output to stderr. "
                       "By default use stderr if --log_file_prefix is not set and "
@@ -1023,6 +1560,12 @@ def main():
             print("unable to load SRW config: %s" % err)
             exit(1)
 
+    try:
+        codec.select(opts.json_codec)
+    except ValueError as err:
+        print(err)
+        exit(1)
+
     use_reuseport = hasattr(socket, "SO_REUSEPORT")
     endpoints = Endpoints(opts.endpoints)
     sockets = []
@@ -1039,6 +1582,16 @@ def main():
     if opts.enableutil:
         utilsockets = bind_sockets(opts.utilport, address=opts.utiladdress)
 
+    count = opts.count if opts.count > 0 else process.cpu_count()
+    stats = SharedCounters(WORKER_STATS, rows=count)
+    board = SharedBoard(rows=count)
+    profiler = ProfilerControl(rows=count)
+
+    shared_state = None
+    if opts.count != 1 and opts.shared_locator:
+        # shared memory has to be mapped before fork
+        shared_state = SharedState(resolve_ttl=opts.resolve_cache_ttl)
+
     try:
         if opts.count != 1:
             process.fork_processes(opts.count)
@@ -1059,11 +1612,24 @@ def main():
                              sticky_header=opts.sticky_header,
                              forcegen_request_header=opts.forcegen_request_header,
                              default_tracing_chance=opts.tracing_chance,
+                             tracing_rate=opts.tracing_rate,
                              srw_config=srw_config,
                              allow_json_rpc=opts.allow_json_rpc,
+                             jsonrpc_batch_concurrency=opts.jsonrpc_batch_concurrency,
+                             jsonrpc_max_batch_size=opts.jsonrpc_max_batch_size,
                              client_id=opts.client_id,
                              client_secret=opts.client_secret,
-                             mapped_headers=opts.mapped_headers)
+                             mapped_headers=opts.mapped_headers,
+                             shared_state=shared_state,
+                             snapshot_path=opts.snapshot_path,
+                             stats=stats,
+                             board=board,
+                             profiler=profiler,
+                             loop_watchdog_ms=opts.loop_watchdog_ms,
+                             server_timing=opts.server_timing,
+                             binary_access_log=opts.access_log_binary,
+                             binary_access_log_max_size=opts.access_log_binary_max_size << 20,
+                             binary_access_log_backups=opts.access_log_binary_backups)
         server = HTTPServer(proxy)
         server.add_sockets(sockets)
 
@@ -0,0 +1,334 @@
+import collections
+import ctypes
+import errno
+import mmap
+import multiprocessing
+import os
+import struct
+import time
+
+import msgpack
+from tornado import gen
+from tornado import process
+from tornado.concurrent import Future
+
+
+DEFAULT_SHARED_STORE_SIZE = 16 << 20  # bytes
+DEFAULT_RESOLVE_CACHE_TTL = 10  # sec
+DEFAULT_BOARD_SLOT_SIZE = 4 << 20  # bytes
+
+# generation counter and payload length
+_HEADER = struct.Struct("=QQ")
+_GENERATION = struct.Struct("=Q")
+
+
+class SharedStoreOverflow(Exception):
+    pass
+
+
+class SharedStoreBusy(Exception):
+    pass
+
+
+class SharedStore(object):
+    """Memory-mapped msgpack blob shared between forked processes
+
+    The store must be created before fork. Readers never lock: the generation counter
+    is odd while a write is in progress, so a reader retries if it observes an odd or
+    changed generation. A store written by a single process takes no lock at all.
+    Otherwise writers are serialized by a process-shared lock, which is never waited
+    for: SharedStoreBusy is raised if it's held. The pid of the holder is kept next to
+    the lock, so the lock of a writer killed in the middle of an update is taken over
+    by the next writer instead of being held forever.
+    """
+
+    def __init__(self, size=DEFAULT_SHARED_STORE_SIZE, single_writer=False):
+        self.size = size
+        # anonymous mapping is MAP_SHARED, so children inherit the same pages
+        self._mm = mmap.mmap(-1, size)
+        self._lock = None if single_writer else multiprocessing.Lock()
+        if self._lock is not None:
+            # 0 while the lock is free or is being handed over
+            self._owner = multiprocessing.RawValue(ctypes.c_long, 0)
+            # serializes the takeovers, so only one writer inherits a dead owner's lock
+            self._takeover = multiprocessing.Lock()
+        # decoded copy of the last seen generation, it's per process
+        self._generation = 0
+        self._value = None
+
+    def generation(self):
+        return _GENERATION.unpack_from(self._mm, 0)[0]
+
+    def read(self, default=None, attempts=100):
+        for _ in xrange(attempts):
+            generation, length = _HEADER.unpack_from(self._mm, 0)
+            if generation == self._generation:
+                break
+
+            if generation & 1:
+                # a writer is in the middle of an update
+                continue
+
+            payload = self._mm[_HEADER.size:_HEADER.size + length]
+            if self.generation() != generation:
+                continue
+
+            self._value = msgpack.unpackb(payload)
+            self._generation = generation
+            break
+
+        return self._value if self._generation else default
+
+    def update(self, func, default=None):
+        """Atomically replaces the stored value with func(current value)"""
+        self._acquire()
+        try:
+            value = func(self.read(default))
+            self._publish(value)
+        finally:
+            self._release()
+        return value
+
+    def publish(self, value):
+        self._acquire()
+        try:
+            self._publish(value)
+        finally:
+            self._release()
+
+    def _acquire(self):
+        if self._lock is None:
+            return
+        if not self._lock.acquire(False) and not self._take_over():
+            raise SharedStoreBusy("the shared store is being updated by another process")
+        self._owner.value = os.getpid()
+
+    def _take_over(self):
+        """Returns True if the lock is acquired or inherited from a dead owner"""
+        if not self._takeover.acquire(False):
+            return False
+        try:
+            if self._lock.acquire(False):
+                return True
+            owner = self._owner.value
+            return owner != 0 and not _is_alive(owner)
+        finally:
+            self._takeover.release()
+
+    def _release(self):
+        if self._lock is not None:
+            self._owner.value = 0
+            self._lock.release()
+
+    def _publish(self, value):
+        payload = msgpack.packb(value)
+        if _HEADER.size + len(payload) > self.size:
+            raise SharedStoreOverflow("%d bytes do not fit into the shared store of %d bytes" %
+                                      (len(payload), self.size))
+
+        # a crashed writer could leave the counter odd
+        generation = self.generation() | 1
+        _GENERATION.pack_into(self._mm, 0, generation)
+        self._mm[_HEADER.size:_HEADER.size + len(payload)] = payload
+        _HEADER.pack_into(self._mm, 0, generation + 1, len(payload))
+
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as err:
+        return err.errno != errno.ESRCH
+    return True
+
+
+class SharedCounters(object):
+    """Table of integer counters in shared memory with a row per forked process
+
+    Every process increments only the cells of its own row,
+    so there is no need to lock anything.
+    """
+
+    def __init__(self, fields, rows=1):
+        self.fields = tuple(fields)
+        self.rows = rows
+        self._index = dict((field, i) for i, field in enumerate(self.fields))
+        # the memory comes from an anonymous shared mapping, it must be allocated before fork
+        self._array = multiprocessing.RawArray(ctypes.c_longlong, rows * len(self.fields))
+        self.row = 0
+        self._offset = 0
+
+    def select(self, row):
+        if not 0 <= row < self.rows:
+            raise ValueError("row %d is out of range [0, %d)" % (row, self.rows))
+        self.row = row
+        self._offset = row * len(self.fields)
+
+    def incr(self, field, value=1):
+        self._array[self._offset + self._index[field]] += value
+
+    def set(self, field, value):
+        self._array[self._offset + self._index[field]] = value
+
+    def get(self, field, row=None):
+        offset = self._offset if row is None else row * len(self.fields)
+        return self._array[offset + self._index[field]]
+
+    def row_values(self, row):
+        offset = row * len(self.fields)
+        return dict(zip(self.fields, self._array[offset:offset + len(self.fields)]))
+
+    def totals(self):
+        width = len(self.fields)
+        return dict((field, sum(self._array[i::width])) for i, field in enumerate(self.fields))
+
+
+class SharedBoard(object):
+    """Shared memory slots where every forked process publishes its own snapshot
+
+    It's used for data too big or too dynamic for SharedCounters,
+    i.e. histograms, which are published periodically out of the request path.
+    """
+
+    def __init__(self, rows=1, size=DEFAULT_BOARD_SLOT_SIZE):
+        self.slots = [SharedStore(size, single_writer=True) for _ in xrange(rows)]
+        self.row = 0
+
+    def select(self, row):
+        if not 0 <= row < len(self.slots):
+            raise ValueError("row %d is out of range [0, %d)" % (row, len(self.slots)))
+        self.row = row
+
+    def publish(self, value):
+        self.slots[self.row].publish(value)
+
+    def read_others(self):
+        return [(row, slot.read()) for row, slot in enumerate(self.slots) if row != self.row]
+
+
+_ResolvedChannel = collections.namedtuple("_ResolvedChannel", ["rx", "tx"])
+
+
+class _CachedRx(object):
+    def __init__(self, value):
+        self._value = value
+
+    def get(self, timeout=0, protocol=None):
+        future = Future()
+        future.set_result(self._value)
+        return future
+
+
+class _PublishingRx(object):
+    def __init__(self, cache, name, rx):
+        self._cache = cache
+        self._name = name
+        self._rx = rx
+
+    @gen.coroutine
+    def get(self, timeout=0, protocol=None):
+        value = yield self._rx.get(timeout=timeout)
+        self._cache.store(self._name, value)
+        raise gen.Return(value)
+
+
+class SharedLocator(object):
+    """Locator wrapper which shares resolve results between forked processes
+
+    It mimics `resolve` of the Locator service, so it can be passed to `Service` as is.
+    Other methods are delegated to the wrapped locator.
+    """
+
+    def __init__(self, locator, cache, ttl=DEFAULT_RESOLVE_CACHE_TTL, logger=None):
+        self.locator = locator
+        self.cache = cache
+        self.ttl = ttl
+        self.logger = logger
+        # name: time of the last invalidation seen by this process,
+        # the shared entries resolved before it are ignored
+        self.invalidated = {}
+
+    def lookup(self, name):
+        entry = self.cache.read({}).get(name)
+        if entry is None:
+            return None
+
+        endpoints, version, api, resolved_at = entry
+        if time.time() - resolved_at > self.ttl or resolved_at <= self.invalidated.get(name, 0):
+            return None
+
+        return endpoints, version, api
+
+    def store(self, name, value):
+        endpoints, version, api = value
+        now = time.time()
+
+        def add(current):
+            fresh = dict((k, v) for k, v in current.iteritems() if now - v[3] <= self.ttl)
+            fresh[name] = [endpoints, version, api, now]
+            return fresh
+
+        try:
+            self.cache.update(add, {})
+        except SharedStoreBusy:
+            # another process is sharing its result, this one is not waited for
+            pass
+        except Exception as err:
+            if self.logger:
+                self.logger.error("unable to share resolve result of %s: %s", name, err)
+
+    def invalidate(self, name, shared=True):
+        """Drops the resolve result of this process, and of the others if shared
+
+        The shared entry is kept if the store is busy, this process ignores it anyway.
+        """
+        now = time.time()
+        # the entries older than ttl are expired without the marks
+        self.invalidated = dict((k, v) for k, v in self.invalidated.iteritems() if now - v <= self.ttl)
+        self.invalidated[name] = now
+        if not shared or name not in self.cache.read({}):
+            return
+
+        def drop(current):
+            return dict((k, v) for k, v in current.iteritems() if k != name)
+
+        try:
+            self.cache.update(drop, {})
+        except SharedStoreBusy:
+            pass
+
+    @gen.coroutine
+    def resolve(self, name, *args):
+        if not args:
+            value = self.lookup(name)
+            if value is not None:
+                raise gen.Return(_ResolvedChannel(rx=_CachedRx(value), tx=None))
+
+        channel = yield self.locator.resolve(name, *args)
+        if args:
+            # seeded resolves are not cacheable
+            raise gen.Return(channel)
+        raise gen.Return(_ResolvedChannel(rx=_PublishingRx(self, name, channel.rx), tx=channel.tx))
+
+    def __getattr__(self, name):
+        return getattr(self.locator, name)
+
+
+class SharedState(object):
+    """Control-plane state shared between forked proxy processes
+
+    Only the leader subscribes to the locator for routing groups and checks its health,
+    the others read the published snapshot.
+    """
+
+    def __init__(self, size=DEFAULT_SHARED_STORE_SIZE, resolve_ttl=DEFAULT_RESOLVE_CACHE_TTL):
+        # it's written by the leader only
+        self.routing = SharedStore(size, single_writer=True)
+        self.resolve = SharedStore(size)
+        self.resolve_ttl = resolve_ttl
+
+    @staticmethod
+    def is_leader():
+        return process.task_id() in (None, 0)
+
+    def make_locator(self, locator, logger=None):
+        return SharedLocator(locator, self.resolve, self.resolve_ttl, logger)
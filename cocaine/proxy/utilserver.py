@@ -1,7 +1,14 @@
 import logging
 
+from tornado import gen
 from tornado import web
 
+from cocaine.proxy.memory import DEFAULT_TOP_TYPES
+from cocaine.proxy.profiler import DEFAULT_PROFILE_DURATION
+from cocaine.proxy.profiler import format_collapsed
+from cocaine.proxy.profiler import MAX_PROFILE_DURATION
+from cocaine.proxy.profiler import ProfilerBusy
+
 
 class PingHandler(web.RequestHandler):  # pylint: disable=W0223
     def get(self):
@@ -31,6 +38,75 @@ class InfoHandler(web.RequestHandler):  # pylint: disable=W0223
         self.write(info)
 
 
+class LatencyHandler(web.RequestHandler):  # pylint: disable=W0223
+    def get(self):
+        app = self.get_argument("app", None)
+        self.write({"series": self.application.proxy.latency_summary(app)})
+
+
+class MetricsHandler(web.RequestHandler):  # pylint: disable=W0223
+    def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4")
+        self.write(self.application.proxy.render_metrics())
+
+
+class MemoryHandler(web.RequestHandler):  # pylint: disable=W0223
+    def get(self):
+        # the diff is against the previous call served by the same worker
+        try:
+            top = int(self.get_argument("top", DEFAULT_TOP_TYPES))
+        except ValueError as err:
+            self.set_status(400)
+            self.write("invalid arguments: %s" % err)
+            return
+
+        if top < 0:
+            self.set_status(400)
+            self.write("top must not be negative")
+            return
+
+        self.write(self.application.proxy.memory_info(top))
+
+
+class ProfileHandler(web.RequestHandler):  # pylint: disable=W0223
+    @gen.coroutine
+    def get(self):
+        try:
+            seconds = float(self.get_argument("seconds", DEFAULT_PROFILE_DURATION))
+            worker = self.get_argument("worker", "all")
+            workers = None if worker == "all" else [int(i) for i in worker.split(",")]
+        except ValueError as err:
+            self.set_status(400)
+            self.write("invalid arguments: %s" % err)
+            return
+
+        if not 0 < seconds <= MAX_PROFILE_DURATION:
+            self.set_status(400)
+            self.write("seconds must be in (0, %d]" % MAX_PROFILE_DURATION)
+            return
+
+        try:
+            result = yield self.application.proxy.profile(seconds, workers)
+        except ProfilerBusy as err:
+            self.set_status(409)
+            self.write(str(err))
+            return
+        except ValueError as err:
+            self.set_status(400)
+            self.write(str(err))
+            return
+
+        if self.get_argument("format", "collapsed") == "json":
+            self.write(result)
+            return
+
+        # collapsed stacks are ready to be fed to flamegraph.pl
+        self.set_header("Content-Type", "text/plain")
+        self.set_header("X-Profile-Workers", ",".join(str(i) for i in result["workers"]))
+        self.set_header("X-Profile-Samples", str(result["samples"]))
+        self.write(format_collapsed(result["stacks"]))
+
+
 class UtilServer(web.Application):  # pylint: disable=W0223
     def __init__(self, proxy):
         self.proxy = proxy
@@ -38,6 +114,10 @@ class UtilServer(web.Application):  # pylint: disable=W0223
         handlers = [
             (r"/ping", PingHandler),
             (r"/info", InfoHandler),
+            (r"/latency", LatencyHandler),
+            (r"/metrics", MetricsHandler),
+            (r"/profile", ProfileHandler),
+            (r"/memory", MemoryHandler),
             (r"/logger", LogLevel),
         ]
         super(UtilServer, self).__init__(handlers=handlers)
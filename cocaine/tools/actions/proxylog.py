@@ -0,0 +1,114 @@
+import collections
+import math
+
+from tornado import gen
+
+from cocaine.proxy.accesslog import read_records
+from cocaine.tools.actions import Action
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+
+DEFAULT_PERCENTILES = (50, 90, 99, 99.9)
+
+
+def load_columns(paths, app=None, since=None, until=None):
+    """Reads (apps, codes, durations in ms) columns of records from binary access logs"""
+    apps, codes, durations = [], [], []
+    for path in paths:
+        for record in read_records(path):
+            if app is not None and record["app"] != app:
+                continue
+            timestamp = record["timestamp"] / 1000000.0
+            if since is not None and timestamp < since:
+                continue
+            if until is not None and timestamp >= until:
+                continue
+            apps.append(record["app"])
+            codes.append(record["code"])
+            durations.append(record["duration_us"] / 1000.0)
+    return apps, codes, durations
+
+
+def percentile(ordered, p):
+    # linear interpolation between the closest ranks, the same way numpy does
+    position = (len(ordered) - 1) * p / 100.0
+    lower = int(math.floor(position))
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+def percentile_name(p):
+    return "p%s" % ("%g" % p).replace(".", "")
+
+
+def summarize(count, classes, latency):
+    errors = classes.get("5xx", 0)
+    return {
+        "count": count,
+        "errors": errors,
+        "error_rate": float(errors) / count,
+        "codes": classes,
+        "latency_ms": latency,
+    }
+
+
+def aggregate(apps, codes, durations, percentiles=DEFAULT_PERCENTILES):
+    groups = collections.defaultdict(lambda: ([], []))
+    for app, code, duration in zip(apps, codes, durations):
+        group = groups[app]
+        group[0].append(code)
+        group[1].append(duration)
+
+    result = {}
+    for app, (app_codes, app_durations) in groups.iteritems():
+        ordered = sorted(app_durations)
+        latency = dict((percentile_name(p), percentile(ordered, p)) for p in percentiles)
+        latency["max"] = ordered[-1]
+        classes = collections.Counter("%dxx" % (code // 100) for code in app_codes)
+        result[app] = summarize(len(ordered), dict(classes), latency)
+    return result
+
+
+def aggregate_vectorized(apps, codes, durations, percentiles=DEFAULT_PERCENTILES):
+    names, inverse = numpy.unique(numpy.array(apps, dtype=object), return_inverse=True)
+    codes = numpy.array(codes)
+    durations = numpy.array(durations, dtype=float)
+    # records of an app become a contiguous slice
+    order = numpy.argsort(inverse, kind="mergesort")
+    bounds = numpy.searchsorted(inverse[order], numpy.arange(len(names) + 1))
+
+    result = {}
+    for i, app in enumerate(names):
+        index = order[bounds[i]:bounds[i + 1]]
+        app_durations = durations[index]
+        values = numpy.percentile(app_durations, percentiles)
+        latency = dict((percentile_name(p), float(value)) for p, value in zip(percentiles, values))
+        latency["max"] = float(app_durations.max())
+        classes, counts = numpy.unique(codes[index] // 100, return_counts=True)
+        result[app] = summarize(len(index), dict(("%dxx" % c, int(n)) for c, n in zip(classes, counts)), latency)
+    return result
+
+
+def logstat(paths, app=None, since=None, until=None, percentiles=DEFAULT_PERCENTILES):
+    apps, codes, durations = load_columns(paths, app, since, until)
+    if numpy is not None:
+        per_app = aggregate_vectorized(apps, codes, durations, percentiles) if apps else {}
+    else:
+        per_app = aggregate(apps, codes, durations, percentiles)
+    return {"records": len(apps), "apps": per_app}
+
+
+class LogStat(Action):
+    def __init__(self, paths, app=None, since=None, until=None):
+        self.paths = paths
+        self.app = app
+        self.since = since
+        self.until = until
+
+    @gen.coroutine
+    def execute(self):
+        raise gen.Return(logstat(self.paths, self.app, self.since, self.until))
@@ -0,0 +1,217 @@
+import calendar
+import collections
+import datetime
+import re
+import time
+
+from tornado import gen
+from tornado import httpclient
+from tornado import locks
+
+from cocaine.proxy.accesslog import MAGIC
+from cocaine.proxy.accesslog import read_records
+from cocaine.tools.actions import Action
+from cocaine.tools.actions.proxylog import DEFAULT_PERCENTILES
+from cocaine.tools.actions.proxylog import percentile
+from cocaine.tools.actions.proxylog import percentile_name
+
+
+DEFAULT_CONCURRENCY = 64
+DEFAULT_STICKY_HEADER = "X-Cocaine-Sticky"
+# sec a request is considered sent late if it's delayed more
+LATE_THRESHOLD = 0.01
+# credentials are not logged, a request which had them is replayed with this one
+REPLAY_AUTHORIZATION = "replay"
+
+ReplayRequest = collections.namedtuple("ReplayRequest", ["timestamp", "method", "uri", "headers", "body_size",
+                                                         "plugin"])
+
+# the default format of the access log, i.e.
+# [+0300 19/Oct/2026:10:00:00.5]\t[proxy:297]\tINFO\t1f2e3d\tstart request: host 127.0.0.1 /app/event?a=1 GET
+_TEXT_START = re.compile(r"^\[(?P<time>[^\]]+)\]\t.*\t(?P<traceid>\S+)\tstart request: "
+                         r"(?P<host>\S+) (?P<ip>\S+) (?P<uri>\S+)(?: (?P<method>[A-Z]+))?$")
+_TEXT_STICKY = re.compile(r"^\[[^\]]+\]\t.*\t(?P<traceid>\S+)\tsticky_header has been found: "
+                          r"name \S+, value (?P<value>.*), seed -?\d+$")
+_TIME = re.compile(r"^(?P<tz>[+-]\d{4}) (?P<time>\S+)\.(?P<msecs>\d+)$")
+
+
+class ReplayError(Exception):
+    pass
+
+
+def parse_time(value):
+    """Parses `%z %d/%b/%Y:%H:%M:%S.msecs` into a unix timestamp"""
+    match = _TIME.match(value)
+    if match is None:
+        raise ReplayError("unsupported time format: %s" % value)
+
+    moment = datetime.datetime.strptime(match.group("time"), "%d/%b/%Y:%H:%M:%S")
+    tz = match.group("tz")
+    offset = (int(tz[1:3]) * 3600 + int(tz[3:5]) * 60) * (-1 if tz[0] == "-" else 1)
+    return calendar.timegm(moment.timetuple()) - offset + int(match.group("msecs")) / 1000.0
+
+
+def read_text_log(path, sticky_header=DEFAULT_STICKY_HEADER):
+    """Reads requests from the text access log, they are logged only for requests with a trace id
+
+    The body size is not logged there, so requests are replayed without bodies.
+    """
+    requests = []
+    by_traceid = {}
+    with open(path) as f:
+        for line in f:
+            line = line.rstrip("\n")
+            match = _TEXT_START.match(line)
+            if match is not None:
+                request = ReplayRequest(parse_time(match.group("time")), match.group("method") or "GET",
+                                        match.group("uri"), {}, 0, None)
+                requests.append(request)
+                by_traceid[match.group("traceid")] = request
+                continue
+
+            match = _TEXT_STICKY.match(line)
+            if match is not None and match.group("traceid") in by_traceid:
+                by_traceid[match.group("traceid")].headers[sticky_header] = match.group("value")
+    return requests
+
+
+def read_binary_log(path, sticky_header=DEFAULT_STICKY_HEADER):
+    requests = []
+    for record in read_records(path):
+        if record.get("uri") is None:
+            # written before the request line was added to the format
+            continue
+
+        headers = {}
+        if record["app"]:
+            # the uri is logged without /app/event prefix
+            headers["X-Cocaine-Service"] = record["app"]
+            headers["X-Cocaine-Event"] = record["event"]
+        if record["sticky"] is not None:
+            headers[sticky_header] = record["sticky"]
+        # requests are dispatched to the same plugins
+        headers.update(record.get("trigger_headers") or {})
+        if record.get("authorization"):
+            headers["Authorization"] = REPLAY_AUTHORIZATION
+        started = (record["timestamp"] - record["duration_us"]) / 1000000.0
+        requests.append(ReplayRequest(started, record["method"], record["uri"], headers, record["request_size"],
+                                      record.get("plugin")))
+    return requests
+
+
+def read_requests(paths, sticky_header=DEFAULT_STICKY_HEADER):
+    requests = []
+    for path in paths:
+        with open(path, "rb") as f:
+            binary = f.read(len(MAGIC)) == MAGIC
+        reader = read_binary_log if binary else read_text_log
+        requests.extend(reader(path, sticky_header))
+    requests.sort(key=lambda request: request.timestamp)
+    return requests
+
+
+class Replayer(object):
+    """Sends requests to the proxy keeping their inter-arrival times divided by `speed`
+
+    Not more than `concurrency` requests are in flight, a request waiting for a free slot
+    is sent late. Zero speed sends requests as fast as the concurrency allows.
+    Requests logged with their trigger headers are dispatched to the same plugins,
+    they are counted by the plugin in the report.
+    """
+
+    def __init__(self, url, speed=1.0, concurrency=DEFAULT_CONCURRENCY, timeout=None):
+        self.url = url.rstrip("/")
+        self.speed = speed
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.client = httpclient.AsyncHTTPClient(force_instance=True, max_clients=concurrency)
+        self.slots = locks.Semaphore(concurrency)
+        self.latencies = []
+        self.codes = collections.Counter()
+        self.plugins = collections.Counter()
+        self.late = 0
+
+    @gen.coroutine
+    def run(self, requests):
+        if not requests:
+            raise gen.Return(self.report(0))
+
+        started = time.time()
+        origin = requests[0].timestamp
+        for request in requests:
+            if self.speed > 0:
+                due = started + (request.timestamp - origin) / self.speed
+                delay = due - time.time()
+                if delay > 0:
+                    yield gen.sleep(delay)
+            else:
+                due = None
+
+            yield self.slots.acquire()
+            if due is not None and time.time() - due > LATE_THRESHOLD:
+                self.late += 1
+            # a slot is released when the request is done
+            self.send(request)
+
+        # wait for the requests in flight
+        for _ in xrange(self.concurrency):
+            yield self.slots.acquire()
+        self.client.close()
+        raise gen.Return(self.report(time.time() - started))
+
+    @gen.coroutine
+    def send(self, request):
+        body = "x" * request.body_size if request.body_size or request.method in ("POST", "PUT", "PATCH") else None
+        http_request = httpclient.HTTPRequest(self.url + request.uri, method=request.method, headers=request.headers,
+                                              body=body, allow_nonstandard_methods=True,
+                                              request_timeout=self.timeout, follow_redirects=False)
+        start = time.time()
+        try:
+            response = yield self.client.fetch(http_request, raise_error=False)
+            code = response.code
+        except Exception:
+            code = 599
+        finally:
+            self.slots.release()
+        self.latencies.append(1000.0 * (time.time() - start))
+        self.codes[code] += 1
+        if request.plugin is not None:
+            self.plugins[request.plugin] += 1
+
+    def report(self, duration):
+        ordered = sorted(self.latencies)
+        latency = {}
+        if ordered:
+            latency = dict((percentile_name(p), percentile(ordered, p)) for p in DEFAULT_PERCENTILES)
+            latency["max"] = ordered[-1]
+        return {
+            "requests": len(ordered),
+            "errors": sum(count for code, count in self.codes.iteritems() if code >= 500),
+            "codes": dict(self.codes),
+            "plugins": dict(self.plugins),
+            "late": self.late,
+            "duration": duration,
+            "rps": len(ordered) / duration if duration else 0.0,
+            "latency_ms": latency,
+        }
+
+
+class Replay(Action):
+    def __init__(self, paths, url, speed=1.0, concurrency=DEFAULT_CONCURRENCY, timeout=None,
+                 sticky_header=DEFAULT_STICKY_HEADER, limit=None):
+        self.paths = paths
+        self.url = url
+        self.speed = speed
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.sticky_header = sticky_header
+        self.limit = limit
+
+    @gen.coroutine
+    def execute(self):
+        requests = read_requests(self.paths, self.sticky_header)
+        if self.limit:
+            requests = requests[:self.limit]
+        replayer = Replayer(self.url, self.speed, self.concurrency, self.timeout)
+        result = yield replayer.run(requests)
+        raise gen.Return(result)
@@ -32,7 +32,7 @@ from cocaine.exceptions import ChokeEvent, CocaineError
 from cocaine.decorators import coroutine
 from cocaine.tools import log, interactive
 from cocaine.tools.actions import common, app, auth, profile, runlist, crashlog, group, \
-    tracing, timeouts, logs, keyring, unicorn, vicodyn
+    tracing, timeouts, logs, keyring, unicorn, vicodyn, proxylog, proxyreplay
 from cocaine.tools.actions.access import storage, event, edit
 from cocaine.tools.error import ToolsError
 
@@ -230,6 +230,9 @@ NG_ACTIONS = {
     'vicodyn:info': JsonToolHandler(vicodyn.Info),
     'vicodyn:apps': JsonToolHandler(vicodyn.Apps),
     'vicodyn:peers': JsonToolHandler(vicodyn.Peers),
+
+    'proxy:logstat': JsonToolHandler(proxylog.LogStat),
+    'proxy:replay': JsonToolHandler(proxyreplay.Replay),
 }
 
 
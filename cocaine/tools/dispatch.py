@@ -571,6 +571,14 @@ def keyring_group():
     pass
 
 
+@tools.group(name='proxy')
+def proxy_group():
+    """
+    Cocaine HTTP proxy tools.
+    """
+    pass
+
+
 @tools.command()
 @click.option('--type', 'ty', default='plain', type=Choice(['plain', 'json']), help='Output type.')
 @click.option('--query', help='Filtering query.')
@@ -2038,4 +2046,53 @@ def keyring_refresh(**kwargs):
     })
 
 
+@proxy_group.command(name='logstat')
+@click.argument('paths', nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False))
+@click.option('-n', '--name', metavar='', help='Application name.')
+@click.option('--since', metavar='', type=float, help='Unix timestamp to skip earlier requests.')
+@click.option('--until', metavar='', type=float, help='Unix timestamp to skip later requests.')
+def proxy_logstat(paths, name, since, until):
+    """
+    Show per-application latency percentiles and error rates from binary access logs.
+
+    The logs are written by the proxy started with --access_log_binary option.
+    Aggregation is vectorized if numpy is installed.
+    """
+    Executor().execute_action('proxy:logstat', **{
+        'paths': paths,
+        'app': name,
+        'since': since,
+        'until': until,
+    })
+
+
+@proxy_group.command(name='replay')
+@click.argument('paths', nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False))
+@click.option('--url', metavar='', default='http://localhost:8080', help='Proxy endpoint.')
+@click.option('--speed', metavar='', type=float, default=1.0,
+              help='Speed-up factor of the original timing, 0 sends requests as fast as possible.')
+@click.option('--concurrency', metavar='', type=int, default=64, help='Maximum requests in flight.')
+@click.option('--timeout', metavar='', type=float, default=20, help='Request timeout.')
+@click.option('--sticky-header', metavar='', default='X-Cocaine-Sticky', help='Sticky header name.')
+@click.option('--limit', metavar='', type=int, help='Replay only first N requests.')
+def proxy_replay(paths, url, speed, concurrency, timeout, sticky_header, limit):
+    """
+    Replay requests from proxy access logs against a proxy.
+
+    Both binary access logs and text ones in the default format are supported.
+    Text logs contain only requests with a trace id and lack body sizes.
+    Latency percentiles, status codes and the count of requests sent late
+    because of the concurrency limit are reported.
+    """
+    Executor().execute_action('proxy:replay', **{
+        'paths': paths,
+        'url': url,
+        'speed': speed,
+        'concurrency': concurrency,
+        'timeout': timeout,
+        'sticky_header': sticky_header,
+        'limit': limit,
+    })
+
+
 cli = click.CommandCollection(sources=[tools])
@@ -0,0 +1,211 @@
+import random
+import socket
+
+import msgpack
+from tornado import gen
+from tornado.iostream import StreamClosedError
+from tornado.netutil import bind_sockets
+from tornado.tcpserver import TCPServer
+
+from cocaine.common import CocaineErrno
+from cocaine.common import ErrorCategory
+from cocaine.detail.api import API
+
+from cocaine.proxy.proxy import EQUEUEISFULL
+from cocaine.proxy.proxy import ESERVICENOTAVAILABLE
+from cocaine.proxy.proxy import LOCATORCATEGORY
+from cocaine.proxy.proxy import OVERSEERCATEGORY
+
+
+# message types of the replies
+VALUE = WRITE = 0
+ERROR = 1
+CLOSE = 2
+
+STREAMING = {0: ["write", None], 1: ["error", {}], 2: ["close", {}]}
+APP_API = {0: ["enqueue", STREAMING, STREAMING]}
+
+READ_CHUNK_SIZE = 64 << 10  # bytes
+
+
+class FakeService(TCPServer):
+    """Serves the cocaine msgpack protocol on an ephemeral localhost port
+
+    Messages of every connection are passed to `on_message` along with
+    a dict to keep the state of its sessions.
+    """
+
+    api = {}
+
+    def __init__(self, name):
+        super(FakeService, self).__init__()
+        self.name = name
+        self.streams = set()
+        sockets = bind_sockets(0, address="127.0.0.1", family=socket.AF_INET)
+        self.port = sockets[0].getsockname()[1]
+        self.add_sockets(sockets)
+
+    @property
+    def endpoint(self):
+        return ["127.0.0.1", self.port]
+
+    @gen.coroutine
+    def handle_stream(self, stream, address):
+        stream.set_nodelay(True)
+        self.streams.add(stream)
+        unpacker = msgpack.Unpacker()
+        sessions = {}
+        try:
+            while True:
+                data = yield stream.read_bytes(READ_CHUNK_SIZE, partial=True)
+                unpacker.feed(data)
+                for message in unpacker:
+                    # headers are ignored
+                    session, message_type, args = message[:3]
+                    self.on_message(stream, sessions, session, message_type, args)
+        except StreamClosedError:
+            pass
+        finally:
+            self.streams.discard(stream)
+
+    def on_message(self, stream, sessions, session, message_type, args):
+        raise NotImplementedError
+
+    def send(self, stream, session, message_type, payload):
+        if not stream.closed():
+            stream.write(msgpack.packb([session, message_type, payload]))
+
+    def send_error(self, stream, session, category, code, reason):
+        self.send(stream, session, ERROR, [[category, code], reason])
+
+    def stop(self):
+        super(FakeService, self).stop()
+        for stream in list(self.streams):
+            stream.close()
+
+
+class FakeApp(FakeService):
+    """Application replying to every event with `response_size` bytes split into `chunks`
+
+    `error_rate` and `queue_full_rate` are chances to reply with an application error
+    and EQUEUEISFULL. `handler(event, request)` returning (code, headers, body)
+    can replace the default reply, `request` is the unpacked HTTP request.
+    """
+
+    api = APP_API
+
+    def __init__(self, name, latency=0, response_size=2, chunks=1,
+                 error_rate=0, queue_full_rate=0, handler=None, seed=None):
+        super(FakeApp, self).__init__(name)
+        self.latency = latency
+        self.response_size = response_size
+        self.chunks = max(chunks, 1)
+        self.error_rate = error_rate
+        self.queue_full_rate = queue_full_rate
+        self.handler = handler or self.default_handler
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.errors = 0
+        self.rejected = 0
+
+    def default_handler(self, event, request):
+        return 200, [["Content-Type", "text/plain"]], "x" * self.response_size
+
+    def on_message(self, stream, sessions, session, message_type, args):
+        if session not in sessions:
+            # the first message of a session is `enqueue(event)`
+            sessions[session] = (args[0], [])
+        elif message_type == WRITE:
+            sessions[session][1].append(args[0])
+        elif message_type == CLOSE:
+            event, chunks = sessions.pop(session)
+            self.reply(stream, session, event, "".join(chunks))
+        else:
+            sessions.pop(session)
+
+    @gen.coroutine
+    def reply(self, stream, session, event, data):
+        self.requests += 1
+        if self.random.random() < self.queue_full_rate:
+            self.rejected += 1
+            self.send_error(stream, session, OVERSEERCATEGORY[1], EQUEUEISFULL, "queue is full")
+            return
+
+        if self.latency > 0:
+            yield gen.sleep(self.latency)
+
+        if self.random.random() < self.error_rate:
+            self.errors += 1
+            self.send_error(stream, session, ErrorCategory.CFRAMEWORKCATEGORY,
+                            CocaineErrno.EUNCAUGHTEXCEPTION, "injected error")
+            return
+
+        code, headers, body = self.handler(event, msgpack.unpackb(data) if data else None)
+        self.send(stream, session, WRITE, [msgpack.packb([code, headers])])
+        size = -(-len(body) // self.chunks) or 1
+        for offset in xrange(0, len(body), size):
+            self.send(stream, session, WRITE, [body[offset:offset + size]])
+        self.send(stream, session, CLOSE, [])
+
+
+class FakeLocator(FakeService):
+    """Locator resolving names into the registered fake services
+
+    `routing` sends empty routing groups once and keeps the stream open,
+    `cluster` replies with an empty cluster.
+    """
+
+    api = API.Locator
+
+    def __init__(self):
+        super(FakeLocator, self).__init__("locator")
+        self.services = {}
+        self.resolves = 0
+
+    def on_message(self, stream, sessions, session, message_type, args):
+        if session in sessions:
+            # `discard` of a subscription
+            return
+
+        sessions[session] = method = self.api.get(message_type, [None])[0]
+        if method == "resolve":
+            self.resolves += 1
+            service = self.services.get(args[0])
+            if service is None:
+                self.send_error(stream, session, LOCATORCATEGORY[1], ESERVICENOTAVAILABLE,
+                                "service is not available")
+            else:
+                self.send(stream, session, VALUE, [[service.endpoint], 1, service.api])
+        elif method == "routing":
+            self.send(stream, session, WRITE, [{}])
+        elif method == "cluster":
+            self.send(stream, session, VALUE, [{}])
+        else:
+            self.send_error(stream, session, ErrorCategory.CFRAMEWORKCATEGORY,
+                            CocaineErrno.ENOHANDLER, "%s is not supported" % method)
+
+
+class FakeRuntime(object):
+    """Locator and applications of a local stand-in cocaine runtime
+
+    It runs on the current IOLoop, so a client in the same process
+    must not block it.
+    """
+
+    def __init__(self, apps=()):
+        self.locator = FakeLocator()
+        self.apps = {}
+        for app in apps:
+            self.add(app)
+
+    @property
+    def locator_endpoint(self):
+        return "127.0.0.1:%d" % self.locator.port
+
+    def add(self, app):
+        self.apps[app.name] = self.locator.services[app.name] = app
+
+    def stop(self):
+        self.locator.stop()
+        for app in self.apps.itervalues():
+            app.stop()
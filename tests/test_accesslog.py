@@ -0,0 +1,99 @@
+import os
+import shutil
+import tempfile
+
+import mock
+
+from cocaine.proxy import accesslog
+from cocaine.proxy.accesslog import BinaryAccessLog
+from cocaine.proxy.accesslog import BinaryAccessLogError
+from cocaine.proxy.accesslog import read_records
+from cocaine.tools.actions import proxylog
+
+
+def with_tmpdir(func):
+    def wrapper():
+        path = tempfile.mkdtemp()
+        try:
+            func(path)
+        finally:
+            shutil.rmtree(path)
+    wrapper.__name__ = func.__name__
+    return wrapper
+
+
+def _record(app, code, duration_ms, timestamp=1000):
+    return [timestamp * 1000000, None, app, "event", code, 10, 20, int(duration_ms * 1000), {"connect": 5}]
+
+
+@with_tmpdir
+@mock.patch.object(accesslog, "FLUSH_SIZE", 64)
+def test_write_read_rotate(tmpdir):
+    path = os.path.join(tmpdir, "access.bin")
+    log = BinaryAccessLog(path, max_size=256, backup_count=2)
+    for i in xrange(40):
+        log.write(_record("app", 200, i))
+    log.close()
+
+    assert sorted(os.listdir(tmpdir)) == ["access.bin", "access.bin.1", "access.bin.2"]
+    records = []
+    for name in ("access.bin.2", "access.bin.1", "access.bin"):
+        records.extend(read_records(os.path.join(tmpdir, name)))
+    # the oldest rotated file is gone
+    assert 0 < len(records) < 40
+    assert [r["duration_us"] for r in records] == range(40000 - 1000 * len(records), 40000, 1000)
+    assert records[0]["stages_us"] == {"connect": 5}
+
+
+@with_tmpdir
+def test_read_truncated_and_foreign(tmpdir):
+    path = os.path.join(tmpdir, "access.bin")
+    log = BinaryAccessLog(path)
+    log.write(_record("app", 200, 1))
+    log.write(_record("app", 200, 2))
+    log.close()
+    with open(path, "r+b") as f:
+        f.truncate(os.path.getsize(path) - 3)
+    assert len(list(read_records(path))) == 1
+
+    with open(path, "wb") as f:
+        f.write("plain text access log")
+    try:
+        list(read_records(path))
+    except BinaryAccessLogError:
+        pass
+    else:
+        assert False, "BinaryAccessLogError has not been raised"
+
+
+@with_tmpdir
+def test_logstat(tmpdir):
+    path = os.path.join(tmpdir, "access.bin")
+    log = BinaryAccessLog(path)
+    for i in xrange(1, 101):
+        log.write(_record("a", 502 if i % 10 == 0 else 200, i))
+    log.write(_record("b", 404, 7, timestamp=2000))
+    log.close()
+
+    with mock.patch.object(proxylog, "numpy", None):
+        stats = proxylog.logstat([path])
+    assert stats["records"] == 101
+    a = stats["apps"]["a"]
+    assert (a["count"], a["errors"], a["error_rate"]) == (100, 10, 0.1)
+    assert a["codes"] == {"2xx": 90, "5xx": 10}
+    assert a["latency_ms"]["p50"] == 50.5
+    assert a["latency_ms"]["max"] == 100
+    assert stats["apps"]["b"]["codes"] == {"4xx": 1}
+
+    with mock.patch.object(proxylog, "numpy", None):
+        assert proxylog.logstat([path], since=1500)["records"] == 1
+        assert proxylog.logstat([path], app="b")["apps"].keys() == ["b"]
+
+    if proxylog.numpy is not None:
+        vectorized = proxylog.logstat([path])
+        for app, summary in stats["apps"].iteritems():
+            latency = vectorized["apps"][app].pop("latency_ms")
+            expected = summary.pop("latency_ms")
+            assert dict((k, round(v, 6)) for k, v in latency.items()) == \
+                dict((k, round(v, 6)) for k, v in expected.items())
+            assert vectorized["apps"][app] == summary
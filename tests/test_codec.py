@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+import json
+
+from cocaine.proxy import codec
+
+
+PAYLOAD = {
+    "jsonrpc": "2.0",
+    "method": "storage.read",
+    "params": ["collection", u"ключ", 1, 2.5, None, True, [], {}],
+    "url": "http://example.com/path",
+    "id": 1 << 40,
+}
+
+
+def test_codecs_round_trip():
+    try:
+        for name in codec.available():
+            codec.select(name)
+            assert codec.info()["encoder"] == codec.info()["decoder"] == name
+            assert json.loads(codec.dumps(PAYLOAD)) == PAYLOAD
+            assert codec.loads(json.dumps(PAYLOAD)) == PAYLOAD
+    finally:
+        codec.select()
+
+
+def test_select():
+    assert "json" in codec.available()
+    assert codec.info()["decoder"] == [name for name in codec.available() if name not in codec.OPT_IN][0]
+    # the automatically picked codec keeps the output of the stdlib one
+    assert codec.info()["encoder"] not in codec.OPT_IN
+    value = {"sum": 0.1 + 0.2, "id": 1 << 40}
+    assert codec.dumps(value) == json.dumps(value)
+    assert codec.loads(json.dumps(value)) == value
+    try:
+        codec.select("unknown")
+    except ValueError:
+        pass
+    else:
+        assert False, "unknown codec must not be selected"
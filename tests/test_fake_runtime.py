@@ -0,0 +1,70 @@
+from tornado.testing import AsyncHTTPTestCase
+from tornado.testing import gen_test
+
+from cocaine.exceptions import ServiceError
+from cocaine.services import Locator
+from cocaine.services import Service
+
+from cocaine.proxy.proxy import CocaineProxy
+from cocaine.proxy.proxy import EQUEUEISFULL
+
+from fake_runtime import FakeApp
+from fake_runtime import FakeRuntime
+
+
+class TestFakeRuntime(AsyncHTTPTestCase):
+    def setUp(self):
+        super(TestFakeRuntime, self).setUp()
+        self.app = FakeApp("echo", response_size=10, chunks=3, seed=1)
+        self.runtime = FakeRuntime([self.app, FakeApp("busy", queue_full_rate=1)])
+
+    def tearDown(self):
+        self.runtime.stop()
+        super(TestFakeRuntime, self).tearDown()
+
+    def get_app(self):
+        self.proxy = CocaineProxy(locators=["localhost:1"], allow_json_rpc=False,
+                                  ioloop=self.io_loop)
+        return self.proxy
+
+    @gen_test
+    def test_service(self):
+        locator = Locator(endpoints=[["127.0.0.1", self.runtime.locator.port]])
+        service = Service("echo", locator=locator)
+        channel = yield service.enqueue("ping")
+        yield channel.tx.write("")
+        yield channel.tx.close()
+        chunks = []
+        for _ in xrange(4):
+            chunk = yield channel.rx.get()
+            chunks.append(chunk)
+        self.assertEqual(chunks[1:], ["xxxx", "xxxx", "xx"])
+
+        service = Service("busy", locator=locator)
+        channel = yield service.enqueue("ping")
+        yield channel.tx.close()
+        with self.assertRaises(ServiceError) as ctx:
+            yield channel.rx.get()
+        self.assertEqual(ctx.exception.code, EQUEUEISFULL)
+
+        with self.assertRaises(ServiceError):
+            yield Service("missing", locator=locator).connect()
+
+    @gen_test
+    def test_proxy(self):
+        self.proxy.locator = Locator(endpoints=[["127.0.0.1", self.runtime.locator.port]])
+        response = yield self.http_client.fetch(self.get_url("/echo/ping"))
+        self.assertEqual(response.body, "x" * 10)
+        self.assertEqual(self.app.requests, 1)
+
+        response = yield self.http_client.fetch(self.get_url("/busy/ping"), raise_error=False)
+        self.assertEqual(response.code, 500)
+        self.assertEqual(self.runtime.apps["busy"].rejected, 2)
+
+        response = yield self.http_client.fetch(self.get_url("/missing/ping"), raise_error=False)
+        self.assertEqual(response.code, 503)
+
+        self.app.error_rate = 1
+        response = yield self.http_client.fetch(self.get_url("/echo/ping"), raise_error=False)
+        self.assertEqual(response.code, 500)
+        self.assertEqual(self.app.errors, 1)
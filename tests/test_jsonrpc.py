@@ -1,11 +1,20 @@
+import json
+
 import mock
 
 import tornado
 from tornado.httpclient import HTTPRequest
 from tornado.httputil import HTTPServerRequest, ResponseStartLine, HTTPHeaders
+from tornado.testing import AsyncHTTPTestCase
 from tornado.testing import AsyncTestCase
 
+from cocaine.exceptions import ChokeEvent
+from cocaine.exceptions import ServiceError
+from cocaine.services import EmptyResponse
+
+from cocaine.proxy.jsonrpc import APITables
 from cocaine.proxy.jsonrpc import JSONRPC
+from cocaine.proxy.jsonrpc import NDJSONStream
 from cocaine.proxy.logutils import NULLLOGGER
 
 
@@ -34,10 +43,10 @@ class TestJSONRPC(AsyncTestCase):
 
         yield plugin.process(request)
 
-        connection.write_headers.assert_called_with(
-            ResponseStartLine(version='HTTP/1.1', code=400, reason='Bad JSON-RPC request'),
-            mock.ANY,
-            '{"message": "Parse error: Invalid JSON was received by the server.", "code": -32700}')
+        start_line, _, body = connection.write_headers.call_args[0]
+        self.assertEqual(start_line, ResponseStartLine(version='HTTP/1.1', code=400, reason='Bad JSON-RPC request'))
+        self.assertEqual(json.loads(body), {"message": "Parse error: Invalid JSON was received by the server.",
+                                            "code": -32700})
 
     @tornado.testing.gen_test
     def test_400_invalid_request_error(self):
@@ -54,7 +63,238 @@ class TestJSONRPC(AsyncTestCase):
 
         yield plugin.process(request)
 
-        connection.write_headers.assert_called_with(
-            ResponseStartLine(version='HTTP/1.1', code=400, reason='Bad JSON-RPC request'),
-            mock.ANY,
-            '{"message": "The JSON sent is not a valid Request object.", "code": -32600}')
+        start_line, _, body = connection.write_headers.call_args[0]
+        self.assertEqual(start_line, ResponseStartLine(version='HTTP/1.1', code=400, reason='Bad JSON-RPC request'))
+        self.assertEqual(json.loads(body), {"message": "The JSON sent is not a valid Request object.",
+                                            "code": -32600})
+
+
+class _Channel(object):
+    def __init__(self, rx):
+        self.rx = rx
+
+
+class _Service(object):
+    name = 'echo'
+    api = {0: ['echo', {}, JSONRPC.PRIMITIVE], 1: ['emit', {}, {}]}
+
+    def __init__(self, io_loop):
+        self.io_loop = io_loop
+        self.inflight = 0
+        self.max_inflight = 0
+        self.emitted = []
+
+    @tornado.gen.coroutine
+    def echo(self, value, delay):
+        self.inflight += 1
+        self.max_inflight = max(self.max_inflight, self.inflight)
+        yield tornado.gen.sleep(delay)
+        self.inflight -= 1
+        rx = mock.Mock()
+        rx.get.return_value = tornado.gen.maybe_future(value)
+        raise tornado.gen.Return(_Channel(rx))
+
+    @tornado.gen.coroutine
+    def emit(self, value):
+        self.emitted.append(value)
+
+
+class TestJSONRPCBatch(AsyncTestCase):
+    def make_request(self, body):
+        connection = mock.Mock(spec=[])
+        connection.write_headers = mock.MagicMock()
+        connection.finish = mock.MagicMock()
+        request = HTTPServerRequest(method='POST', uri='/', version='HTTP/1.1', headers={
+            'X-Cocaine-JSON-RPC': 'Enable',
+        }, connection=connection, body=json.dumps(body), host='localhost')
+        request.logger = NULLLOGGER
+        return request
+
+    def make_plugin(self, config):
+        self.service = _Service(self.io_loop)
+        proxy = mock.Mock()
+        proxy.io_loop = self.io_loop
+        proxy.get_service.side_effect = lambda name, request: tornado.gen.maybe_future(
+            self.service if name == 'echo' else None)
+        return JSONRPC(proxy, config)
+
+    @tornado.testing.gen_test
+    def test_batch(self):
+        plugin = self.make_plugin({'batch_concurrency': 2})
+        batch = [{'jsonrpc': '2.0', 'method': 'echo.echo', 'params': [i, 0.01 * (5 - i)], 'id': i}
+                 for i in range(5)]
+        batch.insert(1, {'jsonrpc': '2.0', 'method': 'echo.emit', 'params': ['notification']})
+        batch.append({'jsonrpc': '2.0', 'method': 'echo.missing', 'params': [], 'id': 'a'})
+        batch.append({'jsonrpc': '2.0', 'method': 'missing.echo', 'params': [], 'id': 'b'})
+        batch.append(1)
+        batch.append({'jsonrpc': '2.0', 'method': 'echo', 'params': [], 'id': 'c'})
+        batch.append({'jsonrpc': '2.0', 'method': 42, 'params': [], 'id': 'd'})
+        request = self.make_request(batch)
+
+        yield plugin.process(request)
+
+        start_line, _, body = request.connection.write_headers.call_args[0]
+        self.assertEqual(start_line.code, 200)
+        replies = json.loads(body)
+        self.assertEqual([reply['id'] for reply in replies], [0, 1, 2, 3, 4, 'a', 'b', None, 'c', 'd'])
+        self.assertEqual([reply.get('result') for reply in replies[:5]], range(5))
+        self.assertEqual(replies[5]['error']['code'], -32601)
+        self.assertEqual(replies[6]['error'], {'code': -32000, 'message': 'Service not found.'})
+        self.assertEqual(replies[7]['error']['code'], -32600)
+        self.assertEqual(replies[8]['error'], {'code': -32601, 'message': 'Method not found.'})
+        self.assertEqual(replies[9]['error']['code'], -32600)
+        self.assertEqual(self.service.emitted, ['notification'])
+        self.assertEqual(self.service.max_inflight, 2)
+
+    @tornado.testing.gen_test
+    def test_batch_of_notifications(self):
+        plugin = self.make_plugin({})
+        request = self.make_request([{'jsonrpc': '2.0', 'method': 'echo.emit', 'params': [1]}])
+
+        yield plugin.process(request)
+        yield tornado.gen.moment
+
+        start_line, _, _ = request.connection.write_headers.call_args[0]
+        self.assertEqual(start_line.code, 204)
+        self.assertEqual(self.service.emitted, [1])
+
+    @tornado.testing.gen_test
+    def test_empty_batch(self):
+        plugin = self.make_plugin({})
+        request = self.make_request([])
+
+        yield plugin.process(request)
+
+        start_line, _, _ = request.connection.write_headers.call_args[0]
+        self.assertEqual(start_line.code, 400)
+
+    @tornado.testing.gen_test
+    def test_batch_too_large(self):
+        plugin = self.make_plugin({'max_batch_size': 2})
+        request = self.make_request([{'jsonrpc': '2.0', 'method': 'echo.emit', 'params': [i]} for i in range(3)])
+
+        yield plugin.process(request)
+        yield tornado.gen.moment
+
+        start_line, _, body = request.connection.write_headers.call_args[0]
+        self.assertEqual(start_line.code, 400)
+        self.assertEqual(json.loads(body)['code'], -32600)
+        self.assertEqual(self.service.emitted, [])
+
+    @tornado.testing.gen_test
+    def test_malformed_method(self):
+        plugin = self.make_plugin({})
+        request = self.make_request({'jsonrpc': '2.0', 'method': 'echo', 'params': [], 'id': 1})
+
+        yield plugin.process(request)
+
+        start_line, _, body = request.connection.write_headers.call_args[0]
+        self.assertEqual(start_line.code, 400)
+        self.assertEqual(json.loads(body), {'code': -32601, 'message': 'Method not found.'})
+
+
+class _Stream(object):
+    def __init__(self, items):
+        self.items = list(items)
+
+    @tornado.gen.coroutine
+    def get(self):
+        if not self.items:
+            raise ChokeEvent()
+        item = self.items.pop(0)
+        if isinstance(item, ServiceError):
+            raise item
+        raise tornado.gen.Return(item)
+
+
+class TestJSONRPCStreaming(AsyncHTTPTestCase):
+    def get_app(self):
+        service = mock.Mock()
+        service.api = {0: ['watch', JSONRPC.STREAMING, JSONRPC.STREAMING]}
+
+        def watch(items):
+            channel = mock.Mock()
+            items = [ServiceError('app', 'failed', 1, 42) if item == 'fail' else item for item in items]
+            channel.rx = _Stream(items + [EmptyResponse()])
+            return tornado.gen.maybe_future(channel)
+        service.watch.side_effect = watch
+
+        proxy = mock.Mock()
+        proxy.get_service.return_value = tornado.gen.maybe_future(service)
+        plugin = JSONRPC(proxy, {})
+
+        def handle(request):
+            request.logger = NULLLOGGER
+            plugin.process(request)
+        return handle
+
+    def fetch_lines(self, items, accept='application/x-ndjson'):
+        body = json.dumps({'jsonrpc': '2.0', 'method': 'app.watch', 'params': [items], 'id': 7})
+        response = self.fetch('/', method='POST', body=body,
+                              headers={'X-Cocaine-JSON-RPC': '1', 'Accept': accept})
+        return response, [json.loads(line) for line in response.body.splitlines()]
+
+    def test_stream(self):
+        response, lines = self.fetch_lines(['a', 'b', 'c'])
+        self.assertEqual(response.headers['Content-Type'], 'application/x-ndjson')
+        self.assertEqual(response.headers['Transfer-Encoding'], 'chunked')
+        self.assertEqual([line.get('chunk') for line in lines[:3]], ['a', 'b', 'c'])
+        self.assertEqual(lines[3], {'jsonrpc': '2.0', 'id': 7, 'status': 'ok', 'chunks': 3})
+
+    def test_stream_error(self):
+        _, lines = self.fetch_lines(['a', 'fail'])
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(lines[1]['status'], 'error')
+
+    def test_buffered(self):
+        _, lines = self.fetch_lines(['a', 'b'], accept='application/json')
+        self.assertEqual(lines, [{'jsonrpc': '2.0', 'id': 7, 'result': ['a', 'b']}])
+
+
+def test_closed_stream_is_accounted():
+    request = mock.Mock()
+    request.request_time.return_value = 0.25
+    streamer = NDJSONStream(request, 7)
+    streamer.closed = True
+    streamer.finish()
+    assert request.response_code == 200
+    assert request.response_time == 0.25
+    request.connection.write.assert_not_called()
+
+
+def test_api_tables():
+    compiled = []
+
+    def compile_table(api):
+        compiled.append(api)
+        return dict((data[0], data[0].upper()) for data in api.itervalues())
+
+    tables = APITables(compile_table)
+    service = mock.Mock(api={0: ['read', {}, JSONRPC.PRIMITIVE]})
+    service.name = 'storage'
+    assert tables.get(service) == {'read': 'READ'}
+    assert tables.get(service) == {'read': 'READ'}
+    assert len(compiled) == 1
+
+    # another instance or a reconnect with the same API
+    cached = service.api
+    service.api = {0: ['read', {}, JSONRPC.PRIMITIVE]}
+    assert tables.get(service) == {'read': 'READ'}
+    assert service.api is cached
+    assert len(compiled) == 1
+
+    # a new version of the service
+    service.api = {0: ['read', {}, JSONRPC.PRIMITIVE], 1: ['write', {}, JSONRPC.PRIMITIVE]}
+    assert tables.get(service) == {'read': 'READ', 'write': 'WRITE'}
+    assert len(compiled) == 2
+    assert list(tables.tables) == ['storage']
+
+
+def test_compile_api():
+    plugin = JSONRPC(mock.Mock(), {})
+    table = plugin.compile_api({0: ['emit', {}, {}],
+                                1: ['read', {}, JSONRPC.PRIMITIVE],
+                                2: ['watch', JSONRPC.STREAMING, JSONRPC.STREAMING],
+                                3: ['odd', {}, {0: ['chunk', None]}]})
+    assert table == {'emit': plugin._handle_mute, 'read': plugin._handle_primitive,
+                     'watch': plugin._handle_streaming, 'odd': None}
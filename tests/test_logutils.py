@@ -0,0 +1,146 @@
+import logging
+import logging.handlers
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import mock
+from tornado.testing import AsyncTestCase
+from tornado.testing import gen_test
+from tornado import gen
+
+from cocaine.proxy.logutils import AsyncHandler
+from cocaine.proxy.logutils import render_record
+
+
+def _make_logger(name, handler):
+    logger = logging.getLogger(name)
+    logger.propagate = False
+    logger.setLevel(logging.DEBUG)
+    logger.handlers = [handler]
+    return logger
+
+
+def test_async_handler_writes_batches():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, "access.log")
+        target = logging.handlers.WatchedFileHandler(path)
+        target.setFormatter(logging.Formatter("%(levelname)s %(message)s"))
+        handler = AsyncHandler(target)
+        logger = _make_logger("test.logutils.file", handler)
+
+        for i in xrange(100):
+            logger.info("request %d", i)
+        time.sleep(0.1)
+        # it's moved away by logrotate
+        os.rename(path, path + ".1")
+        logger.error("after rotation")
+        handler.close()
+
+        with open(path + ".1") as f:
+            assert f.read().splitlines() == ["INFO request %d" % i for i in xrange(100)]
+        with open(path) as f:
+            assert f.read() == "ERROR after rotation\n"
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_async_handler_renders_on_emit():
+    released = threading.Event()
+    target = mock.Mock(spec=logging.Handler, level=logging.NOTSET)
+    target.handle.side_effect = lambda record: released.wait()
+    handler = AsyncHandler(target)
+    logger = _make_logger("test.logutils.render", handler)
+    state = {"stage": "headers"}
+    try:
+        logger.info("request state %s", state)
+        # the event loop goes on with the request
+        state["stage"] = "body"
+        try:
+            raise ValueError("broken")
+        except ValueError:
+            logger.exception("failed")
+    finally:
+        released.set()
+        handler.close()
+    first, second = [call[0][0] for call in target.handle.call_args_list]
+    assert first.getMessage() == "request state {'stage': 'headers'}"
+    assert second.exc_info is None
+    assert second.getMessage().startswith("failed\nTraceback")
+
+
+def test_async_handler_renders_in_writer_thread():
+    rendered_in = []
+
+    def render(record):
+        rendered_in.append(threading.current_thread())
+        return render_record(record)
+
+    target = mock.Mock(spec=logging.Handler, level=logging.NOTSET)
+    with mock.patch("cocaine.proxy.logutils.render_record", side_effect=render):
+        handler = AsyncHandler(target)
+        handler.handleError = mock.Mock()
+        logger = _make_logger("test.logutils.thread", handler)
+        logger.info("%d requests of %s", 10, "app")
+        # a broken record does not stop the writer
+        logger.info("%d requests", "many")
+        logger.info("done")
+        handler.close()
+
+    assert threading.current_thread() not in rendered_in
+    assert [call[0][0].getMessage() for call in target.handle.call_args_list] == ["10 requests of app", "done"]
+    assert handler.handleError.call_count == 1
+
+
+def test_async_handler_drops_on_overflow():
+    released = threading.Event()
+    taken = threading.Event()
+
+    def handle(record):
+        taken.set()
+        released.wait()
+
+    target = mock.Mock(spec=logging.Handler, level=logging.NOTSET)
+    target.handle.side_effect = handle
+    handler = AsyncHandler(target, capacity=1)
+    try:
+        # the first one is being written, the second one is queued
+        handler.emit(logging.makeLogRecord({"msg": "first"}))
+        taken.wait(1)
+        for _ in xrange(3):
+            handler.emit(logging.makeLogRecord({"msg": "record"}))
+        assert handler.dropped == 2
+    finally:
+        released.set()
+        handler.close()
+    assert target.handle.call_count == 2
+
+
+class TestAsyncHandlerLoop(AsyncTestCase):
+    @gen_test
+    def test_records_are_delivered_in_loop(self):
+        delivered = []
+
+        class _LoopHandler(logging.Handler):
+            def emit(this, record):
+                delivered.append((record.getMessage(), threading.current_thread()))
+
+        handler = AsyncHandler(_LoopHandler(), io_loop=self.io_loop)
+        logger = _make_logger("test.logutils.loop", handler)
+        try:
+            raise ValueError("boom")
+        except ValueError:
+            logger.exception("failed %s", "request")
+
+        for _ in xrange(50):
+            if delivered:
+                break
+            yield gen.sleep(0.01)
+
+        message, thread = delivered[0]
+        assert message.startswith("failed request\nTraceback")
+        assert "ValueError: boom" in message
+        assert thread is threading.current_thread()
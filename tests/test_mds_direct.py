@@ -0,0 +1,291 @@
+import json
+from io import BytesIO
+
+import mock
+from nose import tools
+
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.httpclient import HTTPError
+from tornado.httpclient import HTTPRequest
+from tornado.testing import AsyncTestCase
+from tornado.testing import gen_test
+
+from cocaine.exceptions import ServiceError
+
+from cocaine.proxy.logutils import NULLLOGGER
+from cocaine.proxy.memory import count_timeouts
+from cocaine.proxy.mds_direct import credentials_digest
+from cocaine.proxy.mds_direct import MDSDirect
+from cocaine.proxy.mds_direct import ServicePool
+from cocaine.proxy.plugin import PluginConfigurationError
+from cocaine.proxy.plugin import PluginNoSuchApplication
+from cocaine.proxy.proxy import ESERVICENOTAVAILABLE
+from cocaine.proxy.proxy import LOCATORCATEGORY
+
+from fake_runtime import FakeApp
+from fake_runtime import FakeRuntime
+
+
+CONFIG = {
+    "dist_info_endpoint": "http://mulcagate",
+    "mds_dist_info_endpoint": "http://mds",
+    "locator_port": 10053,
+}
+
+KEY = (False, "namespace", "123/key")
+DIST_INFO = json.dumps({"primary": [{"host": "a"}, {"host": "b"}, {"host": "c"}]})
+
+
+def make_request(authorization="token"):
+    request = mock.Mock()
+    request.logger = NULLLOGGER
+    headers = {} if authorization is None else {"Authorization": authorization}
+    return request, HTTPRequest("http://mds/dist-info-namespace/123/key", headers=headers)
+
+
+class TestDistInfoCache(AsyncTestCase):
+    def setUp(self):
+        super(TestDistInfoCache, self).setUp()
+        self.plugin = MDSDirect(mock.Mock(io_loop=self.io_loop), CONFIG)
+        self.fetches = []
+        self.plugin.srw_httpclient = mock.Mock()
+        self.plugin.srw_httpclient.fetch.side_effect = self.fetch
+
+    def fetch(self, request):
+        future = Future()
+        self.fetches.append(future)
+        return future
+
+    def reply(self, future, body=None, code=200):
+        if code == 200:
+            future.set_result(mock.Mock(buffer=BytesIO(body)))
+        else:
+            future.set_exception(HTTPError(code))
+
+    @gen_test
+    def test_coalesced_and_cached(self):
+        first = self.plugin.fetch_mds_endpoints(*make_request(), cache_key=KEY)
+        second = self.plugin.fetch_mds_endpoints(*make_request(), cache_key=KEY)
+        yield gen.moment
+        self.assertEqual(len(self.fetches), 1)
+        self.reply(self.fetches[0], DIST_INFO)
+
+        endpoints = yield [first, second]
+        self.assertEqual(sorted(endpoints[0]), [("a", 10053), ("b", 10053), ("c", 10053)])
+        self.assertEqual(sorted(endpoints[1]), sorted(endpoints[0]))
+        self.assertIsNot(endpoints[0], endpoints[1])
+
+        cached = yield self.plugin.fetch_mds_endpoints(*make_request(), cache_key=KEY)
+        self.assertEqual(sorted(cached), sorted(endpoints[0]))
+        self.assertEqual(len(self.fetches), 1)
+        self.assertEqual(self.plugin.dist_info_fetches, {})
+
+    @gen_test
+    def test_not_found_is_cached(self):
+        first = self.plugin.fetch_mds_endpoints(*make_request(), cache_key=KEY)
+        yield gen.moment
+        self.reply(self.fetches[0], code=404)
+        with self.assertRaises(PluginNoSuchApplication):
+            yield first
+
+        with self.assertRaises(PluginNoSuchApplication):
+            yield self.plugin.fetch_mds_endpoints(*make_request(), cache_key=KEY)
+        self.assertEqual(len(self.fetches), 1)
+
+        self.plugin.dist_info_cache.pop(KEY + (credentials_digest(make_request()[1]),))
+        second = self.plugin.fetch_mds_endpoints(*make_request(), cache_key=KEY)
+        yield gen.moment
+        self.assertEqual(len(self.fetches), 2)
+        self.reply(self.fetches[1], DIST_INFO)
+        yield second
+
+    @gen_test
+    def test_credentials_are_not_coalesced(self):
+        denied, srw_request = make_request("wrong")
+        denied.response_code = None
+        first = self.plugin.fetch_mds_endpoints(denied, srw_request, cache_key=KEY)
+        second = self.plugin.fetch_mds_endpoints(*make_request(), cache_key=KEY)
+        yield gen.moment
+        self.assertEqual(len(self.fetches), 2)
+
+        error = HTTPError(401, response=mock.Mock(body="denied", headers={}))
+        self.fetches[0].set_exception(error)
+        self.reply(self.fetches[1], DIST_INFO)
+        with mock.patch("cocaine.proxy.mds_direct.fill_response_in") as fill_response_in:
+            result = yield first
+        self.assertIsNone(result)
+        fill_response_in.assert_called_once_with(denied, 401, mock.ANY, "denied", {})
+        endpoints = yield second
+        self.assertEqual(len(endpoints), 3)
+
+    @gen_test
+    def test_credentials_are_not_cached(self):
+        first = self.plugin.fetch_mds_endpoints(*make_request(), cache_key=KEY)
+        yield gen.moment
+        self.reply(self.fetches[0], DIST_INFO)
+        yield first
+
+        # the cached endpoints are not served to other credentials
+        for authorization in ("wrong", None):
+            denied, srw_request = make_request(authorization)
+            pending = self.plugin.fetch_mds_endpoints(denied, srw_request, cache_key=KEY)
+            yield gen.moment
+            self.fetches[-1].set_exception(HTTPError(401, response=mock.Mock(body="denied", headers={})))
+            with mock.patch("cocaine.proxy.mds_direct.fill_response_in") as fill_response_in:
+                result = yield pending
+            self.assertIsNone(result)
+            fill_response_in.assert_called_once_with(denied, 401, mock.ANY, "denied", {})
+        self.assertEqual(len(self.fetches), 3)
+
+
+class TestReelectApp(AsyncTestCase):
+    def setUp(self):
+        super(TestReelectApp, self).setUp()
+        config = dict(CONFIG, service_connect_stagger_ms=20, service_connect_timeout_ms=500)
+        self.plugin = MDSDirect(mock.Mock(io_loop=self.io_loop), config)
+        self.request = make_request()[0]
+        self.attempts = {}
+
+    def connect_endpoint(self, request, name, endpoint):
+        future = Future()
+        self.attempts[endpoint] = future
+        return future
+
+    @gen_test
+    def test_staggered_race(self):
+        self.plugin.connect_endpoint = self.connect_endpoint
+        endpoints = [("a", 1), ("b", 1), ("c", 1)]
+        reelection = self.plugin.reelect_app(self.request, None, "app", endpoints)
+        self.assertEqual(list(self.attempts), [("a", 1)])
+
+        # "a" hangs, so "b" is started after the stagger delay
+        yield gen.sleep(0.03)
+        self.assertEqual(sorted(self.attempts), [("a", 1), ("b", 1)])
+
+        # the failure of "b" starts "c" at once
+        self.attempts[("b", 1)].set_exception(ServiceError("locator", "not available", ESERVICENOTAVAILABLE,
+                                                           LOCATORCATEGORY[0]))
+        yield gen.moment
+        self.assertIn(("c", 1), self.attempts)
+
+        winner, loser = mock.Mock(), mock.Mock()
+        self.attempts[("c", 1)].set_result(winner)
+        app = yield reelection
+        self.assertIs(app, winner)
+        # the next reelection goes to the still racing host only
+        self.assertEqual(endpoints, [("a", 1)])
+
+        self.attempts[("a", 1)].set_result(loser)
+        yield gen.moment
+        loser.disconnect.assert_not_called()
+
+    def pending_launches(self):
+        return [name for name in count_timeouts(self.io_loop) if ".launch:" in name]
+
+    @gen_test
+    def test_stagger_is_cancelled_by_winner(self):
+        self.plugin.connect_endpoint = self.connect_endpoint
+        reelection = self.plugin.reelect_app(self.request, None, "app", [("a", 1), ("b", 1)])
+        self.assertEqual(len(self.pending_launches()), 1)
+        self.attempts[("a", 1)].set_result(mock.Mock())
+        yield reelection
+        self.assertEqual(self.pending_launches(), [])
+
+    @gen_test
+    def test_fallback_to_common_pool(self):
+        self.plugin.connect_endpoint = self.connect_endpoint
+        fallback = Future()
+        fallback.set_result("pool")
+        self.plugin.proxy.reelect_app.return_value = fallback
+        self.plugin.proxy.get_service.return_value = fallback
+
+        reelection = self.plugin.reelect_app(self.request, "busy", "app", [("a", 1), ("b", 1)])
+        self.attempts[("a", 1)].set_exception(gen.TimeoutError())
+        yield gen.moment
+        self.attempts[("b", 1)].set_exception(gen.TimeoutError())
+        app = yield reelection
+        self.assertEqual(app, "pool")
+        self.plugin.proxy.reelect_app.assert_called_once_with(self.request, "busy")
+
+        app = yield self.plugin.reelect_app(self.request, None, "app", [])
+        self.assertEqual(app, "pool")
+        self.plugin.proxy.get_service.assert_called_once_with("app", self.request)
+
+    @gen_test
+    def test_unexpected_error(self):
+        self.plugin.connect_endpoint = self.connect_endpoint
+        reelection = self.plugin.reelect_app(self.request, None, "app", [("a", 1)])
+        self.attempts[("a", 1)].set_exception(ServiceError("locator", "denied", 2, 42))
+        with self.assertRaises(ServiceError):
+            yield reelection
+
+    @gen_test
+    def test_fake_runtime(self):
+        runtime = FakeRuntime([FakeApp("echo")])
+        try:
+            unreachable = ("127.0.0.1", 1)
+            endpoint = ("127.0.0.1", runtime.locator.port)
+            endpoints = [unreachable, endpoint]
+            app = yield self.plugin.reelect_app(self.request, None, "echo", endpoints)
+            self.assertEqual(endpoints, [])
+            self.assertFalse(app.locator._connected)
+            channel = yield app.enqueue("ping")
+            yield channel.tx.close()
+            yield channel.rx.get()
+
+            # the next request reuses the connection
+            pooled = yield self.plugin.reelect_app(self.request, None, "echo", [endpoint])
+            self.assertIs(pooled, app)
+            self.assertEqual(len(self.plugin.service_pool), 1)
+
+            # a broken connection is not reused
+            app.disconnect()
+            reconnected = yield self.plugin.reelect_app(self.request, None, "echo", [endpoint])
+            self.assertIsNot(reconnected, app)
+        finally:
+            runtime.stop()
+
+    @gen_test
+    def test_concurrent_connects_are_coalesced(self):
+        connects = []
+
+        def connect_service(request, name, endpoint, key):
+            connects.append(Future())
+            return connects[-1]
+
+        self.plugin.connect_service = connect_service
+        first = self.plugin.connect_endpoint(self.request, "app", ("a", 1))
+        second = self.plugin.connect_endpoint(self.request, "app", ("a", 1))
+        self.assertIs(first, second)
+        self.plugin.connect_endpoint(self.request, "other", ("a", 1))
+        self.assertEqual(len(connects), 2)
+
+
+@mock.patch("cocaine.proxy.mds_direct.PeriodicCallback")
+def test_service_pool_idle_timeout(periodic_callback):
+    MDSDirect(mock.Mock(), dict(CONFIG, service_pool_idle_timeout=0))
+    periodic_callback.assert_not_called()
+    plugin = MDSDirect(mock.Mock(), dict(CONFIG, service_pool_idle_timeout=1))
+    periodic_callback.assert_called_once_with(plugin.evict_idle_services, 500, io_loop=plugin.proxy.io_loop)
+
+
+@tools.raises(PluginConfigurationError)
+def test_negative_service_pool_idle_timeout():
+    MDSDirect(mock.Mock(), dict(CONFIG, service_pool_idle_timeout=-1))
+
+
+def test_service_pool():
+    pool = ServicePool(idle_timeout=10)
+    first, second = mock.Mock(_connected=True), mock.Mock(_connected=True)
+    pool.put("a", first, now=0)
+    pool.put("b", second, now=0)
+    assert pool.get("a", now=5) is first
+    assert pool.evict_idle(now=12) == 1
+    second.disconnect.assert_called_once_with()
+    second.locator.disconnect.assert_called_once_with()
+    assert pool.get("b") is None
+
+    first._connected = False
+    assert pool.get("a", now=6) is None
+    assert len(pool) == 0
@@ -28,6 +28,7 @@ from tornado.testing import gen_test
 from cocaine.proxy.proxy import CocaineProxy
 from cocaine.proxy.logutils import NULLLOGGER
 from cocaine.proxy.mds_exec import MDSExec
+from cocaine.proxy.mds_exec import ReplyDecoder
 from cocaine.proxy.mds_exec import is_mds_stid
 
 
@@ -39,6 +40,7 @@ class _FakeConnection():
         self.start_line = None
         self.headers = None
         self.chunks = list()
+        self.closed = False
 
     def write_headers(self, start_line, headers, chunk=None, callback=None):
         self.start_line = start_line
@@ -56,6 +58,9 @@ class _FakeConnection():
     def finish(self):
         pass
 
+    def close(self):
+        self.closed = True
+
 
 def test_is_mds_stid():
     assert not is_mds_stid("77777.270212926.1074746148309135132")
@@ -73,9 +78,25 @@ class TestMDSExec(AsyncHTTPTestCase):
             self.assertEqual(body, "body")
             self.assertEqual(len(headers), 6)  # 4 + 2
             self.assertEqual(request.query_arguments["timeout"], ["30"])
-            request.connection.write_headers(httputil.ResponseStartLine("HTTP/1.1", 200, "OK"),
-                                             httputil.HTTPHeaders(), chunk=msgpack.packb((202, [("A", "B")])))
+            reply = request.headers["Authorization"].split()[-1]
+            if reply == "denied":
+                request.connection.write_headers(httputil.ResponseStartLine("HTTP/1.1", 401, "Unauthorized"),
+                                                 httputil.HTTPHeaders({"Content-Length": "6"}), chunk="denied")
+                request.connection.finish()
+                return
+
+            # SRW replies 201 to some requests
+            code = 201 if reply == "created" else 200
+            headers = httputil.HTTPHeaders()
+            if reply == "broken":
+                headers["Content-Length"] = "1000"
+            request.connection.write_headers(httputil.ResponseStartLine("HTTP/1.1", code, "OK"),
+                                             headers, chunk=msgpack.packb((202, [("A", "B")])))
             request.connection.write("CHUNK1")
+            if reply == "broken":
+                # SRW goes away in the middle of the body
+                request.connection.close()
+                return
             request.connection.write("CHUNK2")
             request.connection.write("CHUNK3")
             request.connection.finish()
@@ -100,9 +121,7 @@ class TestMDSExec(AsyncHTTPTestCase):
         })
         self.assertFalse(mdsplugin.match(request))
 
-    @gen_test
-    def test_mds_process(self):
-        mdsplugin = MDSExec(CocaineProxy(), {"srw_host": "http://localhost:%d" % self.get_http_port()})
+    def make_request(self, authorization="Basic aaabbb"):
         conn = _FakeConnection()
         req = HTTPServerRequest(method="PUT", uri="/blabla",
                                 version="HTTP/1.1", headers={
@@ -111,14 +130,94 @@ class TestMDSExec(AsyncHTTPTestCase):
                                     "X-Srw-Key": "320.namespace:301123837.E150591:1046883323",
                                     "X-Srw-Namespace": "namespace",
                                     "X-Srw-Key-Type": "mds",
-                                    "Authorization": "Basic aaabbb",
+                                    "Authorization": authorization,
                                 },
                                 connection=conn,
                                 body="body", host="localhost")
         req.logger = NULLLOGGER
-        yield mdsplugin.process(req)
+        return req, conn
+
+    def make_plugin(self):
+        return MDSExec(CocaineProxy(), {"srw_host": "http://localhost:%d" % self.get_http_port()})
+
+    @gen_test
+    def test_mds_process(self):
+        mdsplugin = self.make_plugin()
+        for authorization in ("Basic aaabbb", "Basic created"):
+            req, conn = self.make_request(authorization)
+            yield mdsplugin.process(req)
+            self.assertEqual(conn.start_line.code, 202)
+            self.assertEqual(conn.start_line.version, "HTTP/1.1")
+            # the body is passed in chunks as it arrives
+            self.assertEqual(conn.headers["Transfer-Encoding"], "chunked")
+            self.assertEqual(dechunk(conn.chunks), "CHUNK1CHUNK2CHUNK3")
+            self.assertEqual(conn.headers["A"], "B")
+
+    @gen_test
+    def test_mds_process_unauthorized(self):
+        req, conn = self.make_request("Basic denied")
+        yield self.make_plugin().process(req)
+        self.assertEqual(conn.start_line.code, 401)
+        self.assertEqual(''.join(conn.chunks), "denied")
+        self.assertFalse(conn.closed)
+
+    @gen_test
+    def test_mds_process_broken_off(self):
+        req, conn = self.make_request("Basic broken")
+        yield self.make_plugin().process(req)
+        # the client has got the headers and the beginning of the body
         self.assertEqual(conn.start_line.code, 202)
-        self.assertEqual(conn.start_line.version, "HTTP/1.1")
-        self.assertEqual(len(conn.chunks), 1)
-        self.assertEqual(''.join(conn.chunks), "CHUNK1CHUNK2CHUNK3")
-        self.assertEqual(conn.headers["A"], "B")
+        self.assertTrue(''.join(conn.chunks).startswith("6\r\nCHUNK1"))
+        self.assertTrue(conn.closed)
+        # it's still counted in the metrics and the access log
+        self.assertEqual(req.response_code, 202)
+        self.assertGreater(req.response_time, 0)
+
+
+def dechunk(chunks):
+    data, body = ''.join(chunks), []
+    while True:
+        size, data = data.split("\r\n", 1)
+        if int(size, 16) == 0:
+            return ''.join(body)
+        body.append(data[:int(size, 16)])
+        data = data[int(size, 16) + 2:]
+
+
+def make_request(version="HTTP/1.1"):
+    conn = _FakeConnection()
+    request = HTTPServerRequest(method="GET", uri="/app/event", version=version, connection=conn)
+    request.logger = NULLLOGGER
+    return request, conn
+
+
+def test_reply_decoder():
+    request, conn = make_request()
+    decoder = ReplyDecoder(request, "app")
+    decoder.on_header("HTTP/1.1 200 OK\r\n")
+    reply = msgpack.packb((200, [("X-Header", "value")])) + "first"
+    # the frame is split between reads
+    for byte in reply:
+        decoder.on_chunk(byte)
+    assert conn.start_line.code == 200
+    assert conn.headers["X-Header"] == "value"
+    decoder.on_chunk("second")
+    decoder.finish()
+    assert dechunk(conn.chunks) == "firstsecond"
+    assert decoder.body_size == len("firstsecond")
+
+    # HTTP/1.0 client gets the body with Content-Length
+    request, conn = make_request("HTTP/1.0")
+    decoder = ReplyDecoder(request, "app")
+    decoder.on_header("HTTP/1.1 200 OK\r\n")
+    decoder.on_chunk(msgpack.packb((200, [])) + "body")
+    assert conn.start_line is None
+    assert not decoder.streaming
+    decoder.finish()
+    assert conn.headers["Content-Length"] == "4"
+    assert ''.join(conn.chunks) == "body"
+
+    decoder = ReplyDecoder(request, "app")
+    decoder.on_header("HTTP/1.1 401 Unauthorized\r\n")
+    decoder.on_chunk("denied")
+    assert decoder.error_body() == "denied"
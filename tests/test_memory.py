@@ -0,0 +1,66 @@
+import functools
+
+import mock
+
+from tornado.ioloop import IOLoop
+from tornado.testing import AsyncHTTPTestCase
+
+from cocaine.proxy.memory import callback_name
+from cocaine.proxy.memory import count_objects
+from cocaine.proxy.memory import count_timeouts
+from cocaine.proxy.memory import diff_counts
+from cocaine.proxy.memory import MemoryTracker
+from cocaine.proxy.utilserver import UtilServer
+
+
+class _Tracked(object):
+    pass
+
+
+def _callback(*args):
+    pass
+
+
+def test_count_objects():
+    objects = [_Tracked() for _ in xrange(10)]
+    assert count_objects()["test_memory._Tracked"] >= len(objects)
+
+
+def test_count_timeouts():
+    io_loop = IOLoop()
+    try:
+        io_loop.call_later(10, _callback)
+        io_loop.call_later(10, functools.partial(_callback, 1))
+        cancelled = io_loop.call_later(10, _callback)
+        io_loop.remove_timeout(cancelled)
+        assert count_timeouts(io_loop) == {callback_name(_callback): 2}
+        assert callback_name(_callback).startswith("test_memory._callback:")
+    finally:
+        io_loop.close()
+
+
+def test_memory_tracker_diff():
+    assert diff_counts({"a": 1, "b": 2}, {"b": 5, "c": 1}) == {"a": -1, "b": 3, "c": 1}
+
+    tracker = MemoryTracker()
+    assert tracker.snapshot({"objects": {"dict": 10}}, now=100) is None
+    diff = tracker.snapshot({"objects": {"dict": 15, "list": 1}}, now=130)
+    assert diff == {"objects": {"dict": 5, "list": 1}, "interval": 30}
+
+
+class TestMemoryHandler(AsyncHTTPTestCase):
+    def get_app(self):
+        self.proxy = mock.Mock()
+        self.proxy.memory_info.return_value = {"objects": {}}
+        return UtilServer(self.proxy)
+
+    def test_top(self):
+        response = self.fetch("/memory?top=5")
+        self.assertEqual(response.code, 200)
+        self.proxy.memory_info.assert_called_once_with(5)
+
+    def test_invalid_top(self):
+        for top in ("abc", "-1"):
+            response = self.fetch("/memory?top=%s" % top)
+            self.assertEqual(response.code, 400)
+        self.proxy.memory_info.assert_not_called()
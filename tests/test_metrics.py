@@ -0,0 +1,114 @@
+from cocaine.proxy.metrics import COUNTER
+from cocaine.proxy.metrics import GAUGE
+from cocaine.proxy.metrics import HISTOGRAM_FACTOR
+from cocaine.proxy.metrics import HISTOGRAM
+from cocaine.proxy.metrics import Histogram
+from cocaine.proxy.metrics import LatencyHistograms
+from cocaine.proxy.metrics import MetricsRegistry
+from cocaine.proxy.metrics import OVERFLOW_LABEL
+from cocaine.proxy.metrics import status_class
+
+
+def test_histogram_percentiles():
+    hist = Histogram()
+    for value in xrange(1, 1001):
+        hist.record(float(value))
+
+    assert hist.count == 1000
+    assert hist.max == 1000.0
+    for p, expected in ((50, 500), (90, 900), (99, 990)):
+        value = hist.percentile(p)
+        assert expected <= value <= expected * HISTOGRAM_FACTOR, (p, value)
+    assert hist.percentile(100) == 1000.0
+
+
+def test_histogram_extremes():
+    hist = Histogram()
+    assert hist.percentile(99) == 0.0
+    hist.record(0)
+    hist.record(10 ** 9)
+    assert hist.counts[0] == 1
+    assert hist.counts[-1] == 1
+
+
+def test_histogram_dump_load_merge():
+    first, second = Histogram(), Histogram()
+    first.record(1)
+    second.record(100)
+    second.record(100)
+
+    loaded = Histogram.load(second.dump())
+    assert loaded.counts == second.counts
+    first.merge(loaded)
+    assert first.count == 3
+    assert first.sum == 201
+    assert first.max == 100
+
+
+def test_latency_histograms():
+    histograms = LatencyHistograms(max_series=2)
+    histograms.record("app", "event", 200, 10.0, 4.0)
+    histograms.record("app", "event", 204, 20.0, 5.0)
+    histograms.record("app", "other", 502, 1000.0)
+    histograms.record("app", "third", 200, 1.0)
+
+    assert set(histograms.series) == set([("app", "event", "2xx"),
+                                          ("app", "other", "5xx"),
+                                          ("app", OVERFLOW_LABEL, "2xx")])
+    series = histograms.series[("app", "event", "2xx")]
+    assert series.total.count == 2
+    assert series.body.sum == 21.0
+
+    merged = LatencyHistograms()
+    merged.merge(LatencyHistograms.load(histograms.dump()))
+    merged.merge(histograms)
+    summary = merged.summary(app="app")
+    assert summary[0]["status"] == "5xx"
+    assert summary[0]["total"]["count"] == 2
+    assert merged.summary(app="unknown") == []
+
+
+def test_status_class():
+    assert status_class(200) == "2xx"
+    assert status_class(504) == "5xx"
+
+
+def test_metrics_registry_render():
+    registry = MetricsRegistry(max_series=2)
+    registry.define("requests_total", COUNTER, "Requests", ("app", "code"))
+    registry.define("pool_size", GAUGE, "Pool size", ("app",))
+    registry.incr("requests_total", ("a", 200))
+    registry.incr("requests_total", ("a", 200))
+    registry.incr("requests_total", ("b\"", 502))
+    registry.incr("requests_total", ("c", 200))
+    registry.set("pool_size", ("a",), 3)
+
+    other = MetricsRegistry()
+    other.define("requests_total", COUNTER, "Requests", ("app", "code"))
+    other.incr("requests_total", ("a", 200), 5)
+
+    text = registry.render([(0, registry.dump()), (1, other.dump())])
+    assert text.splitlines() == [
+        '# HELP pool_size Pool size',
+        '# TYPE pool_size gauge',
+        'pool_size{app="a",worker="0"} 3',
+        '# HELP requests_total Requests',
+        '# TYPE requests_total counter',
+        'requests_total{app="__overflow__",code="__overflow__"} 1',
+        'requests_total{app="a",code="200"} 7',
+        'requests_total{app="b\\"",code="502"} 1',
+    ]
+
+
+def test_metrics_registry_histogram():
+    registry = MetricsRegistry()
+    registry.define("lag_seconds", HISTOGRAM, "Lag")
+    for value in (0.5, 3, 3, 20000):
+        registry.observe("lag_seconds", (), value)
+
+    lines = registry.render([(0, registry.dump())]).splitlines()
+    assert 'lag_seconds_bucket{worker="0",le="0.001"} 1' in lines
+    assert 'lag_seconds_bucket{worker="0",le="0.005"} 3' in lines
+    assert 'lag_seconds_bucket{worker="0",le="10"} 3' in lines
+    assert 'lag_seconds_bucket{worker="0",le="+Inf"} 4' in lines
+    assert 'lag_seconds_count{worker="0"} 4' in lines
@@ -0,0 +1,49 @@
+import time
+
+import mock
+from tornado.testing import AsyncTestCase
+from tornado.testing import gen_test
+from tornado import gen
+
+from cocaine.proxy.monitor import describe_request
+from cocaine.proxy.monitor import LoopLagMonitor
+
+
+class TestLoopLagMonitor(AsyncTestCase):
+    @gen_test
+    def test_lag_is_reported(self):
+        lags = []
+        monitor = LoopLagMonitor(self.io_loop, lags.append, period=0.01)
+        monitor.start()
+
+        # blocks the loop right before the tick
+        self.io_loop.call_later(0.005, time.sleep, 0.05)
+        yield gen.sleep(0.05)
+        self.assertTrue(lags)
+        self.assertTrue(max(lags) >= 0.03, lags)
+
+    @gen_test
+    def test_watchdog_dumps_blocked_request(self):
+        logger = mock.Mock()
+        monitor = LoopLagMonitor(self.io_loop, lambda lag: None, period=0.01,
+                                 watchdog_threshold=0.02, logger=logger)
+        monitor.start()
+        yield gen.sleep(0.02)
+
+        def blocking_handler(request):
+            time.sleep(0.2)
+
+        request = mock.Mock(app_name="app", traceid="deadbeef")
+        blocking_handler(request)
+        yield gen.sleep(0.02)
+
+        self.assertEqual(monitor.stalls, 1)
+        message, blocked, app, traceid, stack = logger.error.call_args[0]
+        self.assertEqual((app, traceid), ("app", "deadbeef"))
+        self.assertIn("blocking_handler", stack)
+
+
+def test_describe_request():
+    request = mock.Mock(app_name=None, traceid="1", headers={"X-Cocaine-Service": "app"})
+    assert describe_request(request) == ("app", "1")
+    assert describe_request(None) == ("", "")
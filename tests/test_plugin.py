@@ -0,0 +1,94 @@
+from tornado import gen
+from tornado import web
+from tornado.httpclient import HTTPError
+from tornado.httpclient import HTTPRequest
+from tornado.httputil import HTTPHeaders
+from tornado.testing import AsyncHTTPTestCase
+from tornado.testing import gen_test
+
+from cocaine.proxy.proxy import CocaineProxy
+from cocaine.proxy.plugin import PluginConfigurationError
+from cocaine.proxy.plugin import IPlugin
+from cocaine.proxy.plugin import PluginHTTPClient
+from cocaine.proxy.plugin import PluginIndex
+
+
+class SlowHandler(web.RequestHandler):
+    @gen.coroutine
+    def get(self):
+        yield gen.sleep(float(self.get_argument("delay", 0)))
+        self.write("done")
+
+
+class TestPluginHTTPClient(AsyncHTTPTestCase):
+    def get_app(self):
+        return web.Application([("/", SlowHandler)])
+
+    def setUp(self):
+        super(TestPluginHTTPClient, self).setUp()
+        self.proxy = CocaineProxy(locators=["localhost:1"], allow_json_rpc=False, ioloop=self.io_loop)
+
+    def queue_waits(self):
+        for labels, hist in self.proxy.metrics.values["cocaine_proxy_plugin_http_queue_seconds"].iteritems():
+            if labels == ("test",):
+                return hist
+        return None
+
+    @gen_test
+    def test_queue(self):
+        client = PluginHTTPClient("test", self.proxy, {"max_clients": 1, "request_timeout": 5})
+        self.assertEqual(client.client.max_clients, 1)
+        first = client.fetch(HTTPRequest(self.get_url("/?delay=0.1")))
+        second = client.fetch(HTTPRequest(self.get_url("/")))
+        responses = yield [first, second]
+        self.assertEqual([r.body for r in responses], ["done", "done"])
+
+        hist = self.queue_waits()
+        self.assertEqual(hist.count, 2)
+        # the second request has waited for the first one
+        self.assertGreaterEqual(hist.max, 90)
+
+        slow = client.fetch(HTTPRequest(self.get_url("/?delay=0.2")))
+        with self.assertRaises(HTTPError) as ctx:
+            yield client.fetch(HTTPRequest(self.get_url("/"), request_timeout=0.05))
+        self.assertEqual(ctx.exception.code, 599)
+        yield slow
+
+        # the wait in the queue is a part of the timeout
+        slow = client.fetch(HTTPRequest(self.get_url("/?delay=0.2")))
+        with self.assertRaises(HTTPError) as ctx:
+            yield client.fetch(HTTPRequest(self.get_url("/?delay=0.15"), request_timeout=0.3))
+        self.assertEqual(ctx.exception.code, 599)
+        yield slow
+        client.close()
+
+    def test_configuration(self):
+        client = PluginHTTPClient("test", self.proxy, {"connect_timeout": 1, "request_timeout": 2})
+        self.assertEqual(client.client.defaults["connect_timeout"], 1)
+        self.assertEqual(client.request_timeout, 2)
+
+        with self.assertRaises(PluginConfigurationError):
+            PluginHTTPClient("test", self.proxy, {"implementation": "no.such.Client"})
+
+
+class _Plugin(IPlugin):
+    def __init__(self, name, trigger_headers):
+        self.plugin_name = name
+        self.trigger_headers = trigger_headers
+
+    def name(self):
+        return self.plugin_name
+
+
+def test_plugin_index():
+    srw = _Plugin("srw", ("X-Srw-Key", "x-srw-namespace"))
+    jsonrpc = _Plugin("jsonrpc", ("X-Cocaine-JSON-RPC",))
+    anything = _Plugin("anything", None)
+    index = PluginIndex([srw, jsonrpc, anything])
+
+    assert index.candidates(HTTPHeaders({"Host": "example.com"})) == [anything]
+    assert index.candidates(HTTPHeaders({"X-Srw-Key": "key"})) == [anything]
+    assert index.candidates(HTTPHeaders({"X-Srw-Key": "key", "X-Srw-Namespace": "ns",
+                                         "x-cocaine-json-rpc": "1"})) == [srw, jsonrpc, anything]
+    assert index.candidates(HTTPHeaders({"X-Cocaine-Json-Rpc": "1"})) == [jsonrpc, anything]
+    assert PluginIndex([]).candidates(HTTPHeaders({"X-Srw-Key": "key"})) == []
@@ -0,0 +1,100 @@
+import os
+import sys
+import time
+
+import mock
+from tornado import gen
+from tornado.testing import AsyncTestCase
+from tornado.testing import gen_test
+
+from cocaine.proxy.profiler import collapse
+from cocaine.proxy.profiler import format_collapsed
+from cocaine.proxy.profiler import merge_stacks
+from cocaine.proxy.profiler import ProfilerBusy
+from cocaine.proxy.profiler import ProfilerControl
+from cocaine.proxy.profiler import SamplingProfiler
+from cocaine.proxy.proxy import CocaineProxy
+
+
+def _handle(request, frames):
+    frames.append(collapse(sys._getframe()))
+
+
+def test_collapse_is_attributed_to_request():
+    frames = []
+    _handle(mock.Mock(app_name="app", event_name="ping"), frames)
+    stack = frames[0].split(";")
+    assert stack[0] == "[app/ping]"
+    assert stack[-1].startswith("_handle (test_profiler.py:")
+
+    assert collapse(sys._getframe()).startswith("[-];")
+
+
+def test_sampling_profiler():
+    profiler = SamplingProfiler(interval=0.001)
+    profiler.start()
+    try:
+        try:
+            SamplingProfiler().start()
+        except ProfilerBusy:
+            pass
+        else:
+            assert False, "ProfilerBusy has not been raised"
+
+        deadline = time.time() + 0.2
+        while time.time() < deadline:
+            sum(xrange(1000))
+    finally:
+        counts = profiler.stop()
+
+    assert profiler.samples > 0
+    assert any("test_sampling_profiler" in stack for stack in counts)
+    assert format_collapsed({"a;b": 1, "a;c": 3}) == "a;c 3\na;b 1\n"
+
+
+def test_profiler_control_across_fork():
+    control = ProfilerControl(rows=2)
+    session = control.request(0.1)
+    assert session["workers"] == [0, 1]
+    try:
+        control.request(0.1)
+    except ProfilerBusy:
+        pass
+    else:
+        assert False, "ProfilerBusy has not been raised"
+
+    pid = os.fork()
+    if pid == 0:
+        control.select(1)
+        task = control.pending()
+        control.publish(task["id"], {"[-];main": 2}, 2)
+        os._exit(0)
+    os.waitpid(pid, 0)
+
+    assert control.pending()["id"] == session["id"]
+    assert control.pending() is None
+    control.publish(session["id"], {"[-];main": 1, "[-];other": 1}, 2)
+
+    collected = control.collect(session)
+    assert sorted(collected) == [0, 1]
+    assert merge_stacks(collected.values()) == {"[-];main": 3, "[-];other": 1}
+
+
+class TestProxyProfile(AsyncTestCase):
+    @gen_test(timeout=10)
+    def test_profile_own_worker(self):
+        proxy = CocaineProxy(ioloop=self.io_loop)
+
+        @gen.coroutine
+        def burn():
+            deadline = time.time() + 0.3
+            while time.time() < deadline:
+                sum(xrange(1000))
+                yield gen.moment
+
+        burner = burn()
+        result = yield proxy.profile(0.2, interval=0.001)
+        yield burner
+        self.assertEqual(result["workers"], [0])
+        self.assertEqual(result["missing"], [])
+        self.assertTrue(result["samples"] > 0)
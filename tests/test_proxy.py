@@ -18,12 +18,34 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 #
 
+import os
+import shutil
+import tempfile
+
+import mock
+
+from tornado import gen
+from tornado.concurrent import Future
 from tornado.httputil import HTTPServerRequest
 from tornado.httputil import HTTPHeaders
 
 from cocaine.proxy.helpers import upper_bound
+from cocaine.proxy.accesslog import read_records
+from cocaine.proxy.helpers import dump_snapshot
+from cocaine.proxy.helpers import fill_response_in
+from cocaine.proxy.helpers import mark_stage
+from cocaine.proxy.helpers import RateLimiter
+from cocaine.proxy.helpers import stage_durations
+from cocaine.proxy.helpers import TTLCache
+from cocaine.proxy.proxy import CocaineProxy
+from cocaine.proxy.proxy import drop_unwatched
 from cocaine.proxy.proxy import pack_httprequest
 from cocaine.proxy.proxy import scan_for_updates
+from cocaine.proxy.proxy import WORKER_STATS
+from cocaine.proxy.metrics import LatencyHistograms
+from cocaine.proxy.shared import SharedBoard
+from cocaine.proxy.shared import SharedCounters
+from cocaine.proxy.shared import SharedState
 
 
 class _FakeConnection():
@@ -63,3 +85,287 @@ def test_upper_bound():
     assert upper_bound(l, l[0][0] + 10) == 1
     assert upper_bound(l, l[3][0] + 10) == 4
     assert upper_bound(l, l[4][0] + 10) == 5
+
+
+def test_shared_routing_sync():
+    state = SharedState(size=4096)
+    with mock.patch.object(SharedState, "is_leader", return_value=False):
+        proxy = CocaineProxy(shared_state=state)
+
+    rg = {"A": [[29431330, 'A1'], [82426238, 'A2']]}
+    state.routing.publish({"routing": rg, "locator_status": True})
+    proxy.sync_shared_routing()
+    assert proxy.current_rg == rg
+    assert proxy.locator_status
+    assert proxy.resolve_group_to_version("A", 10) == 'A1'
+
+    # a follower drops only its own resolve result of the updated group, the leader drops the shared one
+    proxy.locator = mock.Mock()
+    with mock.patch.object(SharedState, "is_leader", return_value=False):
+        state.routing.publish({"routing": {"A": [[1, 'A3']]}, "locator_status": True})
+        proxy.sync_shared_routing()
+    proxy.locator.invalidate.assert_called_once_with("A", shared=False)
+
+
+def test_snapshot_restore_and_save():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, "snapshot")
+        dump_snapshot(path, {"version": 1, "timestamp": 0,
+                             "routing": {"A": [[1, "A1"]]},
+                             "timeouts": {"A": {"": 5}},
+                             "sampling": {"A": 100.0}})
+        proxy = CocaineProxy(snapshot_path=path)
+        assert proxy.current_rg == {"A": [[1, "A1"]]}
+        assert proxy.get_timeout("A") == 5
+        assert proxy.sampled_apps == {"A": 100.0}
+
+        proxy.timeouts["B"] = {"": 1}
+        proxy.save_snapshot()
+        assert CocaineProxy(snapshot_path=path).get_timeout("B") == 1
+        assert os.listdir(tmpdir) == ["snapshot"]
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_routing_groups_are_kept_until_subscribed():
+    state = SharedState(size=4096)
+    with mock.patch.object(SharedState, "is_leader", return_value=False):
+        proxy = CocaineProxy(shared_state=state)
+    restored = {"A": [[1, "A1"]]}
+    proxy.current_rg = restored
+
+    def future(result=None, error=None):
+        f = Future()
+        if error is not None:
+            f.set_exception(error)
+        else:
+            f.set_result(result)
+        return f
+
+    channel = mock.Mock()
+    channel.rx.get.side_effect = [future({"B": [[1, "B1"]]}), future(error=Exception("lost"))]
+    subscribed = Future()
+    proxy.locator = mock.Mock()
+    # the locator is down at start, then it delivers a table and is lost again
+    proxy.locator.routing.side_effect = [future(error=Exception("down")), subscribed, Future()]
+
+    @gen.coroutine
+    def run():
+        proxy.io_loop.add_future(proxy.on_routing_groups_update(), lambda f: None)
+        yield gen.moment
+        assert proxy.current_rg == restored
+        subscribed.set_result(channel)
+        for _ in xrange(5):
+            yield gen.moment
+        assert proxy.current_rg == {}
+        assert state.routing.read()["routing"] == {}
+
+    with mock.patch("cocaine.proxy.proxy.gen.sleep", return_value=future()):
+        proxy.io_loop.run_sync(run)
+
+
+def test_snapshot_broken_file_is_ignored():
+    with tempfile.NamedTemporaryFile() as f:
+        f.write("garbage")
+        f.flush()
+        proxy = CocaineProxy(snapshot_path=f.name)
+        assert proxy.current_rg == {}
+        assert proxy.timeouts == {}
+
+
+def test_drop_unwatched():
+    values = {"A": 1, "B": 2}
+    drop_unwatched(values, set(["A"]))
+    assert values == {"A": 1}
+
+
+def test_info_aggregates_workers():
+    stats = SharedCounters(WORKER_STATS, rows=2)
+    stats.select(1)
+    stats.incr("requests_total", 10)
+
+    proxy = CocaineProxy(stats=stats)
+    proxy.stats.incr("requests_total", 2)
+    info = proxy.info()
+    assert info["requests"]["total"] == 12
+    assert info["worker"] == 0
+    assert [w["requests"]["total"] for w in info["workers"]] == [2, 10]
+    assert info["workers"][0]["pid"] == os.getpid()
+    assert info["json"]["encoder"] in info["json"]["available"]
+
+
+def test_latency_is_recorded_on_finish():
+    board = SharedBoard(rows=2)
+    proxy = CocaineProxy(board=board)
+
+    request = mock.Mock()
+    request.app_name = "app"
+    request.event_name = "event"
+    request.response_code = 200
+    request.response_time = 0.010
+    request.headers_time = 0.002
+    proxy.on_request_finished(request)
+
+    other = LatencyHistograms()
+    other.record("app", "event", 200, 30.0, 1.0)
+    board.slots[1].publish({"latency": other.dump()})
+
+    summary = proxy.latency_summary()
+    assert len(summary) == 1
+    assert summary[0]["total"]["count"] == 2
+    assert summary[0]["headers"]["count"] == 2
+
+
+def test_render_metrics():
+    stats = SharedCounters(WORKER_STATS, rows=2)
+    stats.select(1)
+    stats.incr("requests_disconnections", 3)
+    proxy = CocaineProxy(stats=stats, board=SharedBoard(rows=2))
+
+    request = mock.Mock()
+    request.app_name = "app"
+    request.event_name = "event"
+    request.response_code = 200
+    request.response_time = 0.01
+    request.headers_time = None
+    proxy.on_request_finished(request)
+    proxy.cache["app"].append(mock.Mock())
+
+    text = proxy.render_metrics()
+    assert 'cocaine_proxy_requests_total{app="app",code="200"} 1' in text
+    assert 'cocaine_proxy_disconnections_total 3' in text
+    assert 'cocaine_proxy_requests_in_progress{worker="1"} 0' in text
+    assert 'cocaine_proxy_pool_size{app="app",worker="0"} 1' in text
+
+
+def test_memory_info():
+    proxy = CocaineProxy()
+    app = mock.Mock(_connected=True, sessions={1: None})
+    proxy.cache["app"].append(app)
+    proxy.migrate_from_cache_to_inactive(app, "app")
+    proxy.cache["app"].append(mock.Mock(_connected=False, sessions={}))
+
+    info = proxy.memory_info()
+    assert info["diff"] is None
+    assert info["connections"] == {"app": {"active": 1, "connected": 0, "sessions": 0, "disposing": 1}}
+    assert info["structures"]["disposing"] == 1
+
+    proxy.dispose(app, "app")
+    diff = proxy.memory_info()["diff"]
+    assert diff["structures"]["disposing"] == -1
+
+
+def test_stage_timings():
+    request = HTTPServerRequest(method="GET", uri="/app/event", connection=mock.Mock())
+    request.logger = mock.Mock()
+    mark_stage(request, "dispatch")
+    assert stage_durations(request) == []
+
+    request.stages = []
+    elapsed = iter([0.001, 0.003, 0.004, 0.010, 0.012, 0.015, 0.016])
+    request.request_time = lambda: next(elapsed)
+    for stage in ("dispatch", "connect", "enqueue", "reconnect", "enqueue"):
+        mark_stage(request, stage)
+
+    durations = [(stage, round(duration, 6)) for stage, duration in stage_durations(request)]
+    assert durations == [("dispatch", 0.001), ("connect", 0.002), ("enqueue", 0.003), ("reconnect", 0.006)]
+
+    request.server_timing = True
+    fill_response_in(request, 200, "OK", "body")
+    headers = request.connection.write_headers.call_args[0][1]
+    assert headers["Server-Timing"] == "dispatch;dur=1.00, connect;dur=2.00, enqueue;dur=3.00, reconnect;dur=6.00"
+    message = request.logger.info.call_args[0][0] % request.logger.info.call_args[0][1:]
+    assert message.endswith("stages: dispatch=1.00ms connect=2.00ms enqueue=3.00ms reconnect=6.00ms finalize=3.00ms")
+
+
+def test_rate_limiter():
+    limiter = RateLimiter(rate=2, max_keys=2)
+    assert [limiter.allow("app", now=100) for _ in xrange(3)] == [True, True, False]
+    assert not limiter.allow("app", now=100.4)
+    assert limiter.allow("app", now=100.5)
+
+    assert limiter.allow("other", now=100.5)
+    # idle buckets are full again, so they are dropped to make room
+    assert limiter.allow("third", now=110)
+    assert sorted(limiter.buckets) == ["third"]
+
+    # none of the buckets is idle, so the least recently used one makes room
+    limiter = RateLimiter(rate=1, max_keys=3)
+    assert limiter.allow("app", now=100)
+    for i in xrange(100):
+        assert limiter.allow("app%d" % i, now=100)
+        # the used bucket is kept as it's recently used
+        assert not limiter.allow("app", now=100)
+        assert len(limiter.buckets) <= 3
+    assert list(limiter.buckets) == ["app98", "app99", "app"]
+
+    assert all(RateLimiter(rate=0).allow("app") for _ in xrange(100))
+
+
+def test_tracing_is_rate_limited():
+    proxy = CocaineProxy(default_tracing_chance=100, tracing_rate=1)
+    traced = []
+    for _ in xrange(3):
+        request = mock.Mock(traceid="1", tracebit=True)
+        proxy.setup_tracing(request, "app")
+        traced.append(request.tracebit)
+    assert traced == [True, False, False]
+
+    proxy = CocaineProxy(default_tracing_chance=0, tracing_rate=1)
+    request = mock.Mock(traceid="1")
+    proxy.setup_tracing(request, "app")
+    assert request.tracebit is False
+    assert proxy.tracing_limiter.buckets == {}
+
+
+def test_binary_access_log():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, "access.bin")
+        proxy = CocaineProxy(binary_access_log=path)
+        headers = HTTPHeaders({"X-Cocaine-JSON-RPC": "1", "Authorization": "secret", "Cookie": "a=b"})
+        request = HTTPServerRequest(method="POST", uri="/app/event", body="body", headers=headers,
+                                    connection=mock.Mock())
+        request.logger = mock.Mock()
+        request.plugin = "jsonrpc"
+        request.traceid = "abcdef"
+        request.stages = []
+        request.app_name, request.event_name = "app", "event"
+        fill_response_in(request, 200, "OK", "response")
+        proxy.on_request_finished(request)
+        proxy.flush_binary_access_log()
+
+        records = list(read_records(path))
+        assert len(records) == 1
+        record = records[0]
+        assert (record["app"], record["event"], record["code"]) == ("app", "event", 200)
+        assert (record["request_size"], record["response_size"]) == (4, 8)
+        assert record["traceid"] == "abcdef"
+        assert record["stages_us"].keys() == ["finalize"]
+        # credentials are never logged
+        assert (record["plugin"], record["trigger_headers"], record["authorization"]) == \
+            ("jsonrpc", {"X-Cocaine-Json-Rpc": "1"}, True)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_ttl_cache():
+    cache = TTLCache(size=2, ttl=10)
+    cache.put("a", 1, now=0)
+    cache.put("b", 2, now=0)
+    assert cache.get("a", now=5) == 1
+    # "b" is the least recently used one
+    cache.put("c", 3, now=5)
+    assert cache.get("b", now=5) is None
+    assert cache.get("a", now=9) == 1
+    assert cache.get("a", now=10) is None
+    assert len(cache) == 1
+
+    cache.put("d", 4, ttl=1, now=10)
+    assert cache.get("d", now=10.5) == 4
+    assert cache.get("d", "missing", now=11) == "missing"
+
+    disabled = TTLCache(size=0, ttl=10)
+    disabled.put("a", 1)
+    assert disabled.get("a") is None
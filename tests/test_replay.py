@@ -0,0 +1,89 @@
+import os
+import shutil
+import tempfile
+
+from tornado import web
+from tornado.testing import AsyncHTTPTestCase
+from tornado.testing import gen_test
+
+from cocaine.proxy.accesslog import BinaryAccessLog
+from cocaine.tools.actions.proxyreplay import parse_time
+from cocaine.tools.actions.proxyreplay import read_requests
+from cocaine.tools.actions.proxyreplay import REPLAY_AUTHORIZATION
+from cocaine.tools.actions.proxyreplay import ReplayRequest
+from cocaine.tools.actions.proxyreplay import Replayer
+
+
+TEXT_LOG = (
+    "[+0300 19/Oct/2026:10:00:00.5]\t[proxy:297]\tINFO\taaaa\tstart request: host 127.0.0.1 /app/ping?x=1 POST\n"
+    "[+0300 19/Oct/2026:10:00:00.6]\t[proxy:868]\tINFO\taaaa\tsticky_header has been found: "
+    "name app, value 42, seed 42\n"
+    "[+0300 19/Oct/2026:10:00:00.7]\t[helpe:85]\tINFO\taaaa\tfinish request: 200 OK 1.00ms\n"
+    "[+0300 19/Oct/2026:10:00:01.5]\t[proxy:297]\tINFO\tbbbb\tstart request: host 127.0.0.1 /app/ping\n"
+)
+
+
+def test_parse_time():
+    assert parse_time("+0000 01/Jan/1970:00:00:10.5") == 10.005
+    assert parse_time("+0300 01/Jan/1970:03:00:10.250") == 10.25
+
+
+def test_read_requests():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        text = os.path.join(tmpdir, "access.log")
+        with open(text, "w") as f:
+            f.write(TEXT_LOG)
+
+        binary = os.path.join(tmpdir, "access.bin")
+        log = BinaryAccessLog(binary)
+        started = parse_time("+0300 19/Oct/2026:10:00:01.0")
+        log.write([int(started * 1000000) + 2000, "cccc", "app", "ping", 200, 5, 0, 2000, {},
+                   "PUT", "/?x=2", None])
+        log.write([int(started * 1000000) + 5000, "dddd", "app", "read", 200, 0, 0, 1000, {},
+                   "GET", "/", None, "mds", {"X-Srw-Key": "1/key", "X-Srw-Namespace": "ns"}, True])
+        log.close()
+
+        requests = read_requests([binary, text])
+        assert [r.uri for r in requests] == ["/app/ping?x=1", "/?x=2", "/", "/app/ping"]
+        assert requests[0].method == "POST"
+        assert requests[0].headers == {"X-Cocaine-Sticky": "42"}
+        assert requests[1] == ReplayRequest(started, "PUT", "/?x=2",
+                                            {"X-Cocaine-Service": "app", "X-Cocaine-Event": "ping"}, 5, None)
+        assert requests[2].plugin == "mds"
+        assert requests[2].headers == {"X-Cocaine-Service": "app", "X-Cocaine-Event": "read",
+                                       "X-Srw-Key": "1/key", "X-Srw-Namespace": "ns",
+                                       "Authorization": REPLAY_AUTHORIZATION}
+        assert requests[3].method == "GET"
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+class _EchoHandler(web.RequestHandler):  # pylint: disable=W0223
+    def get(self):
+        self.set_status(int(self.get_argument("code", 200)))
+
+    def put(self):
+        assert self.request.headers["X-Cocaine-Service"] == "app"
+        self.write(str(len(self.request.body)))
+
+
+class TestReplayer(AsyncHTTPTestCase):
+    def get_app(self):
+        return web.Application([(r"/.*", _EchoHandler)])
+
+    @gen_test
+    def test_replay(self):
+        requests = [ReplayRequest(0.01 * i, "GET", "/?code=%d" % (200 if i % 2 else 502), {}, 0, None)
+                    for i in xrange(6)]
+        requests.append(ReplayRequest(0.07, "PUT", "/", {"X-Cocaine-Service": "app"}, 10, "mds"))
+        replayer = Replayer(self.get_url("/"), speed=2, concurrency=2)
+        report = yield replayer.run(requests)
+
+        self.assertEqual(report["requests"], 7)
+        self.assertEqual(report["codes"], {200: 4, 502: 3})
+        self.assertEqual(report["errors"], 3)
+        self.assertEqual(report["plugins"], {"mds": 1})
+        # the original timing is stretched twice
+        self.assertTrue(report["duration"] >= 0.035, report)
+        self.assertTrue(report["latency_ms"]["max"] > 0)
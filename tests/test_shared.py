@@ -0,0 +1,195 @@
+import os
+
+import mock
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.testing import AsyncTestCase
+from tornado.testing import gen_test
+
+from cocaine.proxy.shared import SharedCounters
+from cocaine.proxy.shared import SharedLocator
+from cocaine.proxy.shared import SharedStore
+from cocaine.proxy.shared import SharedStoreBusy
+from cocaine.proxy.shared import SharedStoreOverflow
+
+
+def test_shared_store_read_publish():
+    store = SharedStore(4096)
+    assert store.read() is None
+    assert store.read({}) == {}
+
+    store.publish({"A": [[1, "A1"], [2, "A2"]]})
+    generation = store.generation()
+    assert generation % 2 == 0
+    assert store.read() == {"A": [[1, "A1"], [2, "A2"]]}
+
+    store.update(lambda current: dict(current, B=[]))
+    assert store.generation() == generation + 2
+    assert store.read() == {"A": [[1, "A1"], [2, "A2"]], "B": []}
+
+
+def test_shared_store_never_waits_for_lock():
+    store = SharedStore(4096)
+    store.publish({"A": []})
+    # e.g. a writer has been killed in the middle of an update
+    store._lock.acquire()
+    try:
+        store.update(lambda current: dict(current, B=[]))
+    except SharedStoreBusy:
+        pass
+    else:
+        assert False, "SharedStoreBusy has not been raised"
+    assert store.read() == {"A": []}
+
+    locator = SharedLocator(mock.Mock(), store)
+    locator.store("B", [[["host", 10053]], 1, {}])
+    assert locator.lookup("B") is None
+
+    single = SharedStore(4096, single_writer=True)
+    single.publish({"A": []})
+    single.update(lambda current: dict(current, B=[]))
+    assert single.read() == {"A": [], "B": []}
+
+
+def test_contended_invalidation():
+    store = SharedStore(4096)
+    leader, follower = SharedLocator(mock.Mock(), store), SharedLocator(mock.Mock(), store)
+    leader.store("app", [[["host", 10053]], 1, {}])
+
+    locked_r, locked_w = os.pipe()
+    release_r, release_w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        # another process is in the middle of an update
+        store._acquire()
+        os.write(locked_w, "x")
+        os.read(release_r, 1)
+        store._release()
+        os._exit(0)
+
+    os.read(locked_r, 1)
+    try:
+        # both processes get the same routing update at once
+        leader.invalidate("app")
+        follower.invalidate("app", shared=False)
+        assert leader.lookup("app") is None
+        assert follower.lookup("app") is None
+        # the busy store keeps the entry for the processes which have not seen the update
+        assert "app" in store.read()
+    finally:
+        os.write(release_w, "x")
+        os.waitpid(pid, 0)
+
+    leader.invalidate("app")
+    assert "app" not in store.read()
+
+    # a newer result is shared again
+    follower.store("app", [[["host", 10054]], 1, {}])
+    assert leader.lookup("app") == ([["host", 10054]], 1, {})
+
+
+def test_lock_of_dead_writer_is_taken_over():
+    store = SharedStore(4096)
+    store.publish({"A": []})
+    pid = os.fork()
+    if pid == 0:
+        # killed in the middle of an update
+        store._acquire()
+        os._exit(0)
+
+    os.waitpid(pid, 0)
+    store.update(lambda current: dict(current, B=[]))
+    assert store.read() == {"A": [], "B": []}
+    # the lock is released as usual after the takeover
+    store.publish({})
+    assert store.read() == {}
+
+
+def test_shared_store_overflow():
+    store = SharedStore(32)
+    try:
+        store.publish("x" * 64)
+    except SharedStoreOverflow:
+        pass
+    else:
+        assert False, "SharedStoreOverflow has not been raised"
+    assert store.read() is None
+
+
+def test_shared_store_is_visible_after_fork():
+    store = SharedStore(4096)
+    pid = os.fork()
+    if pid == 0:
+        store.publish({"published_by": "child"})
+        os._exit(0)
+
+    os.waitpid(pid, 0)
+    assert store.read() == {"published_by": "child"}
+
+
+def test_shared_counters():
+    counters = SharedCounters(("inprogress", "total"), rows=3)
+    pid = os.fork()
+    if pid == 0:
+        counters.select(2)
+        counters.incr("total", 5)
+        counters.set("inprogress", 1)
+        os._exit(0)
+    os.waitpid(pid, 0)
+
+    counters.incr("total")
+    assert counters.get("total") == 1
+    assert counters.row_values(2) == {"inprogress": 1, "total": 5}
+    assert counters.row_values(1) == {"inprogress": 0, "total": 0}
+    assert counters.totals() == {"inprogress": 1, "total": 6}
+
+
+class _FakeLocator(object):
+    def __init__(self, value):
+        self.value = value
+        self.resolves = 0
+
+    def resolve(self, name):
+        self.resolves += 1
+        channel = mock.Mock()
+        rx_future = Future()
+        rx_future.set_result(self.value)
+        channel.rx.get.return_value = rx_future
+
+        future = Future()
+        future.set_result(channel)
+        return future
+
+
+class TestSharedLocator(AsyncTestCase):
+    @gen_test
+    def test_resolve_is_cached(self):
+        value = ([["localhost", 10054]], 1, {0: ["enqueue", {}, {}]})
+        locator = _FakeLocator(value)
+        shared = SharedLocator(locator, SharedStore(4096))
+
+        channel = yield shared.resolve("app")
+        resolved = yield channel.rx.get(timeout=1)
+        self.assertEqual(resolved, value)
+        self.assertEqual(locator.resolves, 1)
+
+        channel = yield shared.resolve("app")
+        resolved = yield channel.rx.get(timeout=1)
+        self.assertEqual(resolved, value)
+        self.assertEqual(locator.resolves, 1)
+
+        shared.invalidate("app")
+        channel = yield shared.resolve("app")
+        yield channel.rx.get(timeout=1)
+        self.assertEqual(locator.resolves, 2)
+
+    @gen_test
+    def test_resolve_expires(self):
+        locator = _FakeLocator(([["localhost", 10054]], 1, {}))
+        shared = SharedLocator(locator, SharedStore(4096), ttl=-1)
+
+        for _ in range(2):
+            channel = yield shared.resolve("app")
+            yield channel.rx.get()
+            yield gen.moment
+        self.assertEqual(locator.resolves, 2)